@@ -0,0 +1,92 @@
+from math import ceil, floor, log2
+from statistics import mean
+
+import constants
+from resource_metrics_utils import parse_quantity
+
+
+def container_budget(resources, resource, target_utilization):
+    """
+        Share of a worker container's limit(or request without a limit)
+        its busy slots may use
+        @returns cores or bytes, None if neither is set
+    """
+    quantity = (resources.get('limits') or {}).get(resource) or \
+        (resources.get('requests') or {}).get(resource)
+    if not quantity:
+        return None
+    return parse_quantity(quantity) * target_utilization / 100
+
+
+def tune_concurrency(pool, usage):
+    """
+        Fits concurrency to the cpu and memory one busy slot uses, measured
+        while the pool has a backlog so every slot is busy. IO-bound tasks
+        use a fraction of a core per slot and get more slots than cores,
+        CPU-bound ones about one slot per core. Moves at most by a factor
+        of 2 per step
+        @param: usage - resource name -> usage of every pod, see pod_usage
+        @returns concurrency or None if nothing could be measured
+    """
+    autotune = pool.autotune
+    target = autotune.get('targetUtilization', constants.AUTOTUNE_TARGET_UTILIZATION)
+    fits = []
+    for resource in constants.UTILIZATION_RESOURCES:
+        budget = container_budget(pool.resources or {}, resource, target)
+        pods = usage.get(resource)
+        if budget is None or not pods or not mean(pods):
+            continue
+        per_slot = mean(pods) / pool.concurrency
+        fits.append(floor(budget / per_slot))
+    if not fits:
+        return None
+
+    concurrency = min(fits)
+    concurrency = min(max(concurrency, ceil(pool.concurrency / 2)), pool.concurrency * 2)
+    return min(
+        max(concurrency, autotune.get('minConcurrency', 1)),
+        autotune.get('maxConcurrency', constants.AUTOTUNE_MAX_CONCURRENCY)
+    )
+
+
+def tune_prefetch_multiplier(pool, runtime):
+    """
+        Long tasks prefetch one message per process, so a busy process
+        doesn't hold back messages idle ones could run. Short tasks prefetch
+        about AUTOTUNE_PREFETCH_SECONDS worth of messages to save broker
+        round trips. Rounded to a power of 2, so runtime noise doesn't
+        change it
+        @param: runtime - median task runtime of the pool in seconds
+        @returns prefetch multiplier or None without a runtime
+    """
+    if not runtime:
+        return None
+    multiplier = constants.AUTOTUNE_PREFETCH_SECONDS / runtime
+    if multiplier <= 1:
+        return 1
+    return min(
+        2 ** round(log2(multiplier)),
+        pool.autotune.get('maxPrefetchMultiplier', constants.AUTOTUNE_MAX_PREFETCH_MULTIPLIER)
+    )
+
+
+def recommend_worker_settings(pool, usage, runtime):
+    """
+        @param: usage - pod usage measured while the pool had a backlog, or
+            None
+        @returns settings to apply, status.autotune style, or {} when the
+        current ones are close enough
+    """
+    settings = {}
+    # a solo pool runs one task at a time whatever its concurrency
+    if usage and pool.pool != 'solo':
+        concurrency = tune_concurrency(pool, usage)
+        if concurrency is not None and \
+                abs(concurrency - pool.concurrency) >= pool.concurrency * constants.AUTOTUNE_MIN_CHANGE:
+            settings['concurrency'] = concurrency
+
+    prefetch_multiplier = tune_prefetch_multiplier(pool, runtime)
+    current = pool.prefetch_multiplier or constants.CELERY_DEFAULT_PREFETCH_MULTIPLIER
+    if prefetch_multiplier is not None and prefetch_multiplier != current:
+        settings['prefetchMultiplier'] = prefetch_multiplier
+    return settings
@@ -0,0 +1,305 @@
+"""
+    Offline autoscaler simulator.
+
+    Replays queue traces through the real horizontal_autoscale code with a
+    fake clock and a fake AppsV1Api, and reports time-to-drain, peak backlog,
+    the longest time a task waited, replica-seconds(cost) and the number of
+    scale events.
+
+    Synthetic scenarios (closed loop, workers drain the simulated queue):
+        python benchmarks/autoscaler_simulator.py
+        python benchmarks/autoscaler_simulator.py --cr deploy/cr.yaml --json
+
+    Recorded traces(CSV with a header):
+        t,arrivals      - tasks arriving during second t, simulated closed loop
+        t,queue_length  - observed queue length, replayed as is(open loop)
+
+        python benchmarks/autoscaler_simulator.py --trace recorded.csv
+
+    CPU-bound workers prefetching tasks keep the broker queue short, compare
+    queue length alone with an added cpu utilization target(stubbed
+    metrics API reporting busy workers at their full cpu request):
+        python benchmarks/autoscaler_simulator.py --prefetch 50 --cpu-target 70
+
+    Hold a message wait time instead of a queue length, optionally with
+    the broker reporting the age of the oldest message:
+        python benchmarks/autoscaler_simulator.py --wait-target 60 --message-age
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+from collections import deque
+from types import SimpleNamespace
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import handlers  # NOQA
+import scaling_utils  # NOQA
+from resource_metrics_utils import parse_quantity  # NOQA
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeAppsV1Api:
+    """
+        Implements the AppsV1Api calls made by horizontal_autoscale.
+        Scale ups become ready only after startup_seconds.
+    """
+
+    def __init__(self, clock, replicas, startup_seconds):
+        self.clock = clock
+        self.replicas = replicas
+        self.startup_seconds = startup_seconds
+        self.pending = []  # (ready_at, replicas)
+        self.ready = replicas
+        self.patches = 0
+
+    def read_namespaced_deployment_scale(self, name, namespace, **kwargs):
+        return SimpleNamespace(spec=SimpleNamespace(replicas=self.replicas))
+
+    def read_namespaced_deployment_status(self, name, namespace, **kwargs):
+        return SimpleNamespace(status=SimpleNamespace(ready_replicas=self.ready))
+
+    def patch_namespaced_deployment(self, name, namespace, body, **kwargs):
+        self.patches += 1
+        replicas = body['spec']['replicas']
+        if replicas > self.replicas:
+            self.pending.append((self.clock() + self.startup_seconds, replicas))
+        else:
+            self.pending = [(t, min(r, replicas)) for t, r in self.pending]
+            self.ready = min(self.ready, replicas)
+        self.replicas = replicas
+        return SimpleNamespace(
+            metadata=SimpleNamespace(name=name),
+            spec=SimpleNamespace(replicas=replicas)
+        )
+
+    def tick(self):
+        now = self.clock()
+        while self.pending and self.pending[0][0] <= now:
+            _, replicas = self.pending.pop(0)
+            self.ready = max(self.ready, min(replicas, self.replicas))
+
+
+class FakeMetricsApi:
+    """
+        Implements the metrics.k8s.io pod metrics read by horizontal_autoscale.
+        Ready workers report cpu usage proportional to how busy they are
+    """
+
+    def __init__(self, apps_api, cpu_request):
+        self.apps_api = apps_api
+        self.cpu_request = cpu_request
+        self.busy = 0.0
+
+    def list_namespaced_custom_object(self, group, version, namespace, plural, **kwargs):
+        usage = f"{int(self.busy * self.cpu_request * 1e9)}n"
+        return {'items': [
+            {'containers': [{'usage': {'cpu': usage, 'memory': '64Mi'}}]}
+            for _ in range(self.apps_api.ready)
+        ]}
+
+
+def burst_trace(duration=3600, base=1, burst=20, every=900, length=60):
+    return [burst if t % every < length else base for t in range(duration)]
+
+
+def diurnal_trace(duration=6 * 3600, low=0.5, high=4.5, period=6 * 3600):
+    return [
+        low + (high - low) * (1 - math.cos(2 * math.pi * t / period)) / 2
+        for t in range(duration)
+    ]
+
+
+def step_trace(duration=3600, before=1, after=4, at=600, until=2400):
+    return [after if at <= t < until else before for t in range(duration)]
+
+
+# Rates are tasks/sec, sized for the example CR i.e. 2-5 workers at 1 task/sec
+SCENARIOS = {
+    'burst': burst_trace,
+    'diurnal': diurnal_trace,
+    'step': step_trace,
+}
+
+
+def load_trace(path):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    column = 'arrivals' if 'arrivals' in rows[0] else 'queue_length'
+    return column, [float(row[column]) for row in rows]
+
+
+def simulate(spec, arrivals=None, queue_lengths=None, task_rate=1.0,
+             startup_seconds=30, interval=10, drained_below=1, prefetch=0,
+             message_age=False):
+    """
+        Runs one trace through horizontal_autoscale, one entry per second.
+        @param: arrivals - tasks arriving per second, worker drain simulated
+        @param: queue_lengths - recorded queue lengths replayed as observed
+        @param: task_rate - tasks/sec a single ready worker processes
+        @param: prefetch - tasks each ready worker reserves off the broker
+            queue, hidden from queue length metrics
+        @param: message_age - report the oldest message's age like a redis
+            broker with timestamped messages does
+        @returns dict of the summary numbers
+    """
+    clock = FakeClock()
+    replicas = spec['workerSpec']['numOfWorkers']
+    apps_api = FakeAppsV1Api(clock, replicas, startup_seconds)
+    cpu_request = spec['workerSpec'].get('resources', {}).get('requests', {}).get('cpu', '1')
+    metrics_api = FakeMetricsApi(apps_api, parse_quantity(cpu_request))
+    queue_name = spec['workerSpec']['queues']
+    # celery@<pod name>, pods are named <deployment>-<template hash>-<suffix>
+    hostname = f"celery@{spec['common']['appName']}-celery-worker-5d8f7c9b4-x2x7q"
+    name = namespace = 'simulation'
+    scaling_utils.forget_scaling_state(namespace, name)
+
+    trace = arrivals if arrivals is not None else queue_lengths
+    backlog = processed = 0.0
+    peak_backlog = replica_seconds = 0.0
+    scale_events = 0
+    drain_started_at = None
+    drain_times = []
+    # [arrived at, tasks] in queue order, to measure how long tasks wait
+    waiting = deque()
+    max_wait = 0.0
+
+    for second, value in enumerate(trace):
+        clock.now = float(second)
+        apps_api.tick()
+        if arrivals is not None:
+            backlog += value
+            done = min(backlog, apps_api.ready * task_rate)
+            metrics_api.busy = done / (apps_api.ready * task_rate) if apps_api.ready else 0
+            backlog -= done
+            processed += done
+            if value:
+                waiting.append([clock.now, value])
+            while done > 1e-9 and waiting:
+                taken = min(done, waiting[0][1])
+                waiting[0][1] -= taken
+                done -= taken
+                if waiting[0][1] <= 1e-9:
+                    waiting.popleft()
+        else:
+            backlog = value
+        oldest_age = clock.now - waiting[0][0] if waiting else None
+        max_wait = max(max_wait, oldest_age or 0)
+
+        peak_backlog = max(peak_backlog, backlog)
+        replica_seconds += apps_api.replicas
+        if backlog >= drained_below and drain_started_at is None:
+            drain_started_at = clock.now
+        elif backlog < drained_below and drain_started_at is not None:
+            drain_times.append(clock.now - drain_started_at)
+            drain_started_at = None
+
+        if second % interval == 0:
+            before = apps_api.replicas
+            handlers.horizontal_autoscale(
+                spec, name, namespace,
+                [{'name': queue_name, 'messages': int(max(backlog - apps_api.ready * prefetch, 0))}],
+                processed_counts={hostname: int(processed)} if arrivals is not None else None,
+                apps_api_instance=apps_api,
+                now=clock.now,
+                metrics_api=metrics_api,
+                message_ages={queue_name: oldest_age} if message_age and oldest_age is not None else None
+            )
+            scale_events += apps_api.replicas != before
+
+    if drain_started_at is not None:
+        drain_times.append(len(trace) - drain_started_at)
+
+    return {
+        'max_time_to_drain': max(drain_times, default=0),
+        'mean_time_to_drain': round(sum(drain_times) / len(drain_times), 1) if drain_times else 0,
+        'peak_backlog': int(peak_backlog),
+        'max_wait': int(max_wait),
+        'replica_seconds': int(replica_seconds),
+        'scale_events': scale_events,
+        'patches': apps_api.patches,
+    }
+
+
+def main(args):
+    with open(args.cr) as f:
+        spec = yaml.safe_load(f)['spec']
+    if args.scale_target:
+        with open(args.scale_target) as f:
+            spec['scaleTargetRef'] = json.load(f)
+    if args.cpu_target:
+        for target in spec['scaleTargetRef']:
+            target['metrics'].append({
+                'name': 'cpu',
+                'target': {'type': 'utilization', 'averageUtilization': args.cpu_target}
+            })
+
+    if args.wait_target:
+        for target in spec['scaleTargetRef']:
+            for metric in target['metrics']:
+                metric['target'] = {
+                    'type': 'waitTime',
+                    'waitSeconds': args.wait_target,
+                    'averageValue': metric['target'].get('averageValue')
+                }
+
+    kwargs = dict(
+        task_rate=args.task_rate,
+        startup_seconds=args.startup,
+        interval=args.interval,
+        prefetch=args.prefetch,
+        message_age=args.message_age
+    )
+    results = {}
+    if args.trace:
+        column, trace = load_trace(args.trace)
+        results[os.path.basename(args.trace)] = simulate(spec, **{column: trace}, **kwargs)
+    else:
+        for scenario, make_trace in SCENARIOS.items():
+            results[scenario] = simulate(spec, arrivals=make_trace(), **kwargs)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    columns = list(next(iter(results.values())))
+    print(f"{'scenario':<12}" + ''.join(f"{c:>20}" for c in columns))
+    for scenario, summary in results.items():
+        print(f"{scenario:<12}" + ''.join(f"{summary[c]:>20}" for c in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cr', default='deploy/cr.yaml',
+                        help='Celery CR whose workerSpec and scaleTargetRef are simulated')
+    parser.add_argument('--scale-target',
+                        help='JSON file with a scaleTargetRef list overriding the CR one')
+    parser.add_argument('--trace', help='CSV trace to replay instead of synthetic scenarios')
+    parser.add_argument('--task-rate', type=float, default=1.0,
+                        help='tasks/sec processed by one worker replica')
+    parser.add_argument('--startup', type=int, default=30,
+                        help='seconds for a new worker replica to become ready')
+    parser.add_argument('--interval', type=int, default=10,
+                        help='autoscaling evaluation interval in seconds')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='tasks each ready worker reserves, hidden from the queue length')
+    parser.add_argument('--cpu-target', type=int,
+                        help='adds a cpu utilization target with this averageUtilization')
+    parser.add_argument('--wait-target', type=int,
+                        help='replaces queue length metrics with waitTime targets of this many seconds')
+    parser.add_argument('--message-age', action='store_true',
+                        help='report the oldest message age to waitTime targets')
+    parser.add_argument('--json', action='store_true')
+    main(parser.parse_args())
@@ -0,0 +1,307 @@
+"""
+    Replica budget simulator.
+
+    Runs many Celery resources through the real horizontal_autoscale code
+    and the batched budget allocation with a fake clock, on a cluster that
+    fits --capacity worker pods. Pods beyond the capacity stay pending and
+    get scheduled first come first served, like on a full node pool.
+
+    --high of the resources are latency critical(priorityWeight
+    --high-weight) with bursts at random times, the others run batch jobs
+    at priorityWeight 1. During the storm every resource bursts at once and
+    the batch jobs queue --batch-size tasks each.
+
+    Compares no budget, a budget of --capacity replicas with equal weights
+    and with priority weights, and reports per class the mean and p99
+    time tasks waited and the worst resource's longest wait, plus pod
+    seconds spent pending and the cost of an allocation pass.
+
+    Usage (from the repository root):
+        python benchmarks/budget_simulator.py --crs 100 --capacity 300
+        python benchmarks/budget_simulator.py --passes 10000
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import budget_utils  # NOQA
+import constants  # NOQA
+import handlers  # NOQA
+import scaling_utils  # NOQA
+from autoscaler_simulator import FakeAppsV1Api, FakeClock  # NOQA
+
+
+NAMESPACE = 'simulation'
+MODES = ('none', 'equal', 'weighted')
+
+
+class ScheduledAppsV1Api(FakeAppsV1Api):
+    """
+        A deployment whose pods only run once the cluster scheduled them
+    """
+
+    def __init__(self, clock, replicas, startup_seconds):
+        super().__init__(clock, replicas, startup_seconds)
+        self.scheduled = replicas
+        self.pending_since = None
+
+    @property
+    def consuming(self):
+        return min(self.ready, self.scheduled)
+
+    def read_namespaced_deployment_status(self, name, namespace, **kwargs):
+        return SimpleNamespace(status=SimpleNamespace(ready_replicas=self.consuming))
+
+
+def schedule(apps_apis, capacity, now):
+    """
+        Frees the pods of scale downs, then schedules pending pods in the
+        order their deployments started waiting
+        @returns pods left pending
+    """
+    for apps_api in apps_apis:
+        apps_api.scheduled = min(apps_api.scheduled, apps_api.replicas)
+    free = capacity - sum(apps_api.scheduled for apps_api in apps_apis)
+    waiting = [apps_api for apps_api in apps_apis if apps_api.replicas > apps_api.scheduled]
+    for apps_api in waiting:
+        if apps_api.pending_since is None:
+            apps_api.pending_since = now
+    for apps_api in sorted(waiting, key=lambda apps_api: apps_api.pending_since):
+        placed = min(free, apps_api.replicas - apps_api.scheduled)
+        apps_api.scheduled += placed
+        free -= placed
+    pending = 0
+    for apps_api in apps_apis:
+        if apps_api.replicas == apps_api.scheduled:
+            apps_api.pending_since = None
+        pending += apps_api.replicas - apps_api.scheduled
+    return pending
+
+
+def make_specs(args, base_spec, weighted):
+    """
+        @returns [(name, spec, class)]
+    """
+    specs = []
+    for index in range(args.crs):
+        spec = copy.deepcopy(base_spec)
+        high = index < args.high
+        spec['common']['appName'] = f"app-{index}"
+        spec['workerSpec']['numOfWorkers'] = 1
+        spec['scaleTargetRef'] = [{
+            'kind': 'worker',
+            'minReplicas': 1,
+            'maxReplicas': args.max_replicas,
+            'metrics': [{
+                'name': 'message_queue',
+                'target': {'type': 'length', 'averageValue': args.target}
+            }]
+        }]
+        if weighted and high:
+            spec['priorityWeight'] = args.high_weight
+        specs.append((f"cr-{index}", spec, 'high' if high else 'low'))
+    return specs
+
+
+def make_arrivals(args, rng, kind):
+    """
+        @returns tasks arriving per second
+    """
+    arrivals = [0.0] * args.duration
+    storm = range(args.storm_at, args.storm_at + args.storm_length)
+    if kind == 'high':
+        phase = rng.randrange(args.burst_every)
+        for second in range(args.duration):
+            bursting = (second + phase) % args.burst_every < args.burst_length
+            arrivals[second] = args.burst_rate if bursting or second in storm else args.base_rate
+    else:
+        for second in range(args.duration):
+            arrivals[second] = args.base_rate / 2
+        arrivals[args.storm_at + rng.randrange(args.storm_length)] += args.batch_size
+    return arrivals
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def simulate(args, mode):
+    """
+        @returns per class summary numbers and cluster numbers
+    """
+    base_spec = yaml.safe_load(open(args.cr))['spec']
+    specs = make_specs(args, base_spec, mode == 'weighted')
+    rng = random.Random(args.seed)
+    clock = FakeClock()
+
+    budget_utils._budgets.clear()
+    budget_utils._demands.clear()
+    budget_utils._allocations.clear()
+    if mode != 'none':
+        budget_utils.apply_budget_event('ADDED', {
+            'metadata': {'name': 'simulation'},
+            'spec': {'maxReplicas': args.capacity}
+        })
+
+    crs = []
+    for name, spec, kind in specs:
+        scaling_utils.forget_scaling_state(NAMESPACE, name)
+        crs.append(SimpleNamespace(
+            name=name,
+            spec=spec,
+            kind=kind,
+            apps_api=ScheduledAppsV1Api(clock, 1, args.startup),
+            arrivals=make_arrivals(args, rng, kind),
+            queue=spec['workerSpec']['queues'],
+            hostname=f"celery@{spec['common']['appName']}-celery-worker-5d8f7c9b4-x2x7q",
+            backlog=0.0,
+            processed=0.0,
+            waiting=deque(),  # [arrived at, tasks]
+            waits=[],  # (seconds waited, tasks)
+            max_wait=0.0
+        ))
+    apps_apis = [cr.apps_api for cr in crs]
+    pending_pod_seconds = 0
+    allocation_seconds = []
+
+    for second in range(args.duration):
+        clock.now = float(second)
+        for cr in crs:
+            cr.apps_api.tick()
+        pending_pod_seconds += schedule(apps_apis, args.capacity, clock.now)
+
+        for index, cr in enumerate(crs):
+            cr.backlog += cr.arrivals[second]
+            if cr.arrivals[second]:
+                cr.waiting.append([clock.now, cr.arrivals[second]])
+            done = min(cr.backlog, cr.apps_api.consuming * args.task_rate)
+            cr.backlog -= done
+            cr.processed += done
+            while done > 1e-9 and cr.waiting:
+                taken = min(done, cr.waiting[0][1])
+                cr.waiting[0][1] -= taken
+                done -= taken
+                cr.waits.append((clock.now - cr.waiting[0][0], taken))
+                if cr.waiting[0][1] <= 1e-9:
+                    cr.waiting.popleft()
+            if cr.waiting:
+                cr.max_wait = max(cr.max_wait, clock.now - cr.waiting[0][0])
+
+            # every resource's timer ticks on its own
+            if (second + index) % args.interval == 0:
+                handlers.horizontal_autoscale(
+                    cr.spec, cr.name, NAMESPACE,
+                    [{'name': cr.queue, 'messages': int(cr.backlog)}],
+                    processed_counts={cr.hostname: int(cr.processed)},
+                    apps_api_instance=cr.apps_api,
+                    now=clock.now
+                )
+
+        if mode != 'none' and second % constants.BUDGET_INTERVAL == 0:
+            started = time.perf_counter()
+            budget_utils.allocate_budgets(now=clock.now)
+            allocation_seconds.append(time.perf_counter() - started)
+
+    results = {}
+    for kind in ('high', 'low'):
+        members = [cr for cr in crs if cr.kind == kind]
+        waits = sorted(wait for cr in members for wait in cr.waits)
+        tasks = sum(count for _, count in waits)
+        mean = sum(wait * count for wait, count in waits) / tasks if tasks else 0
+        p99 = 0
+        seen = 0
+        for wait, count in waits:
+            seen += count
+            if seen >= tasks * 0.99:
+                p99 = wait
+                break
+        results[kind] = {
+            'mean_wait': round(mean, 1),
+            'p99_wait': round(p99, 1),
+            'worst_max_wait': int(max(cr.max_wait for cr in members)),
+            'left_queued': int(sum(cr.backlog for cr in members)),
+        }
+    results['cluster'] = {
+        'pending_pod_seconds': pending_pod_seconds,
+        'allocation_pass_ms': round(percentile(allocation_seconds, 50) * 1000, 3),
+    }
+    return results
+
+
+def allocation_cost(args):
+    """
+        Times one allocation pass over --passes pools of as many resources
+        @returns milliseconds
+    """
+    budget_utils._budgets.clear()
+    budget_utils._demands.clear()
+    budget_utils.apply_budget_event('ADDED', {
+        'metadata': {'name': 'cost'},
+        'spec': {'maxReplicas': args.passes * 2}
+    })
+    rng = random.Random(args.seed)
+    for index in range(args.passes):
+        budget_utils.record_demand(
+            NAMESPACE, f"cr-{index}", f"app-{index}-celery-worker",
+            rng.choice((1, 2, 4)), 1, rng.randint(1, 10), now=0
+        )
+    started = time.perf_counter()
+    budget_utils.allocate_budgets(now=0)
+    return (time.perf_counter() - started) * 1000
+
+
+def main(args):
+    print(f"{args.crs} resources({args.high} at priorityWeight {args.high_weight}), "
+          f"capacity {args.capacity} pods, storm at {args.storm_at}s for {args.storm_length}s")
+    columns = ['mean_wait', 'p99_wait', 'worst_max_wait', 'left_queued']
+    print(f"{'budget':<10}{'class':<8}" + ''.join(f"{c:>16}" for c in columns) +
+          f"{'pending_pod_s':>16}{'pass_ms':>10}")
+    for mode in MODES:
+        results = simulate(args, mode)
+        cluster = results['cluster']
+        for kind in ('high', 'low'):
+            print(f"{mode:<10}{kind:<8}" + ''.join(f"{results[kind][c]:>16}" for c in columns) +
+                  f"{cluster['pending_pod_seconds']:>16}{cluster['allocation_pass_ms']:>10}")
+    print(f"one allocation pass over {args.passes} pools: {allocation_cost(args):.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cr', default='deploy/cr.yaml', help='Celery CR the resources are made from')
+    parser.add_argument('--crs', type=int, default=100)
+    parser.add_argument('--high', type=int, default=20, help='latency critical resources')
+    parser.add_argument('--high-weight', type=float, default=4)
+    parser.add_argument('--capacity', type=int, default=300, help='worker pods the cluster fits')
+    parser.add_argument('--max-replicas', type=int, default=20)
+    parser.add_argument('--target', type=int, default=20, help='queue length per worker')
+    parser.add_argument('--duration', type=int, default=2400)
+    parser.add_argument('--storm-at', type=int, default=900)
+    parser.add_argument('--storm-length', type=int, default=300)
+    parser.add_argument('--base-rate', type=float, default=1, help='tasks/sec between bursts')
+    parser.add_argument('--burst-rate', type=float, default=8, help='tasks/sec of a burst')
+    parser.add_argument('--burst-every', type=int, default=600)
+    parser.add_argument('--burst-length', type=int, default=60)
+    parser.add_argument('--batch-size', type=int, default=6000, help='tasks of a storm batch job')
+    parser.add_argument('--task-rate', type=float, default=1.0,
+                        help='tasks/sec processed by one worker replica')
+    parser.add_argument('--startup', type=int, default=30,
+                        help='seconds for a new worker replica to become ready')
+    parser.add_argument('--interval', type=int, default=10,
+                        help='autoscaling evaluation interval in seconds')
+    parser.add_argument('--passes', type=int, default=10000,
+                        help='pools of the allocation cost measurement')
+    parser.add_argument('--seed', type=int, default=1)
+    main(parser.parse_args())
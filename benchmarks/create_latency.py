@@ -0,0 +1,106 @@
+"""
+    Benchmark: create latency per Celery CR against a stub Kubernetes API
+    server, children created one after another vs concurrently.
+
+    Usage (from the repository root):
+        python benchmarks/create_latency.py --crs 50 --latency 0.05
+"""
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+import kubernetes
+import yaml
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deployment_utils  # NOQA
+import handlers  # NOQA
+from models.worker_pool import worker_pools_from_spec  # NOQA
+
+
+def make_stub_api_server(latency):
+    async def create(request):
+        await asyncio.sleep(latency)
+        return web.json_response(await request.json(), status=201)
+
+    app = web.Application()
+    app.router.add_post('/apis/apps/v1/namespaces/{namespace}/deployments', create)
+    app.router.add_post('/api/v1/namespaces/{namespace}/services', create)
+    return app
+
+
+def start_stub_api_server(latency):
+    """
+        Serves the stub API from its own thread and loop, like a real
+        API server would be outside the operator's process
+    """
+    ports = queue.Queue()
+
+    def serve():
+        # the benchmark's own loop is already running in the main thread
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(make_stub_api_server(latency))
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        ports.put(site._server.sockets[0].getsockname()[1])
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return f"http://127.0.0.1:{ports.get(timeout=10)}"
+
+
+def create_sequentially(api, apps_api, namespace, spec, logger):
+    return (
+        *(
+            deployment_utils.deploy_celery_workers(apps_api, namespace, spec, logger, pool)
+            for pool in worker_pools_from_spec(spec)
+        ),
+        deployment_utils.deploy_flower(apps_api, namespace, spec, logger),
+        deployment_utils.expose_flower_service(api, namespace, spec, logger)
+    )
+
+
+async def main(args):
+    logger = logging.getLogger('bench')
+    # kopf.adopt needs a handler's owner, there's none outside the operator
+    deployment_utils.mark_as_child = lambda data: None
+
+    configuration = kubernetes.client.Configuration()
+    configuration.host = start_stub_api_server(args.latency)
+    api_client = kubernetes.client.ApiClient(configuration)
+    api = kubernetes.client.CoreV1Api(api_client)
+    apps_api = kubernetes.client.AppsV1Api(api_client)
+
+    with open('deploy/cr.yaml') as f:
+        spec = yaml.safe_load(f)['spec']
+
+    started = time.monotonic()
+    for _ in range(args.crs):
+        create_sequentially(api, apps_api, 'default', spec, logger)
+    sequential = (time.monotonic() - started) / args.crs
+
+    started = time.monotonic()
+    for _ in range(args.crs):
+        await handlers.create_children(api, apps_api, 'default', spec, logger)
+    concurrent = (time.monotonic() - started) / args.crs
+
+    print(f"sequential: {sequential * 1000:.1f} ms per CR")
+    print(f"concurrent: {concurrent * 1000:.1f} ms per CR")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--crs', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='stub API server latency per create in seconds')
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(main(parser.parse_args()))
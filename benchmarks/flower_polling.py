@@ -0,0 +1,90 @@
+"""
+    Benchmark: how many Celery resources can one operator poll per
+    message_queue_length interval against a local fake flower server.
+
+    Usage (from the repository root):
+        python benchmarks/flower_polling.py --crs 500 --latency 0.05 --hung 5
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import constants  # NOQA
+import flower_utils  # NOQA
+
+
+def make_fake_flower(latency):
+    async def queue_length(request):
+        await asyncio.sleep(latency)
+        return web.json_response({
+            'active_queues': [{'name': 'celery', 'messages': 42}]
+        })
+
+    app = web.Application()
+    app.router.add_get('/api/queues/length', queue_length)
+    return app
+
+
+async def start_server(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"127.0.0.1:{port}"
+
+
+async def poll_round(hosts, logger):
+    started = time.monotonic()
+    results = await asyncio.gather(*(
+        flower_utils.get_flower_queue_lengths(host, logger) for host in hosts
+    ))
+    return time.monotonic() - started, sum(r is not None for r in results)
+
+
+async def main(args):
+    logger = logging.getLogger('bench')
+    healthy_runner, healthy_host = await start_server(make_fake_flower(args.latency))
+    # a flower that never answers within the poll timeout
+    hung_runner, hung_host = await start_server(
+        make_fake_flower(constants.FLOWER_POLL_TIMEOUT * 10)
+    )
+
+    # Healthy CRs share one fake server and so one keep-alive pool. The hung
+    # flower is backed off after its first timeout and skipped in later rounds.
+    hosts = [healthy_host] * args.crs + [hung_host] * args.hung
+
+    await flower_utils.start_flower_session()
+    try:
+        for i in range(args.rounds):
+            elapsed, ok = await poll_round(hosts, logger)
+            print(
+                f"round {i + 1}: polled {len(hosts)} CRs in {elapsed:.3f}s "
+                f"({ok} ok), ~{int(len(hosts) * args.interval / elapsed)} "
+                f"CRs per {args.interval}s interval"
+            )
+    finally:
+        await flower_utils.close_flower_session()
+        await healthy_runner.cleanup()
+        await hung_runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--crs', type=int, default=500)
+    parser.add_argument('--hung', type=int, default=0,
+                        help='number of CRs whose flower never responds')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='fake flower response latency in seconds')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--interval', type=int, default=10,
+                        help='timer interval to size against')
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,237 @@
+"""
+    Load generation harness for comparing worker settings.
+
+    Starts a local redis-server(unless --broker-url is given), then for each
+    worker setting starts a celery worker of the example app as a
+    subprocess, runs the load of example/run_task.py against it and
+    reports, per task kind, enqueue-to-start latency, runtime and
+    throughput. Worker command lines are built the way the operator builds
+    them, so results carry over to workerSpec.
+
+    Needs redis-server and the example app's requirements(celery, redis,
+    flask) installed.
+
+    Usage (from the repository root):
+        python benchmarks/load_harness.py --concurrency 2,8 --pool prefork,threads \
+            --mix cpu=0.4,io=0.4,sleep=0.2 --pattern burst --rate 40 --duration 30
+        python benchmarks/load_harness.py --cr deploy/cr.yaml --mix io --rate 100
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import redis
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE = os.path.join(ROOT, 'example')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, EXAMPLE)
+
+from models.worker_pool import worker_pools_from_spec  # NOQA
+from models.worker_spec import args_list_from_spec_params  # NOQA
+
+
+QUEUE = 'load-harness'
+REPORTS = 'load-harness:reports'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_redis():
+    """
+        @returns (redis-server process, broker url)
+    """
+    if not shutil.which('redis-server'):
+        sys.exit("redis-server not found, install it or pass --broker-url")
+    port = free_port()
+    process = subprocess.Popen(
+        ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL
+    )
+    broker_url = f"redis://127.0.0.1:{port}/0"
+    client = redis.Redis.from_url(broker_url)
+    for _ in range(50):
+        try:
+            client.ping()
+            return process, broker_url
+        except redis.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    sys.exit("redis-server did not start")
+
+
+def worker_settings(args):
+    """
+        @returns [(label, worker options)] of the grid or of the CR's pools
+    """
+    if args.cr:
+        with open(args.cr) as f:
+            spec = yaml.safe_load(f)['spec']
+        return [
+            (pool.name or pool.deployment_name, {
+                'concurrency': pool.concurrency,
+                'pool': pool.pool,
+                'prefetch_multiplier': pool.prefetch_multiplier,
+                'max_tasks_per_child': pool.max_tasks_per_child,
+                'max_memory_per_child': pool.max_memory_per_child,
+                'optimization': pool.optimization
+            })
+            for pool in worker_pools_from_spec(spec)
+        ]
+    return [
+        (f"{pool}/{concurrency}", {'concurrency': int(concurrency), 'pool': pool})
+        for pool, concurrency in itertools.product(
+            args.pool.split(','), args.concurrency.split(',')
+        )
+    ]
+
+
+def start_worker(broker_url, options, worker_args, log_file):
+    """
+        @param: options - args_list_from_spec_params keyword arguments
+    """
+    command = ['celery'] + args_list_from_spec_params(
+        celery_app='app:celery_app',
+        queues=QUEUE,
+        loglevel='warning',
+        **options
+    ) + [f"--hostname=load-harness-{os.getpid()}@%h"] + worker_args
+    env = dict(os.environ, CELERY_BROKER_URL=broker_url, CELERY_RESULT_BACKEND=broker_url)
+    return subprocess.Popen(command, cwd=EXAMPLE, env=env, stdout=log_file, stderr=log_file)
+
+
+def wait_for_worker(celery_app, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if celery_app.control.ping(timeout=1):
+            return True
+    return False
+
+
+def collect_reports(client, expected, timeout):
+    """
+        Waits for the workers to report every task sent, or for the timeout
+        @returns reports so far
+    """
+    deadline = time.monotonic() + timeout
+    while client.llen(REPORTS) < expected and time.monotonic() < deadline:
+        time.sleep(0.5)
+    return [json.loads(report) for report in client.lrange(REPORTS, 0, -1)]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(reports, sent):
+    """
+        @returns task kind -> summary numbers, all kinds together under 'all'
+    """
+    summaries = {}
+    kinds = sorted({report['kind'] for report in reports})
+    for kind in kinds + ['all']:
+        selected = [report for report in reports if kind in ('all', report['kind'])]
+        latencies = [report['started_at'] - report['sent_at'] for report in selected]
+        runtimes = [report['finished_at'] - report['started_at'] for report in selected]
+        span = max(report['finished_at'] for report in selected) - \
+            min(report['sent_at'] for report in selected)
+        summaries[kind] = {
+            'sent': sum(sent.values()) if kind == 'all' else sent.get(kind, 0),
+            'done': len(selected),
+            'latency_p50': round(percentile(latencies, 50), 3),
+            'latency_p95': round(percentile(latencies, 95), 3),
+            'latency_p99': round(percentile(latencies, 99), 3),
+            'runtime_p50': round(percentile(runtimes, 50), 3),
+            'runtime_p99': round(percentile(runtimes, 99), 3),
+            'tasks_per_sec': round(len(selected) / span, 1) if span > 0 else 0,
+        }
+    return summaries
+
+
+def run_setting(args, broker_url, options, log_file):
+    from app import celery_app
+    import run_task
+
+    client = redis.Redis.from_url(broker_url)
+    client.flushdb()
+    worker = start_worker(broker_url, options, args.worker_args.split(), log_file)
+    try:
+        if not wait_for_worker(celery_app):
+            raise RuntimeError(f"worker did not start, see {log_file.name}")
+        sent = run_task.send_load(args, report_to=REPORTS, queue=QUEUE, seed=args.seed)
+        # add tasks don't report their timings
+        expected = sum(count for kind, count in sent.items() if kind != 'add')
+        reports = collect_reports(client, expected, args.drain_timeout)
+    finally:
+        worker.terminate()
+        try:
+            worker.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+    return summarize(reports, sent) if reports else {}
+
+
+def main(args, broker_url):
+    results = {}
+    with tempfile.NamedTemporaryFile('w', prefix='load-harness-', suffix='.log',
+                                     delete=False) as log_file:
+        for label, options in worker_settings(args):
+            results[label] = run_setting(args, broker_url, options, log_file)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    columns = ['sent', 'done', 'latency_p50', 'latency_p95', 'latency_p99',
+               'runtime_p50', 'runtime_p99', 'tasks_per_sec']
+    print(f"{'setting':<20}{'kind':<8}" + ''.join(f"{c:>14}" for c in columns))
+    for label, summaries in results.items():
+        for kind, summary in summaries.items():
+            print(f"{label:<20}{kind:<8}" + ''.join(f"{summary[c]:>14}" for c in columns))
+
+
+if __name__ == '__main__':
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument('--broker-url')
+    broker_url = pre_parser.parse_known_args()[0].broker_url
+    redis_server = None
+    if not broker_url:
+        redis_server, broker_url = start_redis()
+    # the example app reads its broker when first imported
+    os.environ['CELERY_BROKER_URL'] = os.environ['CELERY_RESULT_BACKEND'] = broker_url
+    import run_task
+
+    parser = argparse.ArgumentParser()
+    run_task.add_load_arguments(parser)
+    parser.set_defaults(mix='cpu=0.4,io=0.4,sleep=0.2', rate=20, duration=30)
+    parser.add_argument('--broker-url', help='use a running redis instead of starting one')
+    parser.add_argument('--concurrency', default='1,4', help='worker concurrencies to compare')
+    parser.add_argument('--pool', default='prefork',
+                        help='worker pools to compare, e.g. prefork,threads,solo')
+    parser.add_argument('--cr', help='compare the worker pools of a Celery CR instead')
+    parser.add_argument('--worker-args', default='',
+                        help='extra worker arguments, e.g. "--prefetch-multiplier=1"')
+    parser.add_argument('--drain-timeout', type=float, default=120,
+                        help='seconds to wait for the backlog after the load')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true')
+    try:
+        main(parser.parse_args(), broker_url)
+    finally:
+        if redis_server:
+            redis_server.terminate()
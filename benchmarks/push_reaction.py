@@ -0,0 +1,92 @@
+"""
+    Benchmark: scale-up reaction time against a local redis-server, push
+    notifications vs adaptive polling.
+
+    Needs a redis-server on localhost(or --broker-url). Keyspace list
+    notifications are enabled on it for the run.
+
+    Usage (from the repository root):
+        python benchmarks/push_reaction.py --pushes 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import constants  # NOQA
+import polling_utils  # NOQA
+from broker_utils import listen_for_queue_pushes  # NOQA
+
+
+class Stopped:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def __bool__(self):
+        return self.event.is_set()
+
+
+def wait_for_due_poll(namespace, name, timeout):
+    """
+        Emulates the timer, which checks for due polls every base interval
+    """
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        if polling_utils.is_poll_due(namespace, name):
+            return time.monotonic()
+        time.sleep(constants.POLL_BASE_INTERVAL)
+    return None
+
+
+def main(args):
+    client = redis.Redis.from_url(args.broker_url)
+    client.config_set('notify-keyspace-events', 'Kl')
+    spec = {'polling': {'maxIntervalSeconds': args.max_interval}}
+
+    # let adaptive polling relax to its maximum interval on an idle queue
+    polling_utils.schedule_next_poll('bench', 'push', spec, 0)
+    polling_utils.get_polling_state('bench', 'push').interval = args.max_interval
+
+    pushed = threading.Event()
+    stopped = Stopped()
+    listener = threading.Thread(target=listen_for_queue_pushes, args=(
+        args.broker_url, [args.queue], pushed.set, stopped
+    ), daemon=True)
+    listener.start()
+    time.sleep(0.5)  # subscribed
+
+    push_latencies, poll_latencies = [], []
+    try:
+        for _ in range(args.pushes):
+            polling_utils.schedule_next_poll('bench', 'push', spec, 0)
+            pushed.clear()
+            started = time.monotonic()
+            client.lpush(args.queue, 'message')
+            if pushed.wait(timeout=5):
+                push_latencies.append(time.monotonic() - started)
+                polling_utils.request_poll('bench', 'push')
+            due_at = wait_for_due_poll('bench', 'push', args.max_interval * 2)
+            if due_at:
+                poll_latencies.append(due_at - started)
+    finally:
+        stopped.event.set()
+        client.delete(args.queue)
+
+    print(f"push notification: median {statistics.median(push_latencies) * 1000:.1f} ms")
+    print(f"scaling evaluation due: median {statistics.median(poll_latencies):.2f} s "
+          f"(polling alone would wait up to {args.max_interval}s)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--broker-url', default='redis://localhost:6379/0')
+    parser.add_argument('--queue', default='push-reaction-bench')
+    parser.add_argument('--pushes', type=int, default=20)
+    parser.add_argument('--max-interval', type=int, default=constants.POLL_MAX_INTERVAL)
+    main(parser.parse_args())
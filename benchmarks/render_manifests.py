@@ -0,0 +1,187 @@
+"""
+    Micro-benchmark: cost of rendering the child manifests of one Celery CR.
+    Also checks that the create and update paths send the same manifests,
+    that children we applied don't count as drifted when their watch event
+    arrives, and, with celery installed, that `celery worker` accepts the
+    rendered worker arguments.
+
+    Usage (from the repository root):
+        python benchmarks/render_manifests.py --crs 10000
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache_utils  # NOQA
+import constants  # NOQA
+import deployment_utils  # NOQA
+import update_utils  # NOQA
+from k8s_utils import get_api_client  # NOQA
+from models.worker_pool import worker_pools_from_spec  # NOQA
+
+
+class RecordingApi:
+    """
+        Records bodies sent by the create and update paths
+    """
+
+    def __init__(self):
+        self.created = {}
+        self.patched = {}
+
+    def _create(self, namespace, body):
+        self.created[body['metadata']['name'], body['kind']] = body
+        return self._obj(body['kind'], body)
+
+    def _patch(self, kind):
+        def patch(name, namespace, body):
+            self.patched[name, kind] = body
+            # the API server answers with the whole object
+            return self._obj(kind, self.created.get((name, kind)) or {'metadata': {'name': name}})
+        return patch
+
+    @staticmethod
+    def _obj(kind, body):
+        """
+            @returns the kubernetes client model the API server would answer with
+        """
+        response = SimpleNamespace(data=json.dumps(dict(body, kind=kind)))
+        return get_api_client().deserialize(response, f"V1{kind}")
+
+    def __getattr__(self, attr):
+        if attr.startswith('create_namespaced_'):
+            return self._create
+        if attr.startswith('read_namespaced_'):
+            kind = constants.SERVICE_KIND if attr.endswith('service') else constants.DEPLOYMENT_KIND
+            return lambda name, namespace: self._obj(
+                kind, {'metadata': {'name': name}, 'spec': {'replicas': 1}}
+            )
+        if attr == 'patch_namespaced_deployment':
+            return self._patch(constants.DEPLOYMENT_KIND)
+        if attr == 'patch_namespaced_service':
+            return self._patch(constants.SERVICE_KIND)
+        raise AttributeError(attr)
+
+
+def check_create_and_update_match(spec):
+    api = RecordingApi()
+    logger = logging.getLogger('bench')
+    pools = worker_pools_from_spec(spec)
+    for pool in pools:
+        deployment_utils.deploy_celery_workers(api, 'default', spec, logger, pool)
+    deployment_utils.deploy_flower(api, 'default', spec, logger)
+    deployment_utils.expose_flower_service(api, 'default', spec, logger)
+
+    # no recorded hashes, so every child gets patched
+    workers = {pool.deployment_name: pool.name for pool in pools}
+    children = [
+        {
+            'name': name,
+            'kind': kind,
+            'type': constants.WORKER_TYPE if name in workers else constants.FLOWER_TYPE,
+            'pool': workers.get(name)
+        }
+        for name, kind in api.created
+    ]
+    status = {'create_fn': {'children': children}}
+    spec = dict(spec, scaleTargetRef=[])  # keep replicas in the worker patch
+    update_utils.update_all_deployments(api, api, spec, status, 'default', logger)
+
+    for key, created in api.created.items():
+        expected = update_utils.patch_body_from_manifest(created)
+        assert api.patched[key] == expected, f"create and update differ for {key}"
+    print(f"create and update paths render identical manifests for {len(api.created)} children")
+
+
+def check_applied_children_not_drifted(spec):
+    """
+        A child cached from our own apply and then from its watch event must
+        fingerprint the same, or every watch event costs a drift correction
+    """
+    spec = copy.deepcopy(spec)
+    api = RecordingApi()
+    logger = logging.getLogger('bench')
+    # only children of a Celery resource are cached
+    deployment_utils.mark_as_child = lambda data: data['metadata'].update(ownerReferences=[{
+        'apiVersion': f"{constants.OWNER_GROUP}/v1alpha1", 'kind': constants.OWNER_KIND,
+        'name': 'bench', 'uid': 'bench'
+    }])
+    for mode in ('ping', constants.WORKER_PROBE_FILES):
+        spec['workerSpec']['probes'] = {'enabled': True, 'mode': mode}
+        for pool in worker_pools_from_spec(spec):
+            deployment = deployment_utils.deploy_celery_workers(api, 'default', spec, logger, pool)
+            body = get_api_client().sanitize_for_serialization(deployment)
+            # what the watch delivers for it, plain JSON
+            entry = cache_utils.apply_watch_event(
+                constants.DEPLOYMENT_KIND, 'MODIFIED', json.loads(json.dumps(body))
+            )
+            rendered = deployment_utils.render_worker_deployment('default', spec, pool)
+            assert not cache_utils.has_drifted(entry, deployment_utils.get_manifest_hash(rendered)), \
+                f"{pool.deployment_name} drifted right after it was applied"
+    deployment_utils.mark_as_child = lambda data: None
+    print("children applied with probes don't count as drifted")
+
+
+def check_worker_args_parse(spec):
+    """
+        Parses the worker container's arguments the way `celery worker`
+        does, with every worker option of the CR set
+    """
+    try:
+        from celery import Celery
+        from celery.bin.base import CLIContext
+        from celery.bin.worker import worker
+    except ImportError:
+        print("celery not installed, worker arguments not checked")
+        return
+
+    spec = copy.deepcopy(spec)
+    spec['workerSpec'].update(
+        pool='prefork', prefetchMultiplier=2, maxTasksPerChild=100,
+        maxMemoryPerChild=200000, optimization='fair'
+    )
+    for pool in worker_pools_from_spec(spec):
+        data = deployment_utils.render_worker_deployment('default', spec, pool)
+        args = data['spec']['template']['spec']['containers'][0]['args']
+        # --app belongs to the celery command, the rest to its worker command
+        context = CLIContext(app=Celery(), no_color=True, workdir=None, quiet=True)
+        params = worker.make_context(
+            'worker', args[args.index('worker') + 1:], obj=context
+        ).params
+        assert params['optimization'] == 'fair', params
+    print("celery worker accepts the rendered worker arguments")
+
+
+def main(args):
+    with open('deploy/cr.yaml') as f:
+        spec = yaml.safe_load(f)['spec']
+    # kopf.adopt needs a handler's owner, there's none outside the operator
+    deployment_utils.mark_as_child = lambda data: None
+
+    check_create_and_update_match(spec)
+    check_applied_children_not_drifted(spec)
+    check_worker_args_parse(spec)
+
+    started = time.perf_counter()
+    for _ in range(args.crs):
+        for pool in worker_pools_from_spec(spec):
+            deployment_utils.render_worker_deployment('default', spec, pool)
+        deployment_utils.render_flower_deployment('default', spec)
+        deployment_utils.render_flower_service('default', spec)
+    elapsed = time.perf_counter() - started
+    print(f"rendered {args.crs} CRs in {elapsed:.3f}s, {elapsed / args.crs * 1e6:.1f} us per CR")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--crs', type=int, default=10000)
+    main(parser.parse_args())
@@ -0,0 +1,260 @@
+"""
+    Load test of a sharded operator.
+
+    Runs several operator replicas against an in-memory Lease API and a few
+    thousand fake Celery CRs, with a fake clock. Each replica renews its
+    leases through the real sharding_utils code and evaluates the CRs of its
+    shards through the real horizontal_autoscale. Queue bursts hit random
+    CRs; one replica crashes mid-run and its shards move to the others.
+
+    Reports shards and CRs per replica, measured evaluations/sec per replica,
+    the time to rebalance after the crash, whether a shard was ever owned by
+    two replicas at once, and the end-to-end scaling latency(burst to scale
+    up patch) before and during the handover.
+
+    Usage (from the repository root):
+        python benchmarks/shard_load.py --crs 3000 --replicas 4 --shards 32
+"""
+import argparse
+import copy
+import datetime
+import logging
+import math
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kubernetes.client.rest import ApiException  # NOQA
+
+import handlers  # NOQA
+import scaling_utils  # NOQA
+import sharding_utils  # NOQA
+
+
+EPOCH = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FakeLeaseApi:
+    """
+        Implements the CoordinationV1Api calls made by sharding_utils, with
+        resourceVersion conflicts like the API server
+    """
+
+    def __init__(self):
+        self.leases = {}
+        self.version = 0
+        self.writes = 0
+
+    def _store(self, body):
+        self.version += 1
+        self.writes += 1
+        spec = body['spec']
+        self.leases[body['metadata']['name']] = SimpleNamespace(
+            metadata=SimpleNamespace(
+                name=body['metadata']['name'],
+                labels=dict(body['metadata']['labels']),
+                annotations=dict(body['metadata'].get('annotations') or {}),
+                resource_version=str(self.version)
+            ),
+            spec=SimpleNamespace(
+                holder_identity=spec['holderIdentity'],
+                lease_duration_seconds=spec['leaseDurationSeconds'],
+                renew_time=datetime.datetime.strptime(
+                    spec['renewTime'], '%Y-%m-%dT%H:%M:%S.%fZ'
+                ).replace(tzinfo=datetime.timezone.utc)
+            )
+        )
+
+    def list_namespaced_lease(self, namespace, label_selector=None, **kwargs):
+        return SimpleNamespace(items=[copy.deepcopy(lease) for lease in self.leases.values()])
+
+    def read_namespaced_lease(self, name, namespace, **kwargs):
+        return copy.deepcopy(self.leases[name])
+
+    def create_namespaced_lease(self, namespace, body, **kwargs):
+        if body['metadata']['name'] in self.leases:
+            raise ApiException(status=409, reason='Conflict')
+        self._store(body)
+
+    def replace_namespaced_lease(self, name, namespace, body, **kwargs):
+        current = self.leases.get(name)
+        if current is None or current.metadata.resource_version != body['metadata'].get('resourceVersion'):
+            raise ApiException(status=409, reason='Conflict')
+        self._store(body)
+
+
+class FakeAppsV1Api:
+    """
+        Deployment scale of one fake CR's worker pool
+    """
+
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.scaled_up_at = None
+
+    def read_namespaced_deployment_scale(self, name, namespace, **kwargs):
+        return SimpleNamespace(spec=SimpleNamespace(replicas=self.replicas))
+
+    def read_namespaced_deployment_status(self, name, namespace, **kwargs):
+        # pods are ready as soon as they're scaled
+        return SimpleNamespace(status=SimpleNamespace(ready_replicas=self.replicas))
+
+    def patch_namespaced_deployment(self, name, namespace, body, **kwargs):
+        self.replicas = body['spec']['replicas']
+        return SimpleNamespace(
+            metadata=SimpleNamespace(name=name),
+            spec=SimpleNamespace(replicas=self.replicas)
+        )
+
+
+class Replica:
+    def __init__(self, index, shards, lease_api, logger):
+        self.ownership = sharding_utils.ShardOwnership(
+            identity=f"operator-{index}", shard_count=shards, namespace='default'
+        )
+        self.lease_api = lease_api
+        self.logger = logger
+        self.alive = True
+        # renew rounds of the replicas don't line up
+        self.phase = index
+        self.evaluations = 0
+        self.cpu_seconds = 0.0
+
+    def sync(self, second):
+        if self.alive and (second - self.phase) % sharding_utils.constants.LEASE_RENEW_INTERVAL == 0:
+            now = EPOCH + datetime.timedelta(seconds=second)
+            sharding_utils.sync_leases(self.lease_api, self.ownership, self.logger, now=now)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(args):
+    random.seed(args.seed)
+    logger = logging.getLogger('shard_load')
+    logger.setLevel(logging.WARNING)
+    with open(args.cr) as f:
+        spec = yaml.safe_load(f)['spec']
+    queue_name = spec['workerSpec']['queues']
+    scale_target = spec['scaleTargetRef'][0]
+    target = scale_target['metrics'][0]['target']['averageValue']
+    # replicas a burst has to be scaled up to
+    wanted = min(math.ceil(args.burst_factor), scale_target['maxReplicas'])
+
+    lease_api = FakeLeaseApi()
+    replicas = [Replica(i, args.shards, lease_api, logger) for i in range(args.replicas)]
+    crs = [
+        SimpleNamespace(
+            namespace=f"ns-{i % 50}", name=f"celery-{i}",
+            phase=random.randrange(args.interval),
+            apps_api=FakeAppsV1Api(spec['workerSpec']['numOfWorkers']),
+            queue_length=0, burst_at=None, owner=None
+        )
+        for i in range(args.crs)
+    ]
+    for cr in crs:
+        cr.shard = sharding_utils.shard_of(cr.namespace, cr.name, args.shards)
+        scaling_utils.forget_scaling_state(cr.namespace, cr.name)
+
+    bursts = {}
+    for _ in range(args.bursts):
+        bursts.setdefault(random.randrange(10, args.duration - 30), []).append(random.choice(crs))
+
+    latencies = {'steady': [], 'handover': []}
+    double_owned = 0
+    unowned_since = rebalanced_after = None
+
+    for second in range(args.duration):
+        if second == args.kill_at:
+            # crash, the lease isn't released
+            replicas[0].alive = False
+            replicas[0].ownership.owned = frozenset()
+        for replica in replicas:
+            replica.sync(second)
+
+        owners = {}
+        for replica in replicas:
+            for shard in replica.ownership.owned:
+                if shard in owners:
+                    double_owned += 1
+                owners[shard] = replica
+        if second >= args.kill_at:
+            if len(owners) < args.shards and unowned_since is None:
+                unowned_since = second
+            elif len(owners) == args.shards and unowned_since is not None and rebalanced_after is None:
+                rebalanced_after = second - args.kill_at
+
+        for cr in bursts.get(second, []):
+            if cr.burst_at is None:
+                cr.burst_at = second
+                cr.queue_length = int(target * args.burst_factor)
+
+        now = EPOCH + datetime.timedelta(seconds=second)
+        for cr in crs:
+            owner = owners.get(cr.shard)
+            if owner is not cr.owner:
+                # a new owner starts from fresh in-memory state
+                scaling_utils.forget_scaling_state(cr.namespace, cr.name)
+                cr.owner = owner
+            if owner is None or (second - cr.phase) % args.interval:
+                continue
+
+            started = time.perf_counter()
+            handlers.horizontal_autoscale(
+                spec, cr.name, cr.namespace,
+                [{'name': queue_name, 'messages': cr.queue_length}],
+                apps_api_instance=cr.apps_api, now=now.timestamp()
+            )
+            owner.cpu_seconds += time.perf_counter() - started
+            owner.evaluations += 1
+
+            if cr.burst_at is not None and cr.apps_api.replicas >= wanted:
+                window = 'handover' if args.kill_at <= cr.burst_at < args.kill_at + 2 * sharding_utils.constants.LEASE_DURATION else 'steady'
+                latencies[window].append(second - cr.burst_at)
+                cr.burst_at = None
+                cr.queue_length = 0
+
+    crs_by_replica = {}
+    for cr in crs:
+        if cr.owner is not None:
+            crs_by_replica[cr.owner.ownership.identity] = crs_by_replica.get(cr.owner.ownership.identity, 0) + 1
+
+    print(f"{args.crs} CRs, {args.shards} shards, {args.replicas} replicas, "
+          f"{args.duration}s simulated, replica 0 crashed at {args.kill_at}s")
+    print(f"{'replica':<12}{'alive':>8}{'shards':>8}{'crs':>8}{'evaluations':>14}{'evals/sec':>12}")
+    for replica in replicas:
+        identity = replica.ownership.identity
+        rate = replica.evaluations / replica.cpu_seconds if replica.cpu_seconds else 0
+        print(f"{identity:<12}{str(replica.alive):>8}{len(replica.ownership.owned):>8}"
+              f"{crs_by_replica.get(identity, 0):>8}{replica.evaluations:>14}{rate:>12.0f}")
+    print(f"lease writes: {lease_api.writes}, shard owned twice: {double_owned} times, "
+          f"rebalanced {rebalanced_after}s after the crash")
+    for window, values in latencies.items():
+        print(f"scaling latency {window:<9} n={len(values):<5} p50={percentile(values, 50)}s "
+              f"p99={percentile(values, 99)}s max={max(values, default=0)}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cr', default='deploy/cr.yaml', help='Celery CR every fake CR is a copy of')
+    parser.add_argument('--crs', type=int, default=2000)
+    parser.add_argument('--replicas', type=int, default=4)
+    parser.add_argument('--shards', type=int, default=32)
+    parser.add_argument('--duration', type=int, default=180, help='simulated seconds')
+    parser.add_argument('--kill-at', type=int, default=60, help='second replica 0 crashes at')
+    parser.add_argument('--interval', type=int, default=5, help='seconds between evaluations of a CR')
+    parser.add_argument('--bursts', type=int, default=1000)
+    parser.add_argument('--burst-factor', type=float, default=4,
+                        help='burst queue length in multiples of the target averageValue')
+    parser.add_argument('--seed', type=int, default=1)
+    run(parser.parse_args())
@@ -0,0 +1,155 @@
+"""
+    Benchmark of the task event statistics.
+
+    Feeds a synthetic Celery event stream through task_event_utils: tasks of
+    --task-names names(zipf distributed, more than the tracked limit) are
+    received, started and finished on --workers workers with lognormal
+    runtimes, and a fraction of them is lost(never finishes), so every
+    bound is exercised.
+
+    Reports events/sec folded into the stats, also with JSON decoding of
+    every event like kombu does before the handler sees it, memory held by
+    the stats as the stream goes on, and the error of the runtime
+    quantiles against exact ones.
+
+    Usage (from the repository root):
+        python benchmarks/task_events.py --events 1000000 --rate 50000
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import constants  # NOQA
+import task_event_utils  # NOQA
+
+
+def event_stream(args, rng, runtimes):
+    """
+        Endless event stream, one task yields received, started and
+        succeeded/failed events
+        @param: runtimes - collects the runtimes of task_1
+    """
+    for task_index in itertools.count():
+        rank = min(int(rng.paretovariate(1.0)), args.task_names)
+        task_name = f"tasks.task_{rank}"
+        uuid = f"{task_index:032x}"
+        hostname = f"celery@worker-{task_index % args.workers}"
+        received_at = task_index * 3 / args.rate
+        wait = rng.expovariate(1 / 0.5)
+        runtime = rng.lognormvariate(math.log(0.05 * rank), 1.0)
+        if rank == 1 and runtimes is not None:
+            runtimes.append(runtime)
+        yield {'type': 'task-received', 'uuid': uuid, 'name': task_name,
+               'hostname': hostname, 'timestamp': received_at,
+               'local_received': received_at}
+        if rng.random() < args.lost:
+            continue
+        started_at = received_at + wait
+        yield {'type': 'task-started', 'uuid': uuid, 'hostname': hostname,
+               'timestamp': started_at, 'local_received': started_at}
+        finished_at = started_at + runtime
+        if rng.random() < args.failures:
+            yield {'type': 'task-failed', 'uuid': uuid, 'hostname': hostname,
+                   'timestamp': finished_at, 'local_received': finished_at}
+        else:
+            yield {'type': 'task-succeeded', 'uuid': uuid, 'hostname': hostname,
+                   'runtime': runtime, 'timestamp': finished_at,
+                   'local_received': finished_at}
+
+
+def fold(stats, events, decode):
+    started = time.perf_counter()
+    if decode:
+        for payload in events:
+            task_event_utils.handle_task_event(stats, json.loads(payload))
+    else:
+        for event in events:
+            task_event_utils.handle_task_event(stats, event)
+    return time.perf_counter() - started
+
+
+def throughput(args, decode):
+    stream = event_stream(args, random.Random(args.seed), None)
+    stats = task_event_utils.TaskEventStats()
+    elapsed = folded = 0
+    while folded < args.events:
+        events = list(itertools.islice(stream, min(args.chunk, args.events - folded)))
+        if decode:
+            events = [json.dumps(event) for event in events]
+        elapsed += fold(stats, events, decode)
+        folded += len(events)
+    return folded / elapsed
+
+
+def memory(args):
+    """
+        @returns [(events folded, bytes held by the stats)], runtimes of
+        task_1 and the stats
+    """
+    runtimes = []
+    stream = event_stream(args, random.Random(args.seed), runtimes)
+    stats = task_event_utils.TaskEventStats()
+    samples = []
+    checkpoints = {int(args.events * fraction) for fraction in (0.1, 0.25, 0.5, 0.75, 1.0)}
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    folded = 0
+    while folded < args.events:
+        events = list(itertools.islice(stream, min(args.chunk, args.events - folded)))
+        fold(stats, events, False)
+        folded += len(events)
+        del events
+        if any(folded >= checkpoint for checkpoint in checkpoints):
+            checkpoints = {checkpoint for checkpoint in checkpoints if checkpoint > folded}
+            # runtimes of task_1 are kept for the accuracy check only
+            samples.append((folded, tracemalloc.get_traced_memory()[0] - baseline
+                            - sys.getsizeof(runtimes) - 24 * len(runtimes)))
+    tracemalloc.stop()
+    return samples, runtimes, stats
+
+
+def run(args):
+    print(f"{args.events} events at {args.rate}/s simulated, {args.task_names} task names "
+          f"(tracking {constants.TASK_EVENTS_MAX_TASK_NAMES}), {args.workers} workers, "
+          f"{args.lost:.0%} lost tasks")
+    print(f"folded:              {throughput(args, False):>12,.0f} events/sec")
+    print(f"json decoded+folded: {throughput(args, True):>12,.0f} events/sec")
+
+    samples, runtimes, stats = memory(args)
+    for folded, held in samples:
+        print(f"memory after {folded:>10,} events: {held / 2 ** 20:8.1f} MiB")
+    print(f"tracked task names: {len(stats.tasks)}, tasks in flight: {len(stats.pending)}, "
+          f"workers: {len(stats.processed)}")
+
+    # the sketch window rotates, compare with runtimes finished in its span
+    summary = task_event_utils.summarize_task_stats(stats, args.events / args.rate)
+    task = stats.tasks['tasks.task_1']
+    window = task.runtime.current.total + task.runtime.previous.total
+    recent = sorted(runtimes[-window:]) if window else runtimes
+    for quantile in ('50', '95', '99'):
+        exact = recent[min(len(recent) - 1, math.ceil(len(recent) * int(quantile) / 100) - 1)]
+        sketched = summary['tasks.task_1'][f"runtime_p{quantile}"]
+        print(f"task_1 runtime p{quantile}: sketch {sketched:.4f}s exact {exact:.4f}s "
+              f"error {abs(sketched - exact) / exact:.1%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--rate', type=int, default=50000, help='simulated events/sec')
+    parser.add_argument('--task-names', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=200)
+    parser.add_argument('--lost', type=float, default=0.05,
+                        help='fraction of received tasks that never finish')
+    parser.add_argument('--failures', type=float, default=0.02)
+    parser.add_argument('--chunk', type=int, default=100000, help='events generated at a time')
+    parser.add_argument('--seed', type=int, default=1)
+    run(parser.parse_args())
@@ -0,0 +1,261 @@
+import json
+import time
+import asyncio
+from abc import ABC, abstractmethod
+from urllib.parse import urlparse
+
+import constants
+from k8s_utils import (
+    run_in_thread
+)
+from metrics_utils import (
+    POLL_ERRORS
+)
+from models.worker_pool import (
+    worker_pools_from_spec
+)
+
+
+def queue_names_from_spec(spec):
+    """
+        @returns list of queue names consumed by any worker pool
+    """
+    queue_names = []
+    for pool in worker_pools_from_spec(spec):
+        queue_names.extend(
+            queue for queue in pool.queue_names if queue not in queue_names
+        )
+    return queue_names
+
+
+class QueueMetricsBackend(ABC):
+    """
+        Reads queue depth straight from the broker.
+        queue_lengths returns the same shape flower's /api/queues/length
+        does i.e. [{'name': .., 'messages': ..}] so callers can fall back
+        to flower transparently.
+    """
+
+    def __init__(self, broker_url):
+        self.broker_url = broker_url
+
+    @abstractmethod
+    def queue_lengths(self, queues):
+        pass
+
+    def oldest_message_ages(self, queues, now):
+        """
+            @param: now - unix time
+            @returns queue name -> seconds the oldest message has waited,
+            for queues whose oldest message carries a timestamp property
+        """
+        return {}
+
+    def close(self):
+        pass
+
+
+class RedisQueueMetrics(QueueMetricsBackend):
+
+    def __init__(self, broker_url):
+        import redis
+
+        super().__init__(broker_url)
+        self.client = redis.Redis.from_url(
+            broker_url,
+            socket_timeout=constants.BROKER_PROBE_TIMEOUT,
+            socket_connect_timeout=constants.BROKER_PROBE_TIMEOUT,
+            max_connections=constants.BROKER_POOL_SIZE
+        )
+
+    @staticmethod
+    def priority_keys(queue):
+        for priority in constants.REDIS_PRIORITY_STEPS:
+            if priority:
+                yield f"{queue}{constants.REDIS_PRIORITY_SEP}{priority}"
+            else:
+                yield queue
+
+    def queue_lengths(self, queues):
+        # All LLENs go out in a single round trip
+        pipe = self.client.pipeline(transaction=False)
+        for queue in queues:
+            for key in self.priority_keys(queue):
+                pipe.llen(key)
+        lengths = iter(pipe.execute())
+
+        steps = len(constants.REDIS_PRIORITY_STEPS)
+        return [
+            {'name': queue, 'messages': sum(next(lengths) for _ in range(steps))}
+            for queue in queues
+        ]
+
+    @staticmethod
+    def message_timestamp(payload):
+        """
+            @returns unix time the message was published at or None if it
+            wasn't stamped, or the list is empty
+        """
+        try:
+            timestamp = json.loads(payload)['properties'].get('timestamp')
+            return float(timestamp) if timestamp is not None else None
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return None
+
+    def oldest_message_ages(self, queues, now):
+        # kombu pushes to the head and workers pop from the tail, so the
+        # oldest message of every priority list is its last element
+        pipe = self.client.pipeline(transaction=False)
+        for queue in queues:
+            for key in self.priority_keys(queue):
+                pipe.lindex(key, -1)
+        payloads = iter(pipe.execute())
+
+        ages = {}
+        for queue in queues:
+            timestamps = [
+                timestamp for timestamp in (
+                    self.message_timestamp(next(payloads))
+                    for _ in constants.REDIS_PRIORITY_STEPS
+                ) if timestamp is not None
+            ]
+            if timestamps:
+                ages[queue] = max(now - min(timestamps), 0)
+        return ages
+
+    def close(self):
+        self.client.connection_pool.disconnect()
+
+
+class AmqpQueueMetrics(QueueMetricsBackend):
+
+    def __init__(self, broker_url):
+        from kombu import Connection
+        from kombu.pools import connections
+
+        super().__init__(broker_url)
+        self.pool = connections[Connection(broker_url)]
+        self.pool.limit = constants.BROKER_POOL_SIZE
+
+    def queue_lengths(self, queues):
+        result = []
+        with self.pool.acquire(
+            block=True, timeout=constants.BROKER_PROBE_TIMEOUT
+        ) as conn:
+            channel = conn.channel()
+            try:
+                for queue in queues:
+                    try:
+                        declared = channel.queue_declare(queue=queue, passive=True)
+                        messages = declared.message_count
+                    except conn.channel_errors:
+                        # Queue not declared yet, broker closed the channel
+                        messages = 0
+                        channel = conn.channel()
+                    result.append({'name': queue, 'messages': messages})
+            finally:
+                channel.close()
+        return result
+
+    def close(self):
+        self.pool.force_close_all()
+
+
+BACKENDS = {
+    'redis': RedisQueueMetrics,
+    'rediss': RedisQueueMetrics,
+    'amqp': AmqpQueueMetrics,
+    'amqps': AmqpQueueMetrics,
+    'pyamqp': AmqpQueueMetrics,
+}
+
+# broker url -> backend, so connection pools are shared across CRs
+_backends = {}
+
+
+def get_queue_metrics_backend(broker_url):
+    backend = _backends.get(broker_url)
+    if backend is None:
+        scheme = urlparse(broker_url).scheme
+        backend_cls = BACKENDS.get(scheme)
+        if backend_cls is None:
+            raise ValueError(f"Unsupported broker scheme for queue metrics: {scheme}")
+        backend = _backends[broker_url] = backend_cls(broker_url)
+    return backend
+
+
+def close_queue_metrics_backends():
+    for backend in _backends.values():
+        backend.close()
+    _backends.clear()
+
+
+async def get_broker_queue_lengths(broker_url, queues, logger=None):
+    """
+        Probes queue depth on the broker without blocking the event loop
+        @returns [{'name': .., 'messages': ..}] or None if broker is unavailable
+    """
+    try:
+        backend = get_queue_metrics_backend(broker_url)
+        return await asyncio.wait_for(
+            run_in_thread(backend.queue_lengths, queues),
+            timeout=constants.BROKER_PROBE_TIMEOUT * 2
+        )
+    except Exception as e:
+        POLL_ERRORS.labels('broker').inc()
+        if logger:
+            logger.warning("Broker queue probe failed: %r", e)
+        return None
+
+
+async def get_broker_message_ages(broker_url, queues, logger=None):
+    """
+        Probes how long the oldest message of each queue has waited. Only
+        redis brokers can peek at queued messages, and only messages
+        published with a `timestamp` property tell their age
+        @returns queue name -> seconds or None if broker is unavailable
+    """
+    try:
+        backend = get_queue_metrics_backend(broker_url)
+        return await asyncio.wait_for(
+            run_in_thread(backend.oldest_message_ages, queues, time.time()),
+            timeout=constants.BROKER_PROBE_TIMEOUT * 2
+        )
+    except Exception as e:
+        POLL_ERRORS.labels('broker').inc()
+        if logger:
+            logger.warning("Broker message age probe failed: %r", e)
+        return None
+
+
+def listen_for_queue_pushes(broker_url, queues, on_push, stopped,
+                            logger=None, keep_listening=None):
+    """
+        Blocks until `stopped` or keep_listening() turns false, calling
+        on_push whenever a message is pushed to one of the queues. Uses Redis
+        keyspace notifications, which need `notify-keyspace-events` to
+        include `Kl` on the broker
+    """
+    import redis
+
+    if urlparse(broker_url).scheme not in ('redis', 'rediss'):
+        raise ValueError("Push notifications are only supported for redis brokers")
+
+    client = redis.Redis.from_url(
+        broker_url, socket_connect_timeout=constants.BROKER_PROBE_TIMEOUT
+    )
+    db = client.connection_pool.connection_kwargs.get('db', 0)
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    # queue* also matches kombu's priority lists of the queue
+    pubsub.psubscribe(*(f"__keyspace@{db}__:{queue}*" for queue in queues))
+    if logger:
+        logger.info("Listening for pushes to queues: %s", ', '.join(queues))
+
+    try:
+        while not stopped and (keep_listening is None or keep_listening()):
+            message = pubsub.get_message(timeout=1.0)
+            if message and message.get('data') in (b'lpush', b'rpush'):
+                on_push()
+    finally:
+        pubsub.close()
+        client.connection_pool.disconnect()
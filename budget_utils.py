@@ -0,0 +1,407 @@
+import json
+import time
+import threading
+from dataclasses import dataclass, field
+from math import floor
+from typing import Dict, FrozenSet, Optional, Tuple
+
+import constants
+
+
+@dataclass
+class ReplicaBudget:
+    """
+        A CeleryReplicaBudget: at most `max_replicas` autoscaled worker
+        replicas across the Celery resources of its namespaces
+    """
+    name: str
+    max_replicas: int
+    namespaces: FrozenSet[str]  # empty for every namespace
+    # (namespace, name) -> replicas of a Celery resource, allocated by the
+    # replica holding BUDGET_ALLOCATOR_SHARD of a sharded operator
+    celery_shares: Dict[Tuple[str, str], int] = field(default_factory=dict)
+
+
+@dataclass
+class CeleryDemand:
+    """
+        What the autoscaled pools of a Celery resource asked for together,
+        published by a sharded replica to the allocating one
+    """
+    namespace: str
+    name: str
+    weight: float
+    min_replicas: int
+    desired: int
+
+
+@dataclass
+class PoolDemand:
+    """
+        What an autoscaled worker pool asked for on its latest evaluation
+    """
+    namespace: str
+    name: str  # of the Celery resource
+    deployment: str
+    weight: float  # priorityWeight of the Celery resource
+    min_replicas: int
+    desired: int
+    updated_at: float
+
+
+_budgets: Dict[str, ReplicaBudget] = {}
+# (namespace, deployment) -> PoolDemand
+_demands: Dict[Tuple[str, str], PoolDemand] = {}
+# (namespace, deployment) -> replicas, smallest allocation of its budgets
+_allocations: Dict[Tuple[str, str], int] = {}
+_lock = threading.Lock()
+
+
+def apply_budget_event(event_type, body):
+    """
+        Keeps the budgets current from a watch event on a CeleryReplicaBudget
+    """
+    name = body['metadata']['name']
+    with _lock:
+        if event_type == 'DELETED':
+            _budgets.pop(name, None)
+            return
+        spec = body.get('spec') or {}
+        _budgets[name] = ReplicaBudget(
+            name=name,
+            max_replicas=spec.get('maxReplicas', 0),
+            namespaces=frozenset(spec.get('namespaces') or ()),
+            celery_shares=shares_from_status(body.get('status'))
+        )
+
+
+def shares_from_status(status):
+    """
+        @returns (namespace, name) -> replicas of status.allocations
+    """
+    shares = {}
+    for allocation in (status or {}).get('allocations') or []:
+        namespace, _, name = allocation.get('celery', '').partition('/')
+        shares[(namespace, name)] = allocation.get('replicas', 0)
+    return shares
+
+
+def covers(budget, namespace):
+    return not budget.namespaces or namespace in budget.namespaces
+
+
+def is_budgeted(namespace):
+    with _lock:
+        return any(covers(budget, namespace) for budget in _budgets.values())
+
+
+def record_demand(namespace, name, deployment, weight, min_replicas, desired, now=None):
+    """
+        Called on every autoscaling evaluation of a pool under a budget,
+        the next allocation pass picks it up
+    """
+    demand = PoolDemand(
+        namespace=namespace,
+        name=name,
+        deployment=deployment,
+        weight=weight,
+        min_replicas=min_replicas,
+        desired=max(desired, min_replicas),
+        updated_at=time.monotonic() if now is None else now
+    )
+    with _lock:
+        _demands[(namespace, deployment)] = demand
+
+
+def forget_demands(namespace, name):
+    with _lock:
+        for key in [key for key, demand in _demands.items()
+                    if (demand.namespace, demand.name) == (namespace, name)]:
+            del _demands[key]
+            _allocations.pop(key, None)
+
+
+def budget_cap(namespace, deployment, current_replicas, min_replicas):
+    """
+        @returns replicas the pool may have, None outside of any budget.
+        Until its first allocation a pool doesn't grow
+    """
+    if not is_budgeted(namespace):
+        return None
+    allocated = _allocations.get((namespace, deployment))
+    if allocated is None:
+        return max(current_replicas, min_replicas)
+    return max(allocated, min_replicas)
+
+
+def fair_share(total, demands, weights, floors):
+    """
+        Weighted max-min fair shares of `total` replicas: everyone gets its
+        floor, then shares grow in proportion to their weights, each capped
+        at its demand, until `total` is used up. One sweep over the levels
+        at which shares start and stop growing, O(n log n)
+        @returns integer shares in the order of demands. Floors are kept
+        even if they add up to more than `total`
+    """
+    demands = [max(demand, low) for demand, low in zip(demands, floors)]
+    if sum(demands) <= total:
+        return demands
+    if sum(floors) >= total:
+        return list(floors)
+
+    # share k is clamp(level * weight k, floor k, demand k)
+    events = []
+    for demand, weight, low in zip(demands, weights, floors):
+        if weight > 0 and demand > low:
+            events.append((low / weight, weight))
+            events.append((demand / weight, -weight))
+    events.sort()
+    level = slope = 0
+    used = sum(floors)
+    for at, change in events:
+        if used + slope * (at - level) >= total:
+            break
+        used += slope * (at - level)
+        level = at
+        slope += change
+    level += (total - used) / slope
+    shares = [
+        min(max(level * weight, low), demand) if weight > 0 else low
+        for demand, weight, low in zip(demands, weights, floors)
+    ]
+
+    # whole replicas, the biggest remainders get the ones left over
+    rounded = [floor(share + 1e-9) for share in shares]
+    left = total - sum(rounded)
+    by_remainder = sorted(
+        range(len(shares)), key=lambda k: (rounded[k] - shares[k], -weights[k])
+    )
+    for k in by_remainder:
+        if left <= 0:
+            break
+        if rounded[k] < demands[k]:
+            rounded[k] += 1
+            left -= 1
+    return rounded
+
+
+def group_by_celery(demands):
+    """
+        @returns (namespace, name) -> PoolDemands of the Celery resource
+    """
+    by_celery = {}
+    for demand in demands:
+        by_celery.setdefault((demand.namespace, demand.name), []).append(demand)
+    return by_celery
+
+
+def celery_demand(pools):
+    """
+        @param: pools - PoolDemands of one Celery resource
+    """
+    return CeleryDemand(
+        namespace=pools[0].namespace,
+        name=pools[0].name,
+        weight=pools[0].weight,
+        min_replicas=sum(demand.min_replicas for demand in pools),
+        desired=sum(demand.desired for demand in pools)
+    )
+
+
+def allocate_celery_shares(budget, demands):
+    """
+        Splits a budget across Celery resources by their weights
+        @param: demands - CeleryDemands of the budget's namespaces
+        @returns (namespace, name) -> replicas
+    """
+    shares = fair_share(
+        budget.max_replicas,
+        [demand.desired for demand in demands],
+        [demand.weight for demand in demands],
+        [demand.min_replicas for demand in demands]
+    )
+    return {
+        (demand.namespace, demand.name): share
+        for demand, share in zip(demands, shares)
+    }
+
+
+def split_celery_share(share, pools):
+    """
+        Splits a Celery resource's share evenly across its pools
+        @param: pools - PoolDemands of the resource
+        @returns (namespace, deployment) -> replicas
+    """
+    if len(pools) == 1:
+        return {(pools[0].namespace, pools[0].deployment): share}
+    pool_shares = fair_share(
+        share,
+        [demand.desired for demand in pools],
+        [1] * len(pools),
+        [demand.min_replicas for demand in pools]
+    )
+    return {
+        (demand.namespace, demand.deployment): replicas
+        for demand, replicas in zip(pools, pool_shares)
+    }
+
+
+def allocate_budget(budget, demands):
+    """
+        Splits a budget across Celery resources by their weights, then each
+        resource's share evenly across its pools
+        @param: demands - PoolDemands of the budget's namespaces
+        @returns (namespace, deployment) -> replicas
+    """
+    pools = list(group_by_celery(demands).values())
+    celery_shares = fair_share(
+        budget.max_replicas,
+        [sum(demand.desired for demand in pool) for pool in pools],
+        [pool[0].weight for pool in pools],
+        [sum(demand.min_replicas for demand in pool) for pool in pools]
+    )
+    allocations = {}
+    for pool, share in zip(pools, celery_shares):
+        if len(pool) == 1:
+            allocations[(pool[0].namespace, pool[0].deployment)] = share
+        else:
+            allocations.update(split_celery_share(share, pool))
+    return allocations
+
+
+def expire_demands(now):
+    """
+        Drops demands not renewed within BUDGET_DEMAND_TTL, the caller
+        holds _lock
+    """
+    for key in [key for key, demand in _demands.items()
+                if now - demand.updated_at > constants.BUDGET_DEMAND_TTL]:
+        del _demands[key]
+
+
+def allocate_budgets(now=None):
+    """
+        The batched pass of an unsharded operator: allocates every budget
+        from the demands recorded since, in one go
+        @returns budget name -> summary for its status
+    """
+    now = time.monotonic() if now is None else now
+    with _lock:
+        expire_demands(now)
+        budgets = list(_budgets.values())
+        demands = list(_demands.values())
+
+    allocations = {}
+    summaries = {}
+    for budget in budgets:
+        members = [demand for demand in demands if covers(budget, demand.namespace)]
+        allocated = allocate_budget(budget, members)
+        for key, replicas in allocated.items():
+            # under several budgets, the tightest one wins
+            allocations[key] = min(replicas, allocations.get(key, replicas))
+        summaries[budget.name] = {
+            'maxReplicas': budget.max_replicas,
+            'demandedReplicas': sum(demand.desired for demand in members),
+            'allocatedReplicas': sum(allocated.values()),
+            'celeries': len({(demand.namespace, demand.name) for demand in members})
+        }
+
+    global _allocations
+    _allocations = allocations
+    return summaries
+
+
+def local_celery_demands(owns=None, now=None):
+    """
+        @param: owns - filter(namespace, name), leaves out the demands of
+            resources handed to another replica until they expire
+        @returns CeleryDemands of the resources this replica autoscales
+    """
+    now = time.monotonic() if now is None else now
+    with _lock:
+        expire_demands(now)
+        demands = list(_demands.values())
+    return [
+        celery_demand(pools)
+        for (namespace, name), pools in group_by_celery(demands).items()
+        if owns is None or owns(namespace, name)
+    ]
+
+
+def encode_demands(demands):
+    """
+        Compact enough for thousands of resources in a lease annotation
+    """
+    return json.dumps([
+        [demand.namespace, demand.name, demand.weight, demand.min_replicas, demand.desired]
+        for demand in demands
+    ], separators=(',', ':'))
+
+
+def decode_demands(text):
+    try:
+        return [CeleryDemand(*entry) for entry in json.loads(text or '[]')]
+    except (ValueError, TypeError):
+        return []
+
+
+def allocate_celery_budgets(demands):
+    """
+        The pass of the allocating replica of a sharded operator: splits
+        every budget across the Celery resources of all replicas at once,
+        so shares are fair across shards
+        @param: demands - CeleryDemands published by every live replica
+        @returns budget name -> summary for its status, with the shares
+        under `allocations`
+    """
+    # a resource changing hands may be published twice for a moment
+    demands = list({(demand.namespace, demand.name): demand for demand in demands}.values())
+    with _lock:
+        budgets = list(_budgets.values())
+
+    summaries = {}
+    for budget in budgets:
+        members = [demand for demand in demands if covers(budget, demand.namespace)]
+        shares = allocate_celery_shares(budget, members)
+        # used right away, the other replicas get them from the status
+        budget.celery_shares = shares
+        summaries[budget.name] = {
+            'maxReplicas': budget.max_replicas,
+            'demandedReplicas': sum(demand.desired for demand in members),
+            'allocatedReplicas': sum(shares.values()),
+            'celeries': len(members),
+            'allocations': [
+                {'celery': f"{namespace}/{name}", 'replicas': replicas}
+                for (namespace, name), replicas in sorted(shares.items())
+            ]
+        }
+    return summaries
+
+
+def allocate_pools_from_shares(now=None):
+    """
+        The pass of every replica of a sharded operator: splits the shares
+        its Celery resources got from the allocating replica across their
+        pools. A resource without a share yet doesn't grow
+    """
+    now = time.monotonic() if now is None else now
+    with _lock:
+        expire_demands(now)
+        budgets = list(_budgets.values())
+        demands = list(_demands.values())
+
+    allocations = {}
+    for (namespace, name), pools in group_by_celery(demands).items():
+        for budget in budgets:
+            share = budget.celery_shares.get((namespace, name))
+            if share is None or not covers(budget, namespace):
+                continue
+            for key, replicas in split_celery_share(share, pools).items():
+                allocations[key] = min(replicas, allocations.get(key, replicas))
+
+    global _allocations
+    _allocations = allocations
+
+
+def get_allocation(namespace, deployment) -> Optional[int]:
+    return _allocations.get((namespace, deployment))
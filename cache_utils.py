@@ -0,0 +1,208 @@
+import json
+import hashlib
+import threading
+from typing import Dict, Set, Tuple
+
+import constants
+from k8s_utils import get_api_client
+
+
+# (namespace, kind, name) -> cached child entry
+_children: Dict[Tuple[str, str, str], dict] = {}
+# (namespace, owner name) -> keys of the owner's cached children
+_by_owner: Dict[Tuple[str, str], Set[Tuple[str, str, str]]] = {}
+# (namespace, kind, name) -> fingerprint of the child right after our last apply
+_applied: Dict[Tuple[str, str, str], str] = {}
+_lock = threading.Lock()
+
+
+def get_owner_name(metadata):
+    """
+        @returns name of the Celery resource owning an object or None
+    """
+    for ref in metadata.get('ownerReferences') or []:
+        if ref.get('kind') == constants.OWNER_KIND and \
+                ref.get('apiVersion', '').startswith(constants.OWNER_GROUP):
+            return ref.get('name')
+    return None
+
+
+def get_child_type(kind, metadata):
+    """
+        Flower children are labelled app=<their own name>, worker deployments
+        carry the app name of the Celery resource instead, and warm pools
+        a label of their own
+    """
+    if kind == constants.SERVICE_KIND:
+        return constants.FLOWER_TYPE
+    labels = metadata.get('labels') or {}
+    if labels.get(constants.WARM_WORKER_LABEL):
+        return constants.WARM_WORKER_TYPE
+    if labels.get('app') == metadata.get('name'):
+        return constants.FLOWER_TYPE
+    return constants.WORKER_TYPE
+
+
+def _resource_version(entry):
+    try:
+        return int(entry.get('resourceVersion') or 0)
+    except ValueError:
+        # resource versions are opaque, don't order what isn't a number
+        return 0
+
+
+def child_entry(kind, body):
+    """
+        @param: body - child object as a dict, as delivered by the watch
+        @returns cache entry shaped like the children entries in handler status
+    """
+    metadata = body.get('metadata') or {}
+    spec = body.get('spec') or {}
+    entry = {
+        'name': metadata.get('name'),
+        'namespace': metadata.get('namespace'),
+        'kind': kind,
+        'type': get_child_type(kind, metadata),
+        'owner': get_owner_name(metadata),
+        'hash': (metadata.get('annotations') or {}).get(constants.HASH_ANNOTATION),
+        'resourceVersion': metadata.get('resourceVersion'),
+        'fingerprint': live_fingerprint(kind, spec)
+    }
+    if kind == constants.DEPLOYMENT_KIND:
+        entry['pool'] = (metadata.get('labels') or {}).get('celery-pool')
+        entry['replicas'] = spec.get('replicas') or 0
+        entry['readyReplicas'] = (body.get('status') or {}).get('readyReplicas') or 0
+    else:
+        entry['spec'] = {'ports': spec.get('ports') or []}
+    return entry
+
+
+# worker and flower container fields rendered by the operator
+CONTAINER_FIELDS = (
+    'name', 'image', 'command', 'args', 'resources', 'env', 'readinessProbe', 'livenessProbe'
+)
+
+
+def live_fingerprint(kind, spec):
+    """
+        Hash of the child fields the operator owns. Read back from the API
+        server they're defaulted and normalized, so they're only compared
+        with the fingerprint of the object returned by our own last apply
+    """
+    if kind == constants.DEPLOYMENT_KIND:
+        containers = ((spec.get('template') or {}).get('spec') or {}).get('containers') or []
+        # replicas are left out, they belong to the autoscaler
+        owned = {
+            'containers': [
+                {field: container.get(field) for field in CONTAINER_FIELDS}
+                for container in containers
+            ]
+        }
+    else:
+        owned = {
+            'selector': spec.get('selector'),
+            'ports': [port.get('port') for port in spec.get('ports') or []]
+        }
+    content = json.dumps(owned, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def apply_watch_event(kind, event_type, body):
+    """
+        Keeps the cache current from a watch event on a Deployment or Service
+        @returns the cache entry or None if the object isn't a Celery child
+    """
+    # before anything costlier, the watches see other objects too
+    if get_owner_name(body.get('metadata') or {}) is None:
+        return None
+    entry = child_entry(kind, body)
+
+    namespace = entry['namespace']
+    key = (namespace, kind, entry['name'])
+    with _lock:
+        if event_type == 'DELETED':
+            _children.pop(key, None)
+            _by_owner.get((namespace, entry['owner']), set()).discard(key)
+            return entry
+
+        cached = _children.get(key)
+        if cached and _resource_version(entry) < _resource_version(cached):
+            # a write of ours already got a newer version in
+            return cached
+        _children[key] = entry
+        _by_owner.setdefault((namespace, entry['owner']), set()).add(key)
+    return entry
+
+
+def cache_object(kind, obj):
+    """
+        Caches the object returned by one of our own writes, so the next
+        read sees it before its watch event arrives
+        @param: obj - kubernetes client model of the child
+        @returns the cache entry
+    """
+    # shaped like the watch delivers it: camelCase, unset fields left out.
+    # to_dict() would give snake_case keys and Nones, another fingerprint
+    body = get_api_client().sanitize_for_serialization(obj)
+    entry = apply_watch_event(kind, 'MODIFIED', body)
+    if entry:
+        mark_applied(entry)
+    return entry
+
+
+def note_replicas(namespace, deployment_name, replicas):
+    """
+        Records replicas just written to a deployment's scale
+    """
+    with _lock:
+        entry = _children.get((namespace, constants.DEPLOYMENT_KIND, deployment_name))
+        if entry:
+            entry['replicas'] = replicas
+
+
+def get_cached_child(namespace, kind, name):
+    return _children.get((namespace, kind, name))
+
+
+def get_cached_children(namespace, owner, kind=None, child_type=None):
+    """
+        @returns cached children of a Celery resource
+    """
+    with _lock:
+        keys = list(_by_owner.get((namespace, owner), ()))
+    children = (_children.get(key) for key in keys)
+    return [
+        child for child in children
+        if child and (kind is None or child['kind'] == kind)
+        and (child_type is None or child['type'] == child_type)
+    ]
+
+
+def mark_applied(entry):
+    """
+        Remembers what a child looked like right after the operator applied it
+    """
+    _applied[entry['namespace'], entry['kind'], entry['name']] = entry['fingerprint']
+
+
+def has_drifted(entry, rendered_hash):
+    """
+        A child has drifted when its hash annotation no longer matches the
+        rendered manifest, or when the fields the operator owns changed
+        since it last applied them
+    """
+    if entry.get('hash') != rendered_hash:
+        return True
+    applied = _applied.get((entry['namespace'], entry['kind'], entry['name']))
+    if applied is None:
+        # nothing applied since start up, take the live object as baseline
+        mark_applied(entry)
+        return False
+    return applied != entry['fingerprint']
+
+
+def forget_cached_children(namespace, owner):
+    with _lock:
+        for key in _by_owner.pop((namespace, owner), set()):
+            _children.pop(key, None)
+            _applied.pop(key, None)
@@ -4,6 +4,19 @@ SERVICE_KIND = 'Service'
 
 # Celery Worker Constants
 WORKER_TYPE = 'worker'
+WARM_WORKER_TYPE = 'warm-worker'
+WARM_WORKER_LABEL = 'celeryproject.org/warm-pool'
+WORKER_READY_FILE = '/tmp/celery-worker-ready'  # exists while the worker consumes
+WORKER_HEARTBEAT_FILE = '/tmp/celery-worker-heartbeat'  # touched from the worker's event loop
+WORKER_HEARTBEAT_MAX_AGE = 60  # seconds, an older heartbeat restarts the worker
+READINESS_PERIOD = 5  # seconds
+LIVENESS_PERIOD = 15  # seconds
+WORKER_PROBE_FILES = 'files'  # probe mode of apps maintaining the files, see example/app.py
+WORKER_PING_TIMEOUT = 5  # seconds the worker has to answer `celery inspect ping`
+WORKER_PING_PROBE_TIMEOUT = 30  # seconds, the ping process imports the app first
+WORKER_PING_READINESS_PERIOD = 30  # seconds
+WORKER_PING_LIVENESS_PERIOD = 60  # seconds
+WORKER_PING_LIVENESS_DELAY = 120  # seconds a booting worker gets before its first ping
 
 
 # Flower Constants
@@ -15,3 +28,157 @@ STATUS_CREATED = 'CREATED'
 STATUS_SUCCESS = 'SUCCESS'
 STATUS_UPDATED = 'UPDATED'
 STATUS_PATCHED = 'PATCHED'
+
+
+# Flower Polling
+FLOWER_POLL_TIMEOUT = 5  # seconds, whole request
+FLOWER_POLL_CONNECT_TIMEOUT = 2  # seconds
+FLOWER_POOL_SIZE = 100  # max open keep-alive connections
+FLOWER_KEEPALIVE_TIMEOUT = 30  # seconds an idle connection is kept
+FLOWER_MAX_CONCURRENT_POLLS = 50
+FLOWER_BACKOFF_BASE = 10  # seconds, doubled on each consecutive failure
+FLOWER_BACKOFF_MAX = 300  # seconds
+
+
+# Queue Metrics Backends
+QUEUE_METRICS_FLOWER = 'flower'
+QUEUE_METRICS_BROKER = 'broker'
+BROKER_PROBE_TIMEOUT = 3  # seconds
+BROKER_POOL_SIZE = 10  # pooled connections per broker url
+# kombu's redis transport stores priority messages in sibling lists
+REDIS_PRIORITY_SEP = '\x06\x16'
+REDIS_PRIORITY_STEPS = [0, 3, 6, 9]
+
+
+# Autoscaling
+METRIC_TARGET_LENGTH = 'length'
+METRIC_TARGET_DRAIN_TIME = 'drainTime'
+METRIC_TARGET_WAIT_TIME = 'waitTime'
+METRIC_TARGET_UTILIZATION = 'utilization'
+UTILIZATION_RESOURCES = ('cpu', 'memory')
+UTILIZATION_TOLERANCE = 0.1  # like HPA, utilization within 10% of target keeps replicas
+SCALE_EVENT_HISTORY = 1800  # seconds of scale events kept for rate policies
+MIN_SCALE_PATCH_INTERVAL = 15  # seconds between replica patches per CR
+STATUS_MIN_ABS_CHANGE = 5  # messages
+STATUS_MIN_REL_CHANGE = 0.1  # fraction of the last written queue length
+STATUS_MAX_WRITE_INTERVAL = 300  # seconds, status is refreshed at least this often
+
+# Scale To Zero
+SCALE_TO_ZERO_IDLE_SECONDS = 300  # queues empty this long scale a pool to zero
+ACTIVATOR_POLL_INTERVAL = 2  # seconds between queue probes of pools at zero
+ACTIVATOR_IDLE_INTERVAL = 10  # seconds between checks when no pool is at zero
+
+# Graceful scale down
+DRAIN_TIMEOUT = 300  # seconds to wait for in-flight tasks of drained workers
+POD_DELETION_COST_ANNOTATION = 'controller.kubernetes.io/pod-deletion-cost'
+DRAINED_POD_DELETION_COST = -1000  # below the default 0, deleted first
+
+# Warm pool
+WARM_POOL_SIZE = 1  # standby workers per pool
+WARM_POOL_RESOURCES = {'requests': {'cpu': '10m', 'memory': '64Mi'}}
+
+
+# Worker autotuning
+AUTOTUNE_INTERVAL = 60  # seconds between autotuning evaluations
+AUTOTUNE_MIN_INTERVAL = 600  # seconds between worker option changes of a pool, each one rolls its pods
+AUTOTUNE_TARGET_UTILIZATION = 80  # percent of the worker container's cpu/memory the busy slots may use
+AUTOTUNE_MAX_CONCURRENCY = 64
+AUTOTUNE_MIN_CHANGE = 0.25  # relative concurrency change worth a rollout
+AUTOTUNE_PREFETCH_SECONDS = 1  # seconds of tasks a worker process prefetches
+AUTOTUNE_MAX_PREFETCH_MULTIPLIER = 16
+CELERY_DEFAULT_PREFETCH_MULTIPLIER = 4
+
+
+# Resource rightsizing
+RIGHTSIZING_RECOMMEND = 'recommend'
+RIGHTSIZING_APPLY = 'apply'
+RIGHTSIZING_INTERVAL = 60  # seconds between pod usage samples and OOM checks
+RIGHTSIZING_WINDOW = 3600  # seconds of usage samples and OOM kills recommendations are based on
+RIGHTSIZING_MIN_SAMPLES = 10  # usage samples needed before cpu and memory are recommended from usage
+RIGHTSIZING_CPU_PERCENTILE = 90  # of the busiest pod's cpu usage per sample
+RIGHTSIZING_MARGIN = 0.15  # headroom added to the usage based recommendation
+RIGHTSIZING_THROTTLE_RATIO = 0.9  # cpu usage this close to the limit counts as throttled
+RIGHTSIZING_THROTTLED_FRACTION = 0.1  # of the samples, after which the cpu limit is raised
+RIGHTSIZING_THROTTLE_BUMP = 1.25  # cpu limit growth while throttled
+RIGHTSIZING_OOM_BUMP = 1.2  # like VPA, the memory limit of an OOMKilled container grows by 20%
+RIGHTSIZING_OOM_MIN_BUMP = 100 * 2 ** 20  # bytes, at least
+RIGHTSIZING_MIN_CHANGE = 0.2  # relative change of a request or limit worth a rollout
+RIGHTSIZING_MIN_INTERVAL = 1800  # seconds between applied changes of a pool
+RIGHTSIZING_OOM_MIN_INTERVAL = 300  # seconds, after an OOM kill
+RIGHTSIZING_MIN_CPU = 0.01  # cores
+RIGHTSIZING_MIN_MEMORY = 32 * 2 ** 20  # bytes
+
+
+# Replica budgets
+BUDGET_INTERVAL = 2  # seconds between allocation passes
+BUDGET_DEMAND_TTL = 90  # seconds, demands of pools no longer evaluated expire
+BUDGET_DEFAULT_WEIGHT = 1  # priorityWeight of a Celery resource
+BUDGET_ALLOCATOR_SHARD = 0  # the replica holding this shard allocates for a sharded operator
+BUDGET_DEMANDS_ANNOTATION = 'celeryproject.org/budget-demands'  # on member leases
+
+
+# Reconciliation
+HASH_ANNOTATION = 'celeryproject.org/spec-hash'
+CREATE_RETRIES = 5
+CREATE_RETRY_DELAY = 10  # seconds
+
+
+# Manifest Templates, relative to templates/
+WORKER_DEPLOYMENT_TEMPLATE = 'deployments/celery_worker_deployment.yaml'
+FLOWER_DEPLOYMENT_TEMPLATE = 'deployments/flower_deployment.yaml'
+FLOWER_SERVICE_TEMPLATE = 'services/flower_service.yaml'
+
+
+# Kubernetes API Client
+K8S_POOL_SIZE = 32  # urllib3 keep-alive connections to the API server
+K8S_REQUEST_TIMEOUT = (3, 15)  # seconds, (connect, read)
+K8S_RETRIES = 3
+K8S_RETRY_BACKOFF = 0.5  # seconds, doubled on each retry
+K8S_RETRY_STATUSES = (429, 500, 502, 503, 504)
+K8S_RETRY_VERBS = ('read', 'list', 'patch', 'replace')
+
+
+# Adaptive Polling
+POLL_BASE_INTERVAL = 2  # seconds, timer tick. Polls happen on ticks that are due
+POLL_MIN_INTERVAL = 2  # seconds, used while backlog grows
+POLL_MAX_INTERVAL = 30  # seconds, reached while queues stay flat or empty
+POLL_INITIAL_INTERVAL = 10  # seconds
+PUSH_LISTENER_RETRY_INTERVAL = 10  # seconds
+
+
+# Metrics
+METRICS_PORT = 8000  # prometheus metrics endpoint of the operator
+
+
+# Child cache and drift detection
+OWNER_KIND = 'Celery'
+OWNER_GROUP = 'celeryproject.org'
+DRIFT_CHECK_INTERVAL = 30  # seconds between drift checks of a CR's children
+CHILD_LABEL = 'celeryproject.org/child'  # on every child, the child watches skip other objects
+
+
+# Sharding
+SHARD_COUNT_ENV = 'OPERATOR_SHARDS'  # 1 disables sharding and leases
+LEASE_NAMESPACE_ENV = 'POD_NAMESPACE'
+IDENTITY_ENV = 'POD_NAME'
+LEASE_PREFIX = 'celery-operator'
+LEASE_LABEL = 'celeryproject.org/operator-lease'
+LEASE_DURATION = 15  # seconds a shard stays owned without a renewal
+LEASE_RENEW_INTERVAL = 5
+
+
+# Task events
+TASK_EVENTS_RATE_WINDOW = 60  # seconds of per second counts task rates are averaged over
+TASK_EVENTS_SKETCH_WINDOW = 300  # seconds, runtime quantiles cover the last one to two windows
+TASK_EVENTS_SKETCH_MIN = 0.001  # seconds, shorter runtimes and waits share the first bucket
+TASK_EVENTS_SKETCH_MAX = 86400  # seconds, longer ones share the last bucket
+TASK_EVENTS_SKETCH_GROWTH = 1.05  # bucket bound ratio, quantiles are within ~2.5%
+TASK_EVENTS_MAX_TASK_NAMES = 200  # further task names are counted as TASK_EVENTS_OTHER
+TASK_EVENTS_OTHER = '_other'
+TASK_EVENTS_MAX_PENDING = 100000  # tasks received and not finished yet, oldest forgotten first
+TASK_EVENTS_MAX_WORKERS = 1000
+TASK_EVENTS_MAX_WORKER_GROUPS = 100  # deployments whose runtimes are tracked
+TASK_EVENTS_STATUS_TASKS = 10  # busiest task names summarized in the CR status
+TASK_EVENTS_STATUS_INTERVAL = 60  # seconds between task stats status writes
+TASK_EVENTS_CHECK_INTERVAL = 1  # seconds between stop checks while events stream in
+TASK_EVENTS_RETRY_INTERVAL = 10  # seconds
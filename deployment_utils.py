@@ -1,79 +1,277 @@
 import os
+import copy
+import json
+import hashlib
+import shlex
 import kopf
 import yaml
+from kubernetes.client.rest import ApiException
 
+import constants
+from cache_utils import (
+    cache_object
+)
+from models.worker_spec import (
+    args_list_from_spec_params
+)
 
-def deploy_celery_workers(apps_api, namespace, spec, logger):
-    path = os.path.join(
-        os.path.dirname(__file__),
-        'templates/deployments/celery_worker_deployment.yaml'
-    )
-    tmpl = open(path, 'rt').read()
 
-    celery_config = spec['workerSpec']
-    req_resources = celery_config['resources']['requests']
-    lim_resources = celery_config['resources']['limits']
+def load_template(relative_path):
+    path = os.path.join(os.path.dirname(__file__), 'templates', relative_path)
+    with open(path, 'rt') as f:
+        return yaml.safe_load(f)
+
+
+# Parsed once at import, every render works on a deep copy
+TEMPLATES = {
+    constants.WORKER_DEPLOYMENT_TEMPLATE: load_template(constants.WORKER_DEPLOYMENT_TEMPLATE),
+    constants.FLOWER_DEPLOYMENT_TEMPLATE: load_template(constants.FLOWER_DEPLOYMENT_TEMPLATE),
+    constants.FLOWER_SERVICE_TEMPLATE: load_template(constants.FLOWER_SERVICE_TEMPLATE),
+}
+
+
+def get_template(relative_path):
+    return copy.deepcopy(TEMPLATES[relative_path])
+
+
+def overlay_metadata(data, name, namespace, labels):
+    data['metadata'].update({'name': name, 'namespace': namespace})
+    data['metadata'].setdefault('labels', {}).update(labels)
+    data['metadata']['labels'][constants.CHILD_LABEL] = 'true'
+    return data
+
+
+def overlay_pod_template(data, replicas, selector, container):
+    """
+        Overlays replicas, selector, pod labels and the first container's
+        fields on a base deployment
+    """
+    data['spec']['replicas'] = replicas
+    data['spec']['selector'] = {'matchLabels': dict(selector)}
+    data['spec']['template']['metadata'] = {'labels': dict(selector)}
+    data['spec']['template']['spec']['containers'][0].update(container)
+    return data
 
-    text = tmpl.format(
-        namespace=namespace,
-        app_name=spec['common']['appName'],
+
+def worker_args(spec, pool, queues):
+    """
+        @returns celery worker arguments of a pool, consuming queues
+    """
+    return args_list_from_spec_params(
         celery_app=spec['common']['celeryApp'],
-        image=spec['common']['image'],
-        num_of_workers=celery_config['numOfWorkers'],
-        queues=celery_config['queues'],
-        loglevel=celery_config['logLevel'],
-        concurrency=celery_config['concurrency'],
-        lim_cpu=lim_resources['cpu'],
-        lim_mem=lim_resources['memory'],
-        req_cpu=req_resources['cpu'],
-        req_mem=req_resources['memory']
+        queues=queues,
+        loglevel=pool.log_level,
+        concurrency=pool.concurrency,
+        pool=pool.pool,
+        prefetch_multiplier=pool.prefetch_multiplier,
+        max_tasks_per_child=pool.max_tasks_per_child,
+        max_memory_per_child=pool.max_memory_per_child,
+        optimization=pool.optimization
+    )
+
+
+def worker_ping_probes(celery_app):
+    """
+        Exec probes pinging the pod's own worker, which any app answers.
+        Every probe spawns a `celery inspect` process importing the app, so
+        they run far less often than the file probes
+        @returns container fields
+    """
+    ping = [
+        'sh', '-c',
+        f"celery --app={shlex.quote(celery_app)} inspect ping"
+        f" --destination=celery@$HOSTNAME --timeout={constants.WORKER_PING_TIMEOUT}"
+    ]
+    return {
+        'readinessProbe': {
+            'exec': {'command': ping},
+            'periodSeconds': constants.WORKER_PING_READINESS_PERIOD,
+            'timeoutSeconds': constants.WORKER_PING_PROBE_TIMEOUT,
+            'failureThreshold': 2
+        },
+        'livenessProbe': {
+            'exec': {'command': ping},
+            'initialDelaySeconds': constants.WORKER_PING_LIVENESS_DELAY,
+            'periodSeconds': constants.WORKER_PING_LIVENESS_PERIOD,
+            'timeoutSeconds': constants.WORKER_PING_PROBE_TIMEOUT,
+            'failureThreshold': 3
+        }
+    }
+
+
+def worker_probes(pool, celery_app):
+    """
+        With `mode: files`, exec probes on files the worker maintains once
+        told their paths, see example/app.py. Each probe is a shell test
+        rather than a `celery inspect` process. Apps that don't maintain
+        the files would never turn ready, so any other mode pings the worker
+        @returns container fields, {} unless the pool enables probes
+    """
+    probes = pool.probes or {}
+    if not probes.get('enabled'):
+        return {}
+    if probes.get('mode') != constants.WORKER_PROBE_FILES:
+        return worker_ping_probes(celery_app)
+    ready_file = probes.get('readyFile', constants.WORKER_READY_FILE)
+    heartbeat_file = probes.get('heartbeatFile', constants.WORKER_HEARTBEAT_FILE)
+    max_age = probes.get('heartbeatSeconds', constants.WORKER_HEARTBEAT_MAX_AGE)
+    fresh = f"[ $(( $(date +%s) - $(stat -c %Y {heartbeat_file}) )) -lt {max_age} ]"
+    return {
+        'env': [
+            {'name': 'CELERY_WORKER_READY_FILE', 'value': ready_file},
+            {'name': 'CELERY_WORKER_HEARTBEAT_FILE', 'value': heartbeat_file}
+        ],
+        # ready while consuming, not while booting or shutting down
+        'readinessProbe': {
+            'exec': {'command': ['sh', '-c', f"test -f {ready_file} && {fresh}"]},
+            'periodSeconds': constants.READINESS_PERIOD,
+            'failureThreshold': 2
+        },
+        # a booting worker has no heartbeat yet, a wedged one a stale one
+        'livenessProbe': {
+            'exec': {'command': ['sh', '-c', f"test ! -f {heartbeat_file} || {fresh}"]},
+            'periodSeconds': constants.LIVENESS_PERIOD,
+            'failureThreshold': 3
+        }
+    }
+
+
+def overlay_rollout(data, rollout):
+    """
+        Overlays a pool's maxSurge, maxUnavailable and minReadySeconds on
+        the template's rolling update
+    """
+    if not rollout:
+        return data
+    rolling_update = data['spec']['strategy']['rollingUpdate']
+    for key in ('maxSurge', 'maxUnavailable'):
+        if key in rollout:
+            rolling_update[key] = rollout[key]
+    if 'minReadySeconds' in rollout:
+        data['spec']['minReadySeconds'] = rollout['minReadySeconds']
+    return data
+
+
+def render_worker_deployment(namespace, spec, pool):
+    """
+        @param: pool - WorkerPool to render the deployment for
+        @returns worker deployment manifest for the celery spec
+    """
+    data = get_template(constants.WORKER_DEPLOYMENT_TEMPLATE)
+    overlay_metadata(data, pool.deployment_name, namespace, pool.labels)
+    overlay_pod_template(data, pool.replicas, pool.labels, {
+        'name': pool.deployment_name,
+        'image': spec['common']['image'],
+        'args': worker_args(spec, pool, pool.queues),
+        'resources': copy.deepcopy(pool.resources),
+        **worker_probes(pool, spec['common']['celeryApp'])
+    })
+    overlay_rollout(data, pool.rollout)
+    return annotate_hash(data)
+
+
+def render_warm_worker_deployment(namespace, spec, pool):
+    """
+        Standby workers of a pool: same image and worker options, but
+        consuming only the pool's standby queue until activated
+        @param: pool - WorkerPool with a warmPool
+        @returns warm worker deployment manifest
+    """
+    data = get_template(constants.WORKER_DEPLOYMENT_TEMPLATE)
+    overlay_metadata(data, pool.warm_deployment_name, namespace, pool.warm_labels)
+    overlay_pod_template(
+        data, pool.warm_pool.get('size', constants.WARM_POOL_SIZE), pool.warm_labels, {
+            'name': pool.warm_deployment_name,
+            'image': spec['common']['image'],
+            'args': worker_args(spec, pool, pool.standby_queue),
+            'resources': pool.warm_resources,
+            **worker_probes(pool, spec['common']['celeryApp'])
+        }
     )
-    data = yaml.safe_load(text)
+    overlay_rollout(data, pool.rollout)
+    return annotate_hash(data)
+
+
+def render_flower_deployment(namespace, spec):
+    """
+        @returns flower deployment manifest for the celery spec
+    """
+    name = f"{spec['common']['appName']}-flower"
+    flower_spec = spec['flowerSpec']
+
+    data = get_template(constants.FLOWER_DEPLOYMENT_TEMPLATE)
+    overlay_metadata(data, name, namespace, {'app': name})
+    overlay_pod_template(data, flower_spec['replicas'], {'run': name}, {
+        'name': name,
+        'image': spec['common']['image'],
+        'args': [f"--app={spec['common']['celeryApp']}"],
+        'resources': copy.deepcopy(flower_spec['resources'])
+    })
+    return annotate_hash(data)
+
+
+def render_flower_service(namespace, spec):
+    """
+        @returns flower service manifest for the celery spec
+    """
+    name = f"{spec['common']['appName']}-flower"
+
+    data = get_template(constants.FLOWER_SERVICE_TEMPLATE)
+    overlay_metadata(data, name, namespace, {'app': name})
+    data['spec']['selector'] = {'run': name}
+    return annotate_hash(data)
+
+
+def deploy_celery_workers(apps_api, namespace, spec, logger, pool):
+    data = render_worker_deployment(namespace, spec, pool)
     mark_as_child(data)
 
-    deployed_obj = apps_api.create_namespaced_deployment(
-        namespace=namespace,
-        body=data
+    deployed_obj = create_or_read(
+        apps_api.create_namespaced_deployment,
+        apps_api.read_namespaced_deployment,
+        namespace, data, logger
     )
+    cache_object(constants.DEPLOYMENT_KIND, deployed_obj)
 
     logger.info(
-        f"Deployment for celery workers successfully created with name: %s",
+        "Deployment for celery workers successfully created with name: %s",
         deployed_obj.metadata.name
     )
 
     return deployed_obj
 
 
-def deploy_flower(apps_api, namespace, spec, logger):
-    path = os.path.join(
-        os.path.dirname(__file__),
-        'templates/deployments/flower_deployment.yaml'
+def deploy_warm_workers(apps_api, namespace, spec, logger, pool):
+    data = render_warm_worker_deployment(namespace, spec, pool)
+    mark_as_child(data)
+
+    deployed_obj = create_or_read(
+        apps_api.create_namespaced_deployment,
+        apps_api.read_namespaced_deployment,
+        namespace, data, logger
     )
-    tmpl = open(path, 'rt').read()
-
-    flower_config = spec['flowerSpec']
-    req_resources = flower_config['resources']['requests']
-    lim_resources = flower_config['resources']['limits']
-    text = tmpl.format(
-        namespace=namespace,
-        app_name=spec['common']['appName'],
-        celery_app=spec['common']['celeryApp'],
-        image=spec['common']['image'],
-        replicas=flower_config['replicas'],
-        lim_cpu=lim_resources['cpu'],
-        lim_mem=lim_resources['memory'],
-        req_cpu=req_resources['cpu'],
-        req_mem=req_resources['memory']
+    cache_object(constants.DEPLOYMENT_KIND, deployed_obj)
+
+    logger.info(
+        "Deployment for warm celery workers successfully created with name: %s",
+        deployed_obj.metadata.name
     )
-    data = yaml.safe_load(text)
+
+    return deployed_obj
+
+
+def deploy_flower(apps_api, namespace, spec, logger):
+    data = render_flower_deployment(namespace, spec)
     mark_as_child(data)
 
-    deployed_obj = apps_api.create_namespaced_deployment(
-        namespace=namespace,
-        body=data
+    deployed_obj = create_or_read(
+        apps_api.create_namespaced_deployment,
+        apps_api.read_namespaced_deployment,
+        namespace, data, logger
     )
+    cache_object(constants.DEPLOYMENT_KIND, deployed_obj)
     logger.info(
-        f"Deployment for celery flower successfully created with name: %s",
+        "Deployment for celery flower successfully created with name: %s",
         deployed_obj.metadata.name
     )
 
@@ -81,30 +279,83 @@ def deploy_flower(apps_api, namespace, spec, logger):
 
 
 def expose_flower_service(api, namespace, spec, logger):
-    path = os.path.join(
-        os.path.dirname(__file__),
-        'templates/services/flower_service.yaml'
-    )
-    tmpl = open(path, 'rt').read()
-
-    text = tmpl.format(
-        namespace=namespace,
-        app_name=spec['common']['appName']
-    )
-    data = yaml.safe_load(text)
+    data = render_flower_service(namespace, spec)
     mark_as_child(data)
 
-    svc_obj = api.create_namespaced_service(
-        namespace=namespace,
-        body=data
+    svc_obj = create_or_read(
+        api.create_namespaced_service,
+        api.read_namespaced_service,
+        namespace, data, logger
     )
+    cache_object(constants.SERVICE_KIND, svc_obj)
     logger.info(
-        f"Flower service successfully created with name: %s",
+        "Flower service successfully created with name: %s",
         svc_obj.metadata.name
     )
     return svc_obj
 
 
+def create_or_read(create, read, namespace, data, logger):
+    """
+        Creates a child, or returns the existing one if an earlier attempt
+        of the handler already created it, so creation is safe to retry
+    """
+    try:
+        return create(namespace=namespace, body=data)
+    except ApiException as e:
+        if e.status != 409:
+            raise
+
+    name = data['metadata']['name']
+    logger.info("%s %s already exists, reusing it", data['kind'], name)
+    return read(name, namespace)
+
+
+def child_status(obj, kind, child_type, **extra):
+    """
+        @param: obj - created or patched child object
+        @returns status entry recorded for the child in handler status
+    """
+    status = {
+        'name': obj.metadata.name,
+        'kind': kind,
+        'type': child_type,
+        'hash': get_manifest_hash(obj.to_dict()),
+        **extra
+    }
+    if kind == constants.DEPLOYMENT_KIND:
+        status['replicas'] = obj.spec.replicas
+    else:
+        status['spec'] = obj.spec.to_dict()
+    return status
+
+
+def manifest_hash(data):
+    """
+        Content hash of a rendered child manifest, stable across key order
+    """
+    content = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def annotate_hash(data):
+    """
+        Stores the manifest's content hash in its own annotations
+    """
+    content_hash = manifest_hash(data)
+    data['metadata'].setdefault('annotations', {})[constants.HASH_ANNOTATION] = content_hash
+    return data
+
+
+def get_manifest_hash(data):
+    """
+        @param: data - rendered manifest or child object's to_dict()
+        @returns content hash the child was last applied with
+    """
+    annotations = data['metadata'].get('annotations') or {}
+    return annotations.get(constants.HASH_ANNOTATION)
+
+
 def mark_as_child(data):
     """
         Marks the incoming data as child of celeryapplications
@@ -0,0 +1,76 @@
+import constants
+from task_event_utils import worker_group
+
+
+def worker_pod_name(hostname):
+    """
+        Celery's default hostname is celery@<pod name>
+    """
+    return hostname.split('@', 1)[-1]
+
+
+def runs_in_deployment(hostname, deployment_name):
+    """
+        Compares the whole deployment name, a prefix test would let pool `a`
+        claim the pods of pool `a-b`
+    """
+    return bool(hostname) and worker_group(hostname) == f"celery@{deployment_name}"
+
+
+def pool_worker_load(load, deployment_name):
+    """
+        @param: load - worker hostname -> tasks in flight, of all workers
+        @returns the load of the workers running in a deployment's pods
+    """
+    return {
+        hostname: tasks for hostname, tasks in load.items()
+        if runs_in_deployment(hostname, deployment_name)
+    }
+
+
+def pick_workers_to_drain(load, count, exclude=()):
+    """
+        Least busy workers first, workers that didn't answer the inspection last
+        @returns hostnames of up to count workers
+    """
+    candidates = [hostname for hostname in load if hostname not in exclude]
+    candidates.sort(key=lambda hostname: (load[hostname] is None, load[hostname] or 0, hostname))
+    return candidates[:count]
+
+
+def pick_workers_to_restore(load, workers, count):
+    """
+        Busiest drained workers first, the idle ones finish the drain sooner
+        @param: load - worker hostname -> tasks in flight or None
+        @returns hostnames of up to count of the drained workers
+    """
+    keep = pick_workers_to_drain(
+        {hostname: (load or {}).get(hostname) for hostname in workers},
+        max(len(workers) - count, 0)
+    )
+    return [hostname for hostname in workers if hostname not in keep]
+
+
+def busy_workers(load, workers):
+    """
+        Workers still running tasks. Unknown load counts as busy, a worker
+        gone from flower as done
+    """
+    if load is None:
+        return list(workers)
+    return [
+        hostname for hostname in workers
+        if hostname in load and load[hostname] != 0
+    ]
+
+
+def set_pod_deletion_cost(core_api, namespace, hostname, cost):
+    """
+        @param: cost - None removes the annotation
+    """
+    core_api.patch_namespaced_pod(
+        worker_pod_name(hostname), namespace,
+        {'metadata': {'annotations': {
+            constants.POD_DELETION_COST_ANNOTATION: None if cost is None else str(cost)
+        }}}
+    )
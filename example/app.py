@@ -1,4 +1,11 @@
-from celery import Celery
+import os
+import json
+import time
+import hashlib
+
+import redis
+from celery import Celery, bootsteps
+from celery.signals import before_task_publish, worker_ready, worker_shutting_down
 from flask import Flask
 
 
@@ -21,12 +28,143 @@ def make_celery(app):
 
 flask_app = Flask(__name__)
 flask_app.config.update(
-    CELERY_BROKER_URL='redis://redis-master/1',
-    CELERY_RESULT_BACKEND='redis://redis-master/1'
+    CELERY_BROKER_URL=os.environ.get('CELERY_BROKER_URL', 'redis://redis-master/1'),
+    CELERY_RESULT_BACKEND=os.environ.get('CELERY_RESULT_BACKEND', 'redis://redis-master/1')
 )
 celery_app = make_celery(flask_app)
 
+# paths the operator's probes check, set when workerSpec.probes is enabled
+# with mode: files
+READY_FILE = os.environ.get('CELERY_WORKER_READY_FILE')
+HEARTBEAT_FILE = os.environ.get('CELERY_WORKER_HEARTBEAT_FILE')
+HEARTBEAT_INTERVAL = 10  # seconds
+
+# per process client of the broker, for io tasks and timing reports
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(celery_app.conf.broker_url)
+    return _redis
+
+
+@before_task_publish.connect
+def stamp_published_at(properties=None, **kwargs):
+    """
+        Lets the operator's waitTime metrics read how long the oldest
+        message of a queue has waited
+    """
+    if properties is not None:
+        properties.setdefault('timestamp', time.time())
+
+
+def touch(path):
+    with open(path, 'a'):
+        os.utime(path)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Heartbeat(bootsteps.StartStopStep):
+    """
+        Touches HEARTBEAT_FILE from the worker's timer, which stops firing
+        when the worker's event loop is wedged
+    """
+    requires = {'celery.worker.components:Timer'}
+
+    def __init__(self, worker, **kwargs):
+        self.tref = None
+
+    def start(self, worker):
+        if HEARTBEAT_FILE:
+            touch(HEARTBEAT_FILE)
+            self.tref = worker.timer.call_repeatedly(HEARTBEAT_INTERVAL, touch, (HEARTBEAT_FILE,))
+
+    def stop(self, worker):
+        if self.tref:
+            self.tref.cancel()
+            self.tref = None
+
+
+celery_app.steps['worker'].add(Heartbeat)
+
+
+@worker_ready.connect
+def mark_ready(**kwargs):
+    """
+        The worker consumes from here on
+    """
+    if READY_FILE:
+        touch(READY_FILE)
+
+
+@worker_shutting_down.connect
+def mark_not_ready(**kwargs):
+    """
+        Takes a stopping worker out of the ready count before it finishes
+        its tasks
+    """
+    if READY_FILE:
+        remove(READY_FILE)
+
+
+def report_timing(task, kind, sent_at, started_at, report_to):
+    """
+        Pushes the timings of a benchmark task to a redis list, read back by
+        benchmarks/load_harness.py
+    """
+    if not report_to:
+        return
+    get_redis().lpush(report_to, json.dumps({
+        'kind': kind,
+        'sent_at': sent_at,
+        'started_at': started_at,
+        'finished_at': time.time(),
+        'hostname': task.request.hostname
+    }))
+
 
 @celery_app.task()
 def add(a, b):
     return a + b
+
+
+@celery_app.task(bind=True, ignore_result=True)
+def cpu_task(self, iterations, payload='', sent_at=None, report_to=None):
+    """
+        CPU-bound: chains sha256 over the payload
+    """
+    started_at = time.time()
+    digest = hashlib.sha256(payload.encode()).digest()
+    for _ in range(iterations):
+        digest = hashlib.sha256(digest).digest()
+    report_timing(self, 'cpu', sent_at, started_at, report_to)
+
+
+@celery_app.task(bind=True, ignore_result=True)
+def io_task(self, round_trips, payload='', sent_at=None, report_to=None):
+    """
+        IO-bound: writes and reads the payload back from redis
+    """
+    started_at = time.time()
+    client = get_redis()
+    key = f"io-task:{self.request.id}"
+    for _ in range(round_trips):
+        client.set(key, payload)
+        client.get(key)
+    client.delete(key)
+    report_timing(self, 'io', sent_at, started_at, report_to)
+
+
+@celery_app.task(bind=True, ignore_result=True)
+def sleep_task(self, seconds, payload='', sent_at=None, report_to=None):
+    started_at = time.time()
+    time.sleep(seconds)
+    report_timing(self, 'sleep', sent_at, started_at, report_to)
@@ -1,10 +1,119 @@
-from app import add
-
-i = 0
-while True:
-    add.delay(4, 5)
-    add.delay(10, 20)
-    add.delay(100, 20)
-    i += 1
-    if i == 10000:
-        break
+"""
+    Load generator for the example app.
+
+    Without arguments, queues 30000 add tasks as fast as possible. Otherwise
+    sends a mix of task kinds with an arrival pattern, e.g. 50 tasks/sec for
+    a minute, half CPU-bound, in bursts every 10 seconds:
+        python run_task.py --mix cpu=0.5,io=0.3,sleep=0.2 --pattern burst \
+            --rate 50 --duration 60 --payload 1024
+
+    Patterns:
+        constant - evenly spaced at --rate
+        burst - --rate * --burst-every tasks at once every --burst-every seconds
+        ramp - rate grows linearly from 0 to 2 * --rate, averaging --rate
+"""
+import argparse
+import math
+import random
+import time
+
+from app import add, cpu_task, io_task, sleep_task
+
+
+PATTERNS = ('constant', 'burst', 'ramp')
+
+
+def parse_mix(mix):
+    """
+        @param: mix - kind=weight pairs, e.g. cpu=0.5,io=0.3,sleep=0.2
+        @returns [(kind, weight)]
+    """
+    pairs = []
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('add', 'cpu', 'io', 'sleep'):
+            raise ValueError(f"Unknown task kind: {kind}")
+        pairs.append((kind, float(weight or 1)))
+    return pairs
+
+
+def arrival_offsets(pattern, rate, duration, burst_every=10):
+    """
+        @returns seconds from the start at which each task is sent
+    """
+    count = int(rate * duration)
+    if pattern == 'constant':
+        return [i / rate for i in range(count)]
+    if pattern == 'burst':
+        size = max(int(rate * burst_every), 1)
+        return [(i // size) * burst_every for i in range(count)]
+    if pattern == 'ramp':
+        # rate(t) = 2 * rate * t / duration, so task i is sent at the t
+        # where rate * t^2 / duration reaches i
+        return [math.sqrt(i * duration / rate) for i in range(count)]
+    raise ValueError(f"Unknown pattern: {pattern}")
+
+
+def send_task(kind, args, payload, report_to, queue):
+    options = {'queue': queue} if queue else {}
+    kwargs = {'payload': payload, 'sent_at': time.time(), 'report_to': report_to}
+    if kind == 'add':
+        return add.apply_async((4, 5), **options)
+    if kind == 'cpu':
+        return cpu_task.apply_async((args.cpu_iterations,), kwargs, **options)
+    if kind == 'io':
+        return io_task.apply_async((args.io_round_trips,), kwargs, **options)
+    return sleep_task.apply_async((args.sleep_seconds,), kwargs, **options)
+
+
+def send_load(args, report_to=None, queue=None, seed=None):
+    """
+        Sends the configured load, blocking until the last task is sent
+        @returns number of tasks sent by kind
+    """
+    rng = random.Random(seed)
+    kinds, weights = zip(*parse_mix(args.mix))
+    payload = 'x' * args.payload
+    sent = dict.fromkeys(kinds, 0)
+
+    if not args.rate:
+        offsets = [0] * args.count
+    else:
+        offsets = arrival_offsets(args.pattern, args.rate, args.duration, args.burst_every)
+
+    started = time.monotonic()
+    for offset in offsets:
+        delay = started + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        kind = rng.choices(kinds, weights)[0]
+        send_task(kind, args, payload, report_to, queue)
+        sent[kind] += 1
+    return sent
+
+
+def add_load_arguments(parser):
+    parser.add_argument('--mix', default='add',
+                        help='task kinds and weights, e.g. cpu=0.5,io=0.3,sleep=0.2')
+    parser.add_argument('--pattern', choices=PATTERNS, default='constant')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='average tasks/sec, 0 sends --count tasks as fast as possible')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of load')
+    parser.add_argument('--count', type=int, default=30000, help='tasks sent without --rate')
+    parser.add_argument('--burst-every', type=float, default=10, help='seconds between bursts')
+    parser.add_argument('--payload', type=int, default=0, help='bytes of payload per task')
+    parser.add_argument('--cpu-iterations', type=int, default=20000,
+                        help='sha256 rounds of a cpu task')
+    parser.add_argument('--io-round-trips', type=int, default=20,
+                        help='redis set/get round trips of an io task')
+    parser.add_argument('--sleep-seconds', type=float, default=0.1,
+                        help='seconds a sleep task sleeps')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_load_arguments(parser)
+    parser.add_argument('--queue')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    print(send_load(args, queue=args.queue, seed=args.seed))
@@ -0,0 +1,174 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+
+import constants
+from metrics_utils import (
+    FLOWER_POLL_DURATION,
+    POLL_ERRORS
+)
+
+
+# One session (and so one keep-alive connection pool) for the whole operator
+_session = None
+_poll_semaphore = None
+
+# flower host -> (consecutive failures, monotonic time before which we skip it)
+_backoff = {}
+
+
+async def start_flower_session():
+    """
+        Creates the operator wide flower HTTP session.
+        Safe to call more than once.
+    """
+    global _session, _poll_semaphore
+    if _session is not None and not _session.closed:
+        return _session
+
+    connector = aiohttp.TCPConnector(
+        limit=constants.FLOWER_POOL_SIZE,
+        keepalive_timeout=constants.FLOWER_KEEPALIVE_TIMEOUT
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=constants.FLOWER_POLL_TIMEOUT,
+        connect=constants.FLOWER_POLL_CONNECT_TIMEOUT
+    )
+    _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    _poll_semaphore = asyncio.Semaphore(constants.FLOWER_MAX_CONCURRENT_POLLS)
+    return _session
+
+
+async def close_flower_session():
+    global _session, _poll_semaphore
+    if _session is not None:
+        await _session.close()
+    _session = None
+    _poll_semaphore = None
+    _backoff.clear()
+
+
+def is_backing_off(host, now=None):
+    """
+        @param: host - flower service host
+        @returns True if host failed recently and should not be polled yet
+    """
+    now = time.monotonic() if now is None else now
+    _, retry_at = _backoff.get(host, (0, 0))
+    return now < retry_at
+
+
+def record_failure(host, now=None):
+    now = time.monotonic() if now is None else now
+    failures = _backoff.get(host, (0, 0))[0] + 1
+    delay = min(
+        constants.FLOWER_BACKOFF_BASE * 2 ** (failures - 1),
+        constants.FLOWER_BACKOFF_MAX
+    )
+    # jitter so that a flapping fleet of flowers is not retried in lockstep
+    delay *= random.uniform(0.8, 1.2)
+    _backoff[host] = (failures, now + delay)
+    return failures
+
+
+def record_success(host):
+    _backoff.pop(host, None)
+
+
+async def get_flower_json(flower_svc_host, path, logger=None, method='GET', params=None):
+    """
+        Calls a flower API path using the shared session
+        @param: flower_svc_host - host:port of flower service
+        @param: path - API path, e.g. /api/queues/length
+        @param: method, params - for flower's POST control APIs
+        @returns parsed JSON body or None if flower is unavailable
+    """
+    if is_backing_off(flower_svc_host):
+        return None
+
+    session = await start_flower_session()
+    url = f"http://{flower_svc_host}{path}"
+    async with _poll_semaphore:
+        started = time.monotonic()
+        try:
+            async with session.request(method, url, params=params) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    record_success(flower_svc_host)
+                    return data
+                error = f"HTTP {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            error = repr(e)
+        finally:
+            FLOWER_POLL_DURATION.labels(path.split('?')[0]).observe(
+                time.monotonic() - started
+            )
+
+    POLL_ERRORS.labels('flower').inc()
+    failures = record_failure(flower_svc_host)
+    if logger:
+        logger.warning(
+            "Flower poll to %s failed (%s), consecutive failures: %s",
+            url, error, failures
+        )
+    return None
+
+
+async def get_flower_queue_lengths(flower_svc_host, logger=None):
+    """
+        @returns flower's active_queues list i.e. [{'name': .., 'messages': ..}]
+        or None if flower is unavailable
+    """
+    data = await get_flower_json(flower_svc_host, '/api/queues/length', logger)
+    if data is None:
+        return None
+    return data.get('active_queues')
+
+
+async def get_flower_processed_counts(flower_svc_host, logger=None):
+    """
+        @returns worker hostname -> number of tasks finished(succeeded or
+        failed) as counted from flower's event stream, or None if flower
+        is unavailable
+    """
+    data = await get_flower_json(flower_svc_host, '/dashboard?json=1', logger)
+    if data is None:
+        return None
+    return {
+        worker.get('hostname'): worker.get('task-succeeded', 0) + worker.get('task-failed', 0)
+        for worker in data.get('data', [])
+    }
+
+
+async def get_flower_worker_load(flower_svc_host, logger=None):
+    """
+        Inspects the workers through flower
+        @returns worker hostname -> number of active and reserved tasks(None
+        if the worker didn't answer the inspection), or None if flower is
+        unavailable
+    """
+    data = await get_flower_json(flower_svc_host, '/api/workers?refresh=1', logger)
+    if data is None:
+        return None
+    load = {}
+    for hostname, info in data.items():
+        if not isinstance(info, dict) or info.get('active') is None:
+            load[hostname] = None
+            continue
+        load[hostname] = len(info['active']) + len(info.get('reserved') or [])
+    return load
+
+
+async def set_flower_consumer(flower_svc_host, hostname, queue, consume, logger=None):
+    """
+        Makes a worker stop(or resume) consuming from a queue
+        @returns True if flower accepted the request
+    """
+    action = 'add-consumer' if consume else 'cancel-consumer'
+    data = await get_flower_json(
+        flower_svc_host, f"/api/worker/queue/{action}/{hostname}", logger,
+        method='POST', params={'queue': queue}
+    )
+    return data is not None
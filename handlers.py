@@ -1,25 +1,237 @@
-import os
+import time
+import asyncio
+import datetime
+import functools
 import kopf
-import kubernetes
-import requests
 import constants
+from kubernetes.client.rest import ApiException
 from math import ceil
-from collections import namedtuple
 
 from deployment_utils import (
     deploy_celery_workers,
+    deploy_warm_workers,
     deploy_flower,
-    expose_flower_service
+    expose_flower_service,
+    child_status
+)
+from models.worker_pool import (
+    worker_pools_from_spec
 )
 from update_utils import (
+    correct_child_drift,
+    get_handler_status,
     update_all_deployments,
-    update_worker_deployment,
-    update_flower_deployment
+    update_warm_worker_deployment,
+    update_worker_deployment
+)
+from k8s_utils import (
+    core_v1_api,
+    apps_v1_api,
+    custom_objects_api,
+    coordination_v1_api,
+    run_in_thread,
+    run_in_own_thread,
+    close_api_client
+)
+from flower_utils import (
+    start_flower_session,
+    close_flower_session,
+    get_flower_queue_lengths,
+    get_flower_processed_counts,
+    get_flower_worker_load,
+    set_flower_consumer
+)
+from broker_utils import (
+    queue_names_from_spec,
+    get_broker_queue_lengths,
+    get_broker_message_ages,
+    listen_for_queue_pushes,
+    close_queue_metrics_backends
+)
+from polling_utils import (
+    is_poll_due,
+    request_poll,
+    schedule_next_poll,
+    forget_polling_state
+)
+from scaling_utils import (
+    Drain,
+    get_scaling_state,
+    forget_scaling_state,
+    recommend_replicas,
+    record_scale_patch,
+    mark_activation,
+    note_scale_up,
+    is_idle_or_waking,
+    is_patch_rate_limited,
+    should_write_queue_status,
+    write_counters
+)
+from resource_metrics_utils import (
+    label_selector,
+    pod_usage,
+    resource_utilization,
+    utilization_resources
+)
+from autotune_utils import (
+    recommend_worker_settings
+)
+from rightsizing_utils import (
+    count_oom_kills,
+    evidence_status,
+    forget_rightsizing_state,
+    get_rightsizing_state,
+    list_pool_pods,
+    mark_applied,
+    recommend_resources,
+    record_usage,
+    restore_evidence,
+    should_apply,
+    status_changed
+)
+from drain_utils import (
+    busy_workers,
+    pick_workers_to_drain,
+    pick_workers_to_restore,
+    pool_worker_load,
+    runs_in_deployment,
+    set_pod_deletion_cost
 )
+from task_event_utils import (
+    consume_task_events,
+    forget_task_event_stats,
+    get_deployment_runtime,
+    get_event_processed_counts,
+    get_task_event_stats,
+    task_stats_status_if_due
+)
+from budget_utils import (
+    allocate_budgets,
+    allocate_celery_budgets,
+    allocate_pools_from_shares,
+    apply_budget_event,
+    budget_cap,
+    decode_demands,
+    encode_demands,
+    forget_demands,
+    local_celery_demands,
+    record_demand
+)
+from cache_utils import (
+    apply_watch_event,
+    forget_cached_children,
+    get_cached_child,
+    get_cached_children,
+    note_replicas
+)
+from sharding_utils import (
+    ShardedDiffBaseStorage,
+    get_ownership,
+    is_sharded,
+    maintain_shard_leases,
+    owns_resource,
+    release_all_shards,
+    sync_leases
+)
+from metrics_utils import (
+    forget_budget_metrics,
+    forget_cr_metrics,
+    record_budget,
+    record_queue_lengths,
+    record_scaling_decision,
+    record_scale_up_latency,
+    record_warm_workers,
+    record_worker_oom_kills,
+    start_metrics_server,
+    timed_handler
+)
+
+
+# lease loop of a sharded replica
+_shard_leases_task = None
+# allocation loop of the replica budgets
+_budgets_task = None
+
+
+@kopf.on.startup()
+async def startup_fn(logger, settings, **kwargs):
+    global _shard_leases_task, _budgets_task
+    start_metrics_server()
+    await start_flower_session()
+    _budgets_task = asyncio.ensure_future(allocate_replica_budgets(logger))
 
+    if is_sharded():
+        settings.persistence.diffbase_storage = ShardedDiffBaseStorage()
+        # take a share of the shards before the first events are handled
+        await run_in_thread(sync_leases, coordination_v1_api(), get_ownership(), logger)
+        _shard_leases_task = asyncio.ensure_future(maintain_shard_leases(logger))
 
-@kopf.on.create('celeryproject.org', 'v1alpha1', 'celery')
-def create_fn(spec, name, namespace, logger, **kwargs):
+
+@kopf.on.cleanup()
+async def cleanup_fn(logger, **kwargs):
+    if _budgets_task is not None:
+        _budgets_task.cancel()
+    if _shard_leases_task is not None:
+        _shard_leases_task.cancel()
+        await run_in_thread(release_all_shards, coordination_v1_api(), get_ownership(), logger)
+    await close_flower_session()
+    close_queue_metrics_backends()
+    close_api_client()
+
+
+async def create_children(api, apps_api_instance, namespace, spec, logger):
+    """
+        Creates worker deployments(one per pool, plus one per warm pool),
+        flower deployment and flower service concurrently. If any of them
+        fails, the handler is retried and children created by the earlier
+        attempt are reused.
+        @returns list of children status entries
+    """
+    pools = worker_pools_from_spec(spec)
+    warm_pools = [pool for pool in pools if pool.warm_pool]
+    results = await asyncio.gather(
+        *(
+            run_in_thread(deploy_celery_workers, apps_api_instance, namespace, spec, logger, pool)
+            for pool in pools
+        ),
+        *(
+            run_in_thread(deploy_warm_workers, apps_api_instance, namespace, spec, logger, pool)
+            for pool in warm_pools
+        ),
+        run_in_thread(deploy_flower, apps_api_instance, namespace, spec, logger),
+        run_in_thread(expose_flower_service, api, namespace, spec, logger),
+        return_exceptions=True
+    )
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        for error in errors:
+            logger.error("Child creation failed: %r", error)
+        raise kopf.TemporaryError(
+            f"{len(errors)} of {len(results)} children failed to create",
+            delay=constants.CREATE_RETRY_DELAY
+        )
+
+    *worker_deployments, flower_deployment, flower_svc = results
+    warm_deployments = worker_deployments[len(pools):]
+    return [
+        *(
+            child_status(deployment, constants.DEPLOYMENT_KIND, constants.WORKER_TYPE, pool=pool.name)
+            for pool, deployment in zip(pools, worker_deployments)
+        ),
+        *(
+            child_status(deployment, constants.DEPLOYMENT_KIND, constants.WARM_WORKER_TYPE, pool=pool.name)
+            for pool, deployment in zip(warm_pools, warm_deployments)
+        ),
+        child_status(flower_deployment, constants.DEPLOYMENT_KIND, constants.FLOWER_TYPE),
+        child_status(flower_svc, constants.SERVICE_KIND, constants.FLOWER_TYPE)
+    ]
+
+
+@kopf.on.create('celeryproject.org', 'v1alpha1', 'celery',
+                retries=constants.CREATE_RETRIES, when=owns_resource)
+@timed_handler('create')
+async def create_fn(spec, name, namespace, logger, **kwargs):
     """
         Celery custom resource creation handler
     """
@@ -27,48 +239,16 @@ def create_fn(spec, name, namespace, logger, **kwargs):
     # 1. Validation of spec
     val, err_msg = validate_spec(spec)
     if err_msg:
-        status = 'Failed validation'
         raise kopf.PermanentError(f"{err_msg}. Got {val}")
 
-    api = kubernetes.client.CoreV1Api()
-    apps_api_instance = kubernetes.client.AppsV1Api()
+    api = core_v1_api()
+    apps_api_instance = apps_v1_api()
 
-    # 2. Deployment for celery workers
-    worker_deployment = deploy_celery_workers(
-        apps_api_instance, namespace, spec, logger
+    # 2. Worker deployments, flower deployment and flower service
+    children = await create_children(
+        api, apps_api_instance, namespace, spec, logger
     )
 
-    # 3. Deployment for flower
-    flower_deployment = deploy_flower(
-        apps_api_instance, namespace, spec, logger
-    )
-
-    # 4. Expose flower service
-    flower_svc = expose_flower_service(
-        api, namespace, spec, logger
-    )
-
-    children = [
-        {
-            'name': worker_deployment.metadata.name,
-            'replicas': worker_deployment.spec.replicas,
-            'kind': constants.DEPLOYMENT_KIND,
-            'type': constants.WORKER_TYPE
-        },
-        {
-            'name': flower_deployment.metadata.name,
-            'replicas': flower_deployment.spec.replicas,
-            'kind': constants.DEPLOYMENT_KIND,
-            'type': constants.FLOWER_TYPE
-        },
-        {
-            'name': flower_svc.metadata.name,
-            'spec': flower_svc.spec.to_dict(),
-            'kind': constants.SERVICE_KIND,
-            'type': constants.FLOWER_TYPE
-        }
-    ]
-
     return {
         'children': children,
         'children_count': len(children),
@@ -76,173 +256,1035 @@ def create_fn(spec, name, namespace, logger, **kwargs):
     }
 
 
-@kopf.on.update('celeryproject.org', 'v1alpha1', 'celery')
+@kopf.on.update('celeryproject.org', 'v1alpha1', 'celery', when=owns_resource)
+@timed_handler('update')
 def update_fn(spec, status, namespace, logger, **kwargs):
-    diff = kwargs.get('diff')
-    modified_spec = get_modified_spec_object(diff)
+    api = core_v1_api()
+    apps_api_instance = apps_v1_api()
 
-    api = kubernetes.client.CoreV1Api()
-    apps_api_instance = kubernetes.client.AppsV1Api()
-    result = status.get('update_fn') or status.get('create_fn')
+    # children whose rendered manifest didn't change are left untouched
+    return update_all_deployments(
+        api, apps_api_instance, spec, status, namespace, logger
+    )
 
-    if modified_spec.common_spec:
-        # if common spec was updated, need to update all deployments
-        return update_all_deployments(
-            api, apps_api_instance, spec, status, namespace
-        )
-    else:
-        if modified_spec.worker_spec:
-            # if worker spec was updated, just update worker deployments
-            worker_deployment = update_worker_deployment(
-                apps_api_instance, spec, status, namespace
-            )
-            deployment_status = next(child for child in result.get('children') if child['type'] == constants.WORKER_TYPE)  # NOQA
 
-            deployment_status.update({
-                'name': worker_deployment.metadata.name,
-                'replicas': worker_deployment.spec.replicas
-            })
+def check_flower_label(value, spec, **_):
+    """
+        Checks if incoming label value is the one assigned to
+        flower service and deployment
+    """
+    return value == f"{spec['common']['appName']}-flower"
 
-        if modified_spec.flower_spec:
-            # if flower spec was updated, just update flower deployments
-            flower_deployment = update_flower_deployment(
-                apps_api_instance, spec, status, namespace
-            )
-            deployment_status = next(child for child in result.get('children') if child['type'] == constants.FLOWER_TYPE)  # NOQA
 
-            deployment_status.update({
-                'name': flower_deployment.metadata.name,
-                'replicas': flower_deployment.spec.replicas
-            })
-        return result
+def get_flower_svc_host(status, namespace=None, name=None):
+    """
+        Get latest flower SVC host from the child cache, falling back to
+        parent's status until the watch delivered the service
+    """
+    for child in get_cached_children(namespace, name, constants.SERVICE_KIND, constants.FLOWER_TYPE):
+        return f"{child.get('name')}:{child['spec']['ports'][0]['port']}"
+
+    handler = get_handler_status(status)
+
+    for child in handler.get('children'):
+        if child.get('kind') == constants.SERVICE_KIND and child.get('type') == constants.FLOWER_TYPE:  # NOQA
+            return f"{child.get('name')}:{child['spec']['ports'][0]['port']}"
+
+    return None
 
 
-def get_modified_spec_object(diff):
+async def poll_queue_lengths(spec, status, name, namespace, logger):
     """
-        @param: diff - arg provided by kopf when an object is updated
-        diff format - Tuple of (op, (fields tuple), old, new)
-        @returns ModifiedSpec namedtuple signifying which spec was updated
+        @returns [{'name': .., 'messages': ..}] from the configured queue
+        metrics backend or None if no source could be reached
     """
-    common_spec_checklist = ['appName', 'celeryApp', 'image']
-    celery_config_checklist = ['workerSpec']
-    flower_config_checklist = ['flowerSpec']
+    queue_metrics = spec.get('queueMetrics') or {}
+    if queue_metrics.get('backend') == constants.QUEUE_METRICS_BROKER:
+        queue_lengths = await get_broker_queue_lengths(
+            queue_metrics['brokerUrl'], queue_names_from_spec(spec), logger
+        )
+        if queue_lengths is not None:
+            return queue_lengths
+        # fall back to flower below
 
-    common_spec_modified = False
-    celery_spec_modified = False
-    flower_spec_modified = False
+    flower_svc_host = get_flower_svc_host(status, namespace, name)
+    if not flower_svc_host:
+        return None
 
-    # TODO - Optimize this loop maybe
-    for op, fields, old, new in diff:
-        if any(field in fields for field in common_spec_checklist):
-            common_spec_modified = True
-        if any(field in fields for field in celery_config_checklist):
-            celery_spec_modified = True
-        if any(field in fields for field in flower_config_checklist):
-            flower_spec_modified = True
+    return await get_flower_queue_lengths(flower_svc_host, logger)
 
-    # a namedtuple to give structure to which spec was updated
-    ModifiedSpec = namedtuple('ModifiedSpec', ['common_spec', 'worker_spec', 'flower_spec'])
 
-    return ModifiedSpec(
-        common_spec=common_spec_modified,
-        worker_spec=celery_spec_modified,
-        flower_spec=flower_spec_modified
+def uses_metric_type(spec, *target_types):
+    """
+        Checks if any worker pool scales on one of the metric target types
+    """
+    return any(
+        metric.get('target', {}).get('type') in target_types
+        for pool in worker_pools_from_spec(spec) if pool.scaling_target
+        for metric in pool.scaling_target.get('metrics', [])
     )
 
 
-def check_flower_label(value, spec, **_):
+def needs_throughput(spec):
     """
-        Checks if incoming label value is the one assigned to
-        flower service and deployment
+        Checks if any worker pool sizes replicas by drain or wait time
     """
-    return value == f"{spec['common']['appName']}-flower"
+    return uses_metric_type(
+        spec, constants.METRIC_TARGET_DRAIN_TIME, constants.METRIC_TARGET_WAIT_TIME
+    )
 
 
-def get_flower_svc_host(status):
+async def poll_message_ages(spec, logger):
     """
-        Get latest flower SVC host from parent's status
+        @returns queue name -> seconds its oldest message waited, for
+        waitTime metrics read from the broker, or None
     """
-    handler = status.get('update_fn') or status.get('create_fn')
+    queue_metrics = spec.get('queueMetrics') or {}
+    if queue_metrics.get('backend') != constants.QUEUE_METRICS_BROKER or \
+            not uses_metric_type(spec, constants.METRIC_TARGET_WAIT_TIME):
+        return None
+    return await get_broker_message_ages(
+        queue_metrics['brokerUrl'], queue_names_from_spec(spec), logger
+    )
 
-    for child in handler.get('children'):
-        if child.get('kind') == constants.SERVICE_KIND and child.get('type') == constants.FLOWER_TYPE:  # NOQA
-            return f"{child.get('name')}:{child['spec']['ports'][0]['port']}"
 
-    return None
+@kopf.timer('celeryproject.org', 'v1alpha1', 'celery',
+            initial_delay=5, interval=constants.POLL_BASE_INTERVAL)
+@timed_handler('message_queue_length')
+async def message_queue_length(spec, status, name, namespace, logger, patch, **kwargs):
+    """
+        Polls queue lengths and runs an autoscaling evaluation whenever a poll
+        is due, so that stabilization windows elapse even when queues stay
+        flat. How often polls are due adapts to the backlog, see polling_utils
+    """
+    # timers and daemons run on every replica, filtering them with `when`
+    # would make replicas fight over kopf's finalizer
+    if not owns_resource(namespace, name):
+        return
+    if not is_poll_due(namespace, name):
+        # cold scale up latency is measured on every tick
+        await progress_warm_pools(spec, name, namespace, status, logger)
+        return
 
+    queue_lengths = await poll_queue_lengths(spec, status, name, namespace, logger)
+    if queue_lengths is None:
+        # source unreachable, leave the last status and replicas intact
+        schedule_next_poll(namespace, name, spec, 0)
+        return
 
-@kopf.timer('celeryproject.org', 'v1alpha1', 'celery',
-            initial_delay=5, interval=10, idle=10)
-def message_queue_length(spec, status, **kwargs):
-    flower_svc_host = get_flower_svc_host(status)
+    schedule_next_poll(
+        namespace, name, spec,
+        get_current_queue_len(queue_names_from_spec(spec), queue_lengths)
+    )
+    record_queue_lengths(namespace, name, queue_lengths)
+
+    processed_counts = None
+    if needs_throughput(spec):
+        processed_counts = await poll_processed_counts(status, name, namespace, logger)
+
+    message_ages = await poll_message_ages(spec, logger)
+
+    autoscale_status = await run_in_thread(
+        horizontal_autoscale, spec, name, namespace, queue_lengths,
+        processed_counts, logger, message_ages=message_ages
+    )
+    await progress_drains(spec, name, namespace, status, logger)
+    await progress_warm_pools(spec, name, namespace, status, logger)
+
+    write_status = should_write_queue_status(
+        namespace, name, status.get('message_queue_length'), queue_lengths
+    )
+    if autoscale_status:
+        if write_status or replicas_by_deployment(autoscale_status) != \
+                replicas_by_deployment(status.get('horizontal_autoscale')):
+            patch.setdefault('status', {})['horizontal_autoscale'] = autoscale_status
+
+    task_events = task_stats_status_if_due(namespace, name)
+    if task_events:
+        patch.setdefault('status', {})['task_events'] = task_events
+
+    logger.debug("Autoscaling API writes: %s", dict(write_counters))
+    # None leaves status.message_queue_length untouched
+    return queue_lengths if write_status else None
+
+
+async def poll_processed_counts(status, name, namespace, logger):
+    """
+        @returns worker hostname -> tasks finished, from the task event
+        consumer if it runs, otherwise from flower, or None
+    """
+    processed_counts = get_event_processed_counts(namespace, name)
+    if processed_counts is not None:
+        return processed_counts
+
+    flower_svc_host = get_flower_svc_host(status, namespace, name)
     if not flower_svc_host:
-        return
+        return None
+    return await get_flower_processed_counts(flower_svc_host, logger)
 
-    url = f"http://{flower_svc_host}/api/queues/length"
-    response = requests.get(url=url)
-    if response.status_code == 200:
-        return response.json().get('active_queues')
 
+def replicas_by_deployment(autoscale_status):
     return {
-        "queue_length": 0
+        decision.get('deploymentName'): decision.get('updated_num_of_replicas')
+        for decision in autoscale_status or []
+        if isinstance(decision, dict)
     }
 
 
-def get_current_replicas(child_name, status):
-    children = status.get('create_fn').get('children')
-    for child in children:
-        if child.get('name') == child_name:
-            return child.get('replicas')
-
-
-def get_current_queue_len(child_name, status):
-    for queue in status.get('message_queue_length', []):
-        if queue.get('name') == child_name:
-            return queue.get('messages')
-
-    return 0
-
-
-@kopf.on.field('celeryproject.org', 'v1alpha1', 'celery',
-               field='status.message_queue_length')
-def horizontal_autoscale(spec, status, namespace, **kwargs):
-    worker_deployment_name = f"{spec['common']['appName']}-celery-worker"
-    current_replicas = get_current_replicas(worker_deployment_name, status)
-    updated_num_of_replicas = current_replicas
-    scaling_targets = spec['scaleTargetRef']
-    for scaling_target in scaling_targets:
-        # For now we only support 1 i.e message queue length
-        if scaling_target.get('kind') == 'worker':
-            min_replicas = scaling_target.get('minReplicas', spec['workerSpec']['numOfWorkers'])
-            max_replicas = scaling_target.get('maxReplicas')
-            queue_name = spec['workerSpec']['queues']
-            current_queue_length = get_current_queue_len(queue_name, status)
-            avg_queue_length = scaling_target['metrics'][0].get('target').get('averageValue')
-            updated_num_of_replicas = min(
-                max(
-                    ceil(
-                        current_replicas * (current_queue_length / avg_queue_length)
-                    ),
-                    min_replicas
-                ),
-                max_replicas
-            )
+def get_current_replicas(apps_api_instance, deployment_name, namespace):
+    cached = get_cached_child(namespace, constants.DEPLOYMENT_KIND, deployment_name)
+    if cached is not None:
+        return cached['replicas']
+
+    scale = apps_api_instance.read_namespaced_deployment_scale(
+        deployment_name, namespace
+    )
+    return scale.spec.replicas or 0
+
+
+def get_pool_usage(metrics_api, pool, namespace, logger=None):
+    """
+        Reads the worker pods' usage from the resource metrics API
+        @returns resource name -> usage of every pod, or None
+    """
+    try:
+        pod_metrics = (metrics_api or custom_objects_api()).list_namespaced_custom_object(
+            'metrics.k8s.io', 'v1beta1', namespace, 'pods',
+            label_selector=label_selector(pool.labels)
+        )
+    except ApiException as e:
+        # e.g. no metrics-server, queue metrics still apply
+        if logger:
+            logger.warning("Pod metrics of %s unavailable: %r", pool.deployment_name, e)
+        return None
+    return pod_usage(pod_metrics)
+
+
+def get_pool_utilization(metrics_api, pool, namespace, logger=None):
+    """
+        Only for pools with utilization metrics
+        @returns resource name -> (percent, pods measured) or None
+    """
+    resources = utilization_resources(pool.scaling_target)
+    if not resources:
+        return None
+
+    usage = get_pool_usage(metrics_api, pool, namespace, logger)
+    if usage is None:
+        return None
+    return resource_utilization(
+        usage, (pool.resources or {}).get('requests') or {}, resources
+    )
+
+
+def get_current_queue_len(queue_names, queue_lengths):
+    return sum(
+        queue.get('messages') or 0
+        for queue in queue_lengths if queue.get('name') in queue_names
+    )
+
+
+def get_oldest_message_age(queue_names, message_ages):
+    ages = [age for queue, age in (message_ages or {}).items() if queue in queue_names]
+    return max(ages) if ages else None
+
+
+def get_processed_total(deployment_name, processed_counts):
+    """
+        Sums processed counts of the workers running in a deployment's pods,
+        celery's default hostname is celery@<pod name>
+    """
+    if processed_counts is None:
+        return None
+    return sum(
+        count for hostname, count in processed_counts.items()
+        if runs_in_deployment(hostname, deployment_name)
+    )
+
+
+def horizontal_autoscale(spec, name, namespace, queue_lengths,
+                         processed_counts=None, logger=None,
+                         apps_api_instance=None, now=None, metrics_api=None,
+                         message_ages=None):
+    """
+        Sizes every autoscaled worker pool for the latest queue length sample
+        @param: queue_lengths - [{'name': .., 'messages': ..}] of the broker
+        @param: processed_counts - worker hostname -> processed tasks, for
+            drainTime and waitTime
+        @param: message_ages - queue name -> oldest message age, for waitTime
+        @param: apps_api_instance, now, metrics_api - injectable for offline simulation
+        @returns list of scaling decisions or None if no pool is autoscaled
+    """
+    apps_api_instance = apps_api_instance or apps_v1_api()
+    priority_weight = spec.get('priorityWeight', constants.BUDGET_DEFAULT_WEIGHT)
+
+    decisions = [
+        autoscale_worker_pool(
+            pool, name, namespace, queue_lengths, processed_counts,
+            logger, apps_api_instance, now, metrics_api, message_ages,
+            priority_weight
+        )
+        for pool in worker_pools_from_spec(spec) if pool.scaling_target
+    ]
+    return decisions or None
+
+
+def autoscale_worker_pool(pool, name, namespace, queue_lengths, processed_counts,
+                          logger, apps_api_instance, now, metrics_api=None,
+                          message_ages=None, priority_weight=constants.BUDGET_DEFAULT_WEIGHT):
+    """
+        Sizes one worker pool's deployment on its own queues' depth and,
+        if targeted, the CPU/memory utilization of its pods. Under a replica
+        budget, the recommendation is the pool's demand and the replicas
+        applied are capped at its allocation, see allocate_replica_budgets
+        @returns status of the scaling decision
+    """
+    scaling_target = pool.scaling_target
+    min_replicas = scaling_target.get('minReplicas', pool.replicas)
+    current_replicas = get_current_replicas(
+        apps_api_instance, pool.deployment_name, namespace
+    )
+    current_queue_length = get_current_queue_len(pool.queue_names, queue_lengths)
+    state = get_scaling_state(namespace, name, pool.name)
+    updated_num_of_replicas, details = recommend_replicas(
+        state,
+        scaling_target,
+        current_replicas,
+        current_queue_length,
+        processed_total=get_processed_total(pool.deployment_name, processed_counts),
+        now=now,
+        min_replicas=min_replicas,
+        utilization=get_pool_utilization(metrics_api, pool, namespace, logger),
+        oldest_message_age=get_oldest_message_age(pool.queue_names, message_ages),
+        ready_replicas=get_ready_replicas(pool.deployment_name, namespace, apps_api_instance)
+    )
+
+    budget_replicas = budget_cap(namespace, pool.deployment_name, current_replicas, min_replicas)
+    if budget_replicas is not None:
+        record_demand(
+            namespace, name, pool.deployment_name, priority_weight,
+            min_replicas, updated_num_of_replicas, now
+        )
+        details['demanded_replicas'] = updated_num_of_replicas
+        details['budget_replicas'] = budget_replicas
+        updated_num_of_replicas = min(updated_num_of_replicas, budget_replicas)
+
+    updated_num_of_replicas = apply_replicas(
+        apps_api_instance, pool, namespace, state,
+        current_replicas, updated_num_of_replicas, logger, now
+    )
+
+    decision = {
+        'deploymentName': pool.deployment_name,
+        'pool': pool.name,
+        'updated_num_of_replicas': updated_num_of_replicas,
+        **details
+    }
+    if state.drain is not None:
+        decision['draining_to'] = state.drain.target_replicas
+    if state.scale_up is not None:
+        decision['warm_workers'] = len(state.scale_up.warm_workers)
+    record_scaling_decision(
+        namespace, name, pool.deployment_name, current_replicas, decision
+    )
+    return decision
+
+
+def apply_replicas(apps_api_instance, pool, namespace, state,
+                   current_replicas, updated_num_of_replicas, logger, now=None):
+    """
+        Patches a pool's deployment to the recommended replicas unless that's
+        a no-op or the pool was patched too recently. With gracefulScaleDown
+        a scale down starts a drain instead, see progress_drain
+        @returns replicas the deployment is left with
+    """
+    now = time.monotonic() if now is None else now
+    if state.drain is not None:
+        if updated_num_of_replicas >= current_replicas:
+            # load came back, progress_drain puts the workers back to work
+            state.drain.cancelled = True
+        else:
+            # progress_drain restores the workers drained beyond a raised target
+            state.drain.target_replicas = updated_num_of_replicas
+        return current_replicas
+
+    if updated_num_of_replicas == current_replicas:
+        write_counters['scale_patches_skipped_noop'] += 1
+        return current_replicas
+
+    if is_patch_rate_limited(state, now, current_replicas):
+        # try again on a later tick
+        write_counters['scale_patches_rate_limited'] += 1
+        return current_replicas
 
+    if updated_num_of_replicas < current_replicas and \
+            pool.scaling_target.get('gracefulScaleDown') is not None:
+        state.drain = Drain(target_replicas=updated_num_of_replicas, started_at=now)
+        write_counters['scale_downs_drained'] += 1
+        return current_replicas
+
+    return patch_replicas(
+        apps_api_instance, pool, namespace, state,
+        current_replicas, updated_num_of_replicas, logger, now
+    )
+
+
+def patch_replicas(apps_api_instance, pool, namespace, state,
+                   current_replicas, updated_num_of_replicas, logger, now=None):
     patch_body = {
         "spec": {
             "replicas": updated_num_of_replicas,
         }
     }
+    apps_api_instance.patch_namespaced_deployment(
+        pool.deployment_name, namespace, patch_body
+    )
+    note_replicas(namespace, pool.deployment_name, updated_num_of_replicas)
+    write_counters['scale_patches'] += 1
+    record_scale_patch(state, current_replicas, updated_num_of_replicas, now)
+    if pool.warm_pool:
+        note_scale_up(
+            state, current_replicas, updated_num_of_replicas,
+            time.monotonic() if now is None else now
+        )
+    if logger:
+        logger.info(
+            "Scaled %s from %s to %s replicas",
+            pool.deployment_name, current_replicas, updated_num_of_replicas
+        )
+    return updated_num_of_replicas
+
+
+async def progress_drains(spec, name, namespace, status, logger, now=None):
+    flower_svc_host = get_flower_svc_host(status, namespace, name)
+    for pool in worker_pools_from_spec(spec):
+        state = get_scaling_state(namespace, name, pool.name)
+        if state.drain is None:
+            continue
+        try:
+            await progress_drain(pool, state, flower_svc_host, namespace, logger, now)
+        except Exception as e:
+            logger.warning("Drain of %s failed: %r", pool.deployment_name, e)
 
-    apps_api_instance = kubernetes.client.AppsV1Api()
-    updated_deployment = apps_api_instance.patch_namespaced_deployment(
-        worker_deployment_name, namespace, patch_body
+
+async def progress_drain(pool, state, flower_svc_host, namespace, logger, now=None):
+    """
+        Moves a graceful scale down on by one step:
+        1. picks the least busy workers and gives their pods a low
+           pod-deletion-cost, so the ReplicaSet removes those pods
+        2. cancels their queue consumers, so they stop taking new tasks
+        3. once they're idle or drainTimeoutSeconds passed, shrinks the
+           deployment
+        Without flower, the deployment is shrunk right away. If a later
+        evaluation raised the target, the workers drained beyond it consume
+        again
+    """
+    now = time.monotonic() if now is None else now
+    drain = state.drain
+    if drain.cancelled:
+        await restore_drained_workers(pool, drain.workers, flower_svc_host, namespace, logger)
+        state.drain = None
+        return
+
+    load = None
+    if flower_svc_host:
+        load = await get_flower_worker_load(flower_svc_host, logger)
+    if load is not None:
+        load = pool_worker_load(load, pool.deployment_name)
+
+    surplus = len(drain.workers) - (state.current_replicas - drain.target_replicas)
+    if surplus > 0:
+        restored = pick_workers_to_restore(load, drain.workers, surplus)
+        await restore_drained_workers(pool, restored, flower_svc_host, namespace, logger)
+        drain.workers = [hostname for hostname in drain.workers if hostname not in restored]
+
+    if load is not None:
+        missing = state.current_replicas - drain.target_replicas - len(drain.workers)
+        workers = pick_workers_to_drain(load, max(missing, 0), exclude=drain.workers)
+        for hostname in workers:
+            await run_in_thread(
+                set_pod_deletion_cost, core_v1_api(), namespace, hostname,
+                constants.DRAINED_POD_DELETION_COST
+            )
+            for queue in pool.queue_names:
+                await set_flower_consumer(flower_svc_host, hostname, queue, False, logger)
+        drain.workers.extend(workers)
+        if workers:
+            logger.info("Draining %s of %s", workers, pool.deployment_name)
+            return
+
+    timeout = pool.scaling_target['gracefulScaleDown'].get(
+        'drainTimeoutSeconds', constants.DRAIN_TIMEOUT
     )
+    busy = busy_workers(load, drain.workers)
+    if busy and now - drain.started_at < timeout:
+        return
+    if busy:
+        logger.warning(
+            "Drain of %s timed out, %s still busy", pool.deployment_name, busy
+        )
 
-    return {
-        'deploymentName': updated_deployment.metadata.name,
-        'updated_num_of_replicas': updated_num_of_replicas
+    state.drain = None
+    await run_in_thread(
+        patch_replicas, apps_v1_api(), pool, namespace, state,
+        state.current_replicas, drain.target_replicas, logger, now
+    )
+
+
+async def restore_drained_workers(pool, workers, flower_svc_host, namespace, logger):
+    for hostname in workers:
+        try:
+            await run_in_thread(set_pod_deletion_cost, core_v1_api(), namespace, hostname, None)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        if flower_svc_host:
+            for queue in pool.queue_names:
+                await set_flower_consumer(flower_svc_host, hostname, queue, True, logger)
+    if workers:
+        logger.info("Drained workers %s of %s consume again", workers, pool.deployment_name)
+
+
+def get_ready_replicas(deployment_name, namespace, apps_api_instance=None):
+    deployment = get_cached_child(namespace, constants.DEPLOYMENT_KIND, deployment_name)
+    if deployment is not None:
+        return deployment['readyReplicas']
+    return (apps_api_instance or apps_v1_api()).read_namespaced_deployment_status(
+        deployment_name, namespace
+    ).status.ready_replicas or 0
+
+
+async def progress_warm_pools(spec, name, namespace, status, logger):
+    flower_svc_host = get_flower_svc_host(status, namespace, name)
+    for pool in worker_pools_from_spec(spec):
+        state = get_scaling_state(namespace, name, pool.name)
+        if state.scale_up is None:
+            continue
+        if not pool.warm_pool:
+            # warm pool removed from the spec, its deployment goes with it
+            state.scale_up = None
+            continue
+        try:
+            await progress_warm_pool(pool, state, flower_svc_host, name, namespace, logger)
+        except Exception as e:
+            logger.warning("Warm pool of %s failed: %r", pool.deployment_name, e)
+
+
+async def progress_warm_pool(pool, state, flower_svc_host, name, namespace, logger):
+    """
+        Covers a scale up with warm workers until its pods are ready:
+        1. adds the pool's queue consumers to as many standby workers as
+           replicas are still missing, up to the warm pool's size
+        2. once the deployment has the replicas ready, cancels them again,
+           so the warm workers go back to standby for the next scale up
+        Records the latency of both paths
+    """
+    scale_up = state.scale_up
+    ready_replicas = await run_in_thread(get_ready_replicas, pool.deployment_name, namespace)
+    if ready_replicas >= scale_up.target_replicas:
+        if not scale_up.lowered:
+            record_scale_up_latency(
+                namespace, name, pool.deployment_name, 'cold',
+                time.monotonic() - scale_up.started_at
+            )
+        await release_warm_workers(pool, scale_up.warm_workers, flower_svc_host, logger)
+        state.scale_up = None
+        record_warm_workers(namespace, name, pool.deployment_name, 0)
+        return
+
+    missing = min(scale_up.target_replicas - ready_replicas, pool.warm_pool.get(
+        'size', constants.WARM_POOL_SIZE
+    )) - len(scale_up.warm_workers)
+    if missing <= 0 or not flower_svc_host:
+        return
+    load = await get_flower_worker_load(flower_svc_host, logger)
+    if load is None:
+        return
+
+    standby = {
+        hostname: tasks
+        for hostname, tasks in pool_worker_load(load, pool.warm_deployment_name).items()
+        # workers not answering the inspection wouldn't take consumers either
+        if tasks is not None
     }
+    workers = pick_workers_to_drain(standby, missing, exclude=scale_up.warm_workers)
+    for hostname in workers:
+        for queue in pool.queue_names:
+            await set_flower_consumer(flower_svc_host, hostname, queue, True, logger)
+    if not workers:
+        return
+
+    scale_up.warm_workers.extend(workers)
+    if scale_up.activated_at is None:
+        scale_up.activated_at = time.monotonic()
+        record_scale_up_latency(
+            namespace, name, pool.deployment_name, 'warm',
+            scale_up.activated_at - scale_up.started_at
+        )
+    record_warm_workers(namespace, name, pool.deployment_name, len(scale_up.warm_workers))
+    logger.info("Activated warm workers %s for %s", workers, pool.deployment_name)
+
+
+async def release_warm_workers(pool, workers, flower_svc_host, logger):
+    if not flower_svc_host:
+        return
+    for hostname in workers:
+        for queue in pool.queue_names:
+            await set_flower_consumer(flower_svc_host, hostname, queue, False, logger)
+    if workers:
+        logger.info("Warm workers %s of %s back on standby", workers, pool.deployment_name)
+
+
+def scale_to_zero_pools(spec):
+    return [
+        pool for pool in worker_pools_from_spec(spec)
+        if pool.scaling_target and pool.scaling_target.get('scaleToZero') is not None
+    ]
+
+
+def activate_worker_pool(pool, name, namespace, queue_length, logger):
+    """
+        Wakes a pool up from zero replicas without waiting for the next
+        autoscaling tick
+    """
+    apps_api_instance = apps_v1_api()
+    state = get_scaling_state(namespace, name, pool.name)
+    mark_activation(state, time.monotonic())
+
+    average_value = next((
+        metric['target']['averageValue']
+        for metric in pool.scaling_target.get('metrics', [])
+        if metric.get('target', {}).get('averageValue')
+    ), None)
+    replicas = ceil(queue_length / average_value) if average_value else 1
+    replicas = min(max(replicas, 1), pool.scaling_target['maxReplicas'])
+
+    apply_replicas(apps_api_instance, pool, namespace, state, 0, replicas, logger)
+
+
+def report_activation(pool, name, namespace, logger):
+    """
+        Once a woken up pool has a ready worker, records the time from the
+        first queued message seen to the first consumer in the CR status
+    """
+    state = get_scaling_state(namespace, name, pool.name)
+    if not get_ready_replicas(pool.deployment_name, namespace):
+        return
+
+    wake_up_seconds = round(time.monotonic() - state.activation_started_at, 2)
+    state.activation_started_at = None
+    logger.info(
+        "Worker pool %s woke up from zero in %ss",
+        pool.deployment_name, wake_up_seconds
+    )
+    custom_objects_api().patch_namespaced_custom_object(
+        'celeryproject.org', 'v1alpha1', namespace, 'celery', name,
+        {'status': {'scale_to_zero': {pool.deployment_name: {
+            'lastWakeUpSeconds': wake_up_seconds,
+            'lastWakeUpAt': datetime.datetime.utcnow().isoformat() + 'Z'
+        }}}}
+    )
+
+
+@kopf.daemon('celeryproject.org', 'v1alpha1', 'celery', cancellation_timeout=5)
+async def scale_from_zero_activator(spec, status, name, namespace, logger, stopped, **kwargs):
+    """
+        Probes queues of pools scaled to zero at a short interval and wakes
+        them up as soon as messages appear
+    """
+    while not stopped:
+        pools = [
+            pool for pool in scale_to_zero_pools(spec)
+            if is_idle_or_waking(get_scaling_state(namespace, name, pool.name))
+        ] if owns_resource(namespace, name) else []
+        if not pools:
+            await asyncio.sleep(constants.ACTIVATOR_IDLE_INTERVAL)
+            continue
+
+        queue_lengths = await poll_queue_lengths(spec, status, name, namespace, logger) or []
+        for pool in pools:
+            state = get_scaling_state(namespace, name, pool.name)
+            queue_length = get_current_queue_len(pool.queue_names, queue_lengths)
+            try:
+                if state.current_replicas == 0 and queue_length > 0:
+                    await run_in_thread(
+                        activate_worker_pool, pool, name, namespace, queue_length, logger
+                    )
+                    if state.scale_up is not None:
+                        # warm workers take the queue while the pool wakes up
+                        await progress_warm_pool(
+                            pool, state, get_flower_svc_host(status, namespace, name),
+                            name, namespace, logger
+                        )
+                if state.activation_started_at is not None and state.current_replicas:
+                    await run_in_thread(report_activation, pool, name, namespace, logger)
+            except Exception as e:
+                logger.warning("Scale from zero of %s failed: %r", pool.deployment_name, e)
+
+        await asyncio.sleep(min(
+            pool.scaling_target['scaleToZero'].get(
+                'activationPollSeconds', constants.ACTIVATOR_POLL_INTERVAL
+            )
+            for pool in pools
+        ))
+
+
+def wants_queue_pushes(spec, **_):
+    """
+        Daemon filter, the same on every replica so it doesn't touch
+        ownership, see message_queue_length
+    """
+    return bool(
+        (spec.get('polling') or {}).get('push') and
+        (spec.get('queueMetrics') or {}).get('brokerUrl')
+    )
+
+
+@kopf.daemon('celeryproject.org', 'v1alpha1', 'celery',
+             cancellation_timeout=5, when=wants_queue_pushes)
+async def queue_push_listener(spec, name, namespace, logger, stopped, **kwargs):
+    """
+        With spec.polling.push, listens for messages pushed to the workers'
+        queues on a redis broker and triggers a scaling evaluation right away
+        instead of waiting for the next due poll. Async, so CRs this replica
+        doesn't own wait on the event loop, and the subscription gets a
+        thread of its own instead of one of kopf's sync handler threads
+    """
+    def push_config():
+        # spec is kept up to date by kopf while the daemon runs
+        if not owns_resource(namespace, name) or not wants_queue_pushes(spec):
+            return None
+        return spec['queueMetrics']['brokerUrl'], tuple(queue_names_from_spec(spec))
+
+    while not stopped:
+        config = push_config()
+        if not config:
+            await asyncio.sleep(constants.PUSH_LISTENER_RETRY_INTERVAL)
+            continue
+
+        broker_url, queues = config
+        try:
+            # resubscribes whenever the broker, queues or ownership change
+            await run_in_own_thread(
+                listen_for_queue_pushes, broker_url, queues,
+                functools.partial(request_poll, namespace, name),
+                stopped, logger, lambda: push_config() == config,
+                name=f"push-{namespace}-{name}"
+            )
+        except Exception as e:
+            logger.warning("Queue push listener failed: %r", e)
+            await asyncio.sleep(constants.PUSH_LISTENER_RETRY_INTERVAL)
+
+
+def task_events_broker_url(spec, **_):
+    """
+        @returns broker url of spec.taskEvents, None while events are off.
+        Also the daemon filter, see wants_queue_pushes
+    """
+    task_events = spec.get('taskEvents') or {}
+    if not task_events.get('enabled'):
+        return None
+    return task_events.get('brokerUrl') or (spec.get('queueMetrics') or {}).get('brokerUrl')
+
+
+@kopf.daemon('celeryproject.org', 'v1alpha1', 'celery',
+             cancellation_timeout=5, when=task_events_broker_url)
+async def task_event_consumer(spec, name, namespace, logger, stopped, **kwargs):
+    """
+        With spec.taskEvents.enabled, consumes the Celery event stream on the
+        broker and keeps bounded task statistics for scaling, the CR status
+        and the metrics endpoint, see task_event_utils. Runs like
+        queue_push_listener, the consumer on a thread of its own
+    """
+    def broker_url():
+        return owns_resource(namespace, name) and task_events_broker_url(spec)
+
+    while not stopped:
+        url = broker_url()
+        if not url:
+            # stale stats would pass for workers that stopped finishing tasks
+            forget_task_event_stats(namespace, name)
+            await asyncio.sleep(constants.TASK_EVENTS_RETRY_INTERVAL)
+            continue
+
+        try:
+            # reconnects whenever the broker url or ownership change
+            await run_in_own_thread(
+                consume_task_events, url, get_task_event_stats(namespace, name),
+                stopped, logger, lambda: broker_url() == url,
+                name=f"events-{namespace}-{name}"
+            )
+        except Exception as e:
+            logger.warning("Task event consumer failed: %r", e)
+            await asyncio.sleep(constants.TASK_EVENTS_RETRY_INTERVAL)
+    # also when kopf stops the daemon because events were turned off
+    forget_task_event_stats(namespace, name)
+
+
+@kopf.timer('celeryproject.org', 'v1alpha1', 'celery',
+            initial_delay=constants.AUTOTUNE_INTERVAL, interval=constants.AUTOTUNE_INTERVAL)
+@timed_handler('autotune')
+async def autotune_workers(spec, status, name, namespace, logger, **kwargs):
+    """
+        Tunes concurrency and prefetch multiplier of the pools with
+        autotune.enabled from their pods' usage and task runtimes
+    """
+    if not owns_resource(namespace, name) or not get_handler_status(status):
+        return
+
+    pools = [
+        pool for pool in worker_pools_from_spec(spec, status)
+        if pool.autotuned
+    ]
+    if not pools:
+        return
+    queue_lengths = await poll_queue_lengths(spec, status, name, namespace, logger)
+    if queue_lengths is None:
+        return
+
+    for pool in pools:
+        try:
+            await autotune_worker_pool(spec, pool, name, namespace, queue_lengths, logger)
+        except Exception as e:
+            logger.warning("Autotuning of %s failed: %r", pool.deployment_name, e)
+
+
+async def autotune_worker_pool(spec, pool, name, namespace, queue_lengths, logger, now=None):
+    """
+        Applies recommend_worker_settings at most every AUTOTUNE_MIN_INTERVAL,
+        as every change rolls the pool's pods. The tuned options go to
+        status.autotune, the update and drift paths render them from there
+    """
+    now = time.monotonic() if now is None else now
+    state = get_scaling_state(namespace, name, pool.name)
+    if state.last_tuned_at is not None and now - state.last_tuned_at < constants.AUTOTUNE_MIN_INTERVAL:
+        return
+
+    usage = None
+    if get_current_queue_len(pool.queue_names, queue_lengths):
+        # only a backlog keeps every slot busy
+        usage = await run_in_thread(get_pool_usage, None, pool, namespace, logger)
+    runtime = get_deployment_runtime(namespace, name, pool.deployment_name)
+    if runtime is None and state.per_worker_rate:
+        # measured with every process busy, a replica finishes `concurrency`
+        # tasks per runtime
+        runtime = pool.concurrency / state.per_worker_rate
+
+    settings = recommend_worker_settings(pool, usage, runtime)
+    if not settings:
+        return
+    state.last_tuned_at = now
+    tuned = {
+        'concurrency': pool.concurrency,
+        'prefetchMultiplier': pool.prefetch_multiplier,
+        **settings
+    }
+
+    # status first, so a drift check in between doesn't revert the change
+    await run_in_thread(
+        custom_objects_api().patch_namespaced_custom_object,
+        'celeryproject.org', 'v1alpha1', namespace, 'celery', name,
+        {'status': {'autotune': {pool.deployment_name: tuned}}}
+    )
+    tuned_pool = pool.with_applied_settings({'autotune': {pool.deployment_name: tuned}})
+    apps_api_instance = apps_v1_api()
+    await run_in_thread(
+        update_worker_deployment, apps_api_instance, spec, tuned_pool,
+        {'name': pool.deployment_name}, namespace
+    )
+    if pool.warm_pool:
+        await run_in_thread(
+            update_warm_worker_deployment, apps_api_instance, spec, tuned_pool,
+            {'name': pool.warm_deployment_name}, namespace
+        )
+    logger.info("Autotuned %s: %s", pool.deployment_name, settings)
+
+
+@kopf.timer('celeryproject.org', 'v1alpha1', 'celery',
+            initial_delay=constants.RIGHTSIZING_INTERVAL, interval=constants.RIGHTSIZING_INTERVAL)
+@timed_handler('rightsizing')
+async def rightsize_workers(spec, status, name, namespace, logger, patch, **kwargs):
+    """
+        Watches the pods of pools with `rightsizing` for OOM kills and cpu
+        throttling, records the evidence and recommended resources in
+        status.rightsizing and, in apply mode, rolls them out
+    """
+    if not owns_resource(namespace, name) or not get_handler_status(status):
+        return
+
+    rightsizing_status = status.get('rightsizing') or {}
+    for pool in worker_pools_from_spec(spec, status):
+        if not pool.rightsizing:
+            continue
+        try:
+            pool_status = await rightsize_worker_pool(
+                spec, pool, name, namespace,
+                rightsizing_status.get(pool.deployment_name) or {}, logger
+            )
+        except Exception as e:
+            logger.warning("Rightsizing of %s failed: %r", pool.deployment_name, e)
+            continue
+        if pool_status is not None:
+            patch.setdefault('status', {}).setdefault('rightsizing', {})[pool.deployment_name] = pool_status
+
+
+async def rightsize_worker_pool(spec, pool, name, namespace, pool_status, logger, now=None):
+    """
+        @param: pool_status - the pool's entry of status.rightsizing
+        @returns the pool's new status.rightsizing entry, or None if there's
+        nothing new to write
+    """
+    now = time.monotonic() if now is None else now
+    state = get_rightsizing_state(namespace, name, pool.name)
+    restore_evidence(state, pool_status)
+
+    pods = await run_in_thread(list_pool_pods, core_v1_api(), pool, namespace)
+    kills = count_oom_kills(state, pods, pool.deployment_name)
+    if kills:
+        record_worker_oom_kills(namespace, name, pool.deployment_name, kills)
+        logger.warning(
+            "%s worker container(s) of %s were OOMKilled, memory limit %s",
+            kills, pool.deployment_name, (pool.resources.get('limits') or {}).get('memory')
+        )
+    usage = await run_in_thread(get_pool_usage, None, pool, namespace, logger)
+    if usage:
+        record_usage(state, usage, pool.resources, now)
+
+    recommended = recommend_resources(state, pool.resources, pool.rightsizing)
+    result = evidence_status(state, recommended)
+    if pool_status.get('resources'):
+        result['resources'] = pool_status['resources']
+    if pool.rightsized and recommended and should_apply(state, pool.resources, recommended, now):
+        mark_applied(state, now)
+        result['resources'] = recommended
+        # status first, the update and drift paths render the resources from it
+        await run_in_thread(
+            custom_objects_api().patch_namespaced_custom_object,
+            'celeryproject.org', 'v1alpha1', namespace, 'celery', name,
+            {'status': {'rightsizing': {pool.deployment_name: result}}}
+        )
+        state.last_status = result
+        rightsized_pool = pool.with_applied_settings(
+            {'rightsizing': {pool.deployment_name: result}}
+        )
+        apps_api_instance = apps_v1_api()
+        await run_in_thread(
+            update_worker_deployment, apps_api_instance, spec, rightsized_pool,
+            {'name': pool.deployment_name}, namespace
+        )
+        if pool.warm_pool:
+            await run_in_thread(
+                update_warm_worker_deployment, apps_api_instance, spec, rightsized_pool,
+                {'name': pool.warm_deployment_name}, namespace
+            )
+        logger.info("Rightsized %s to %s", pool.deployment_name, recommended)
+        return None
+
+    if not status_changed(state.last_status, result):
+        return None
+    state.last_status = result
+    return result
+
+
+@kopf.on.delete('celeryproject.org', 'v1alpha1', 'celery', optional=True)
+@timed_handler('delete')
+def delete_fn(name, namespace, **kwargs):
+    # children are garbage collected through owner references
+    forget_scaling_state(namespace, name)
+    forget_polling_state(namespace, name)
+    forget_cr_metrics(namespace, name)
+    forget_cached_children(namespace, name)
+    forget_task_event_stats(namespace, name)
+    forget_rightsizing_state(namespace, name)
+    forget_demands(namespace, name)
+
+
+# children created before they were labelled are read on their next drift
+# check, which also labels them
+@kopf.on.event('apps', 'v1', 'deployments', labels={constants.CHILD_LABEL: 'true'})
+def cache_deployment_event(event, body, **kwargs):
+    apply_watch_event(constants.DEPLOYMENT_KIND, event['type'], body)
+
+
+@kopf.on.event('', 'v1', 'services', labels={constants.CHILD_LABEL: 'true'})
+def cache_service_event(event, body, **kwargs):
+    apply_watch_event(constants.SERVICE_KIND, event['type'], body)
+
+
+@kopf.on.event('celeryproject.org', 'v1alpha1', 'celeryreplicabudgets')
+def cache_budget_event(event, body, **kwargs):
+    apply_budget_event(event['type'], body)
+    if event['type'] == 'DELETED':
+        forget_budget_metrics(body['metadata']['name'])
+
+
+def allocate_sharded_budgets(ownership):
+    """
+        One pass of a sharded replica: publishes the demands of the
+        resources it owns on its member lease. The replica holding
+        BUDGET_ALLOCATOR_SHARD splits every budget across the published
+        demands of all replicas. Every replica then splits the shares of its
+        resources, taken from the budgets' status, across their pools
+        @returns budget name -> status to write, only on the allocating replica
+    """
+    own_demands = local_celery_demands(owns_resource)
+    ownership.announced = {constants.BUDGET_DEMANDS_ANNOTATION: encode_demands(own_demands)}
+    summaries = {}
+    if constants.BUDGET_ALLOCATOR_SHARD in ownership.owned:
+        summaries = allocate_celery_budgets(own_demands + [
+            demand
+            for annotations in ownership.peers.values()
+            for demand in decode_demands(annotations.get(constants.BUDGET_DEMANDS_ANNOTATION))
+        ])
+    allocate_pools_from_shares()
+    return summaries
+
+
+async def allocate_replica_budgets(logger):
+    """
+        Allocation loop, runs until cancelled on cleanup. Every
+        BUDGET_INTERVAL, one pass splits each CeleryReplicaBudget across
+        the demands the autoscaling evaluations recorded since. A sharded
+        operator allocates in one replica, see allocate_sharded_budgets
+    """
+    written = {}
+    while True:
+        try:
+            ownership = get_ownership()
+            if is_sharded(ownership):
+                summaries = allocate_sharded_budgets(ownership)
+            else:
+                summaries = allocate_budgets()
+            for budget, summary in summaries.items():
+                record_budget(budget, summary)
+                if written.get(budget) != summary:
+                    await run_in_thread(
+                        custom_objects_api().patch_cluster_custom_object,
+                        'celeryproject.org', 'v1alpha1', 'celeryreplicabudgets', budget,
+                        {'status': summary}
+                    )
+                    written[budget] = summary
+        except Exception as e:
+            logger.warning("Replica budget allocation failed: %r", e)
+        await asyncio.sleep(constants.BUDGET_INTERVAL)
+
+
+@kopf.timer('celeryproject.org', 'v1alpha1', 'celery',
+            initial_delay=constants.DRIFT_CHECK_INTERVAL,
+            interval=constants.DRIFT_CHECK_INTERVAL)
+@timed_handler('correct_drift')
+async def correct_drift(spec, status, name, namespace, logger, **kwargs):
+    """
+        Re-applies children changed or deleted outside the operator. Reads
+        the child cache, so only drifted children cost an API call
+    """
+    if not owns_resource(namespace, name) or not get_handler_status(status):
+        # children not created yet
+        return
+
+    await run_in_thread(
+        correct_child_drift, core_v1_api(), apps_v1_api(), spec, namespace, logger, status
+    )
 
 
 def validate_stuff(spec):
@@ -0,0 +1,185 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import kubernetes
+import urllib3
+from kubernetes.client.rest import ApiException
+
+import constants
+from metrics_utils import (
+    record_api_call
+)
+
+
+_lock = threading.Lock()
+_api_client = None
+_apis = {}
+_executor = None
+
+
+def split_api_method(method_name):
+    """
+        patch_namespaced_deployment -> ('patch', 'deployment')
+        read_namespaced_deployment_scale -> ('read', 'deployment_scale')
+    """
+    verb, _, resource = method_name.partition('_')
+    for prefix in ('namespaced_', 'collection_namespaced_'):
+        if resource.startswith(prefix):
+            resource = resource[len(prefix):]
+    return verb, resource
+
+
+class InstrumentedApi:
+    """
+        Wraps a kubernetes API object(CoreV1Api, AppsV1Api, ...) so that
+        every call gets a timeout, idempotent calls are retried on transient
+        errors and latency is exported by verb and resource
+    """
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        method = getattr(self._api, name)
+        if name.startswith('_') or not callable(method):
+            return method
+
+        verb, resource = split_api_method(name)
+        retries = constants.K8S_RETRIES if verb in constants.K8S_RETRY_VERBS else 0
+
+        @functools.wraps(method)
+        def call(*args, **kwargs):
+            kwargs.setdefault('_request_timeout', constants.K8S_REQUEST_TIMEOUT)
+            for attempt in range(retries + 1):
+                started = time.monotonic()
+                try:
+                    result = method(*args, **kwargs)
+                except (ApiException, urllib3.exceptions.HTTPError) as e:
+                    record_api_call(verb, resource, time.monotonic() - started, error=True)
+                    transient = not isinstance(e, ApiException) or \
+                        e.status in constants.K8S_RETRY_STATUSES
+                    if not transient or attempt == retries:
+                        raise
+                    time.sleep(constants.K8S_RETRY_BACKOFF * 2 ** attempt)
+                else:
+                    record_api_call(verb, resource, time.monotonic() - started)
+                    return result
+
+        return call
+
+
+def get_api_client():
+    """
+        Operator wide ApiClient, so all handlers share one keep-alive pool.
+        Created lazily, after kopf has logged in and configured the client.
+    """
+    global _api_client
+    with _lock:
+        if _api_client is None:
+            configuration = kubernetes.client.Configuration()
+            configuration.connection_pool_maxsize = constants.K8S_POOL_SIZE
+            _api_client = kubernetes.client.ApiClient(configuration)
+        return _api_client
+
+
+def _get_api(api_cls):
+    api = _apis.get(api_cls)
+    if api is None:
+        api = _apis[api_cls] = InstrumentedApi(api_cls(get_api_client()))
+    return api
+
+
+def core_v1_api():
+    return _get_api(kubernetes.client.CoreV1Api)
+
+
+def apps_v1_api():
+    return _get_api(kubernetes.client.AppsV1Api)
+
+
+def custom_objects_api():
+    return _get_api(kubernetes.client.CustomObjectsApi)
+
+
+def coordination_v1_api():
+    return _get_api(kubernetes.client.CoordinationV1Api)
+
+
+def get_executor():
+    """
+        Thread pool for blocking API calls, sized to the connection pool
+        so calls never queue for a connection inside urllib3
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=constants.K8S_POOL_SIZE,
+                thread_name_prefix='k8s-api'
+            )
+        return _executor
+
+
+async def run_in_thread(fn, *args):
+    """
+        Runs a blocking call off the event loop, keeping kopf's context
+        vars(used by kopf.adopt) visible to it
+    """
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(context.run, fn, *args)
+    )
+
+
+def _resolve(future, result=None, error=None):
+    # the awaiting daemon may have been cancelled meanwhile
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+async def run_in_own_thread(fn, *args, name=None):
+    """
+        Runs a call that blocks for as long as a daemon lives, e.g. a broker
+        subscription, on a thread of its own. Neither kopf's executor nor
+        the API pool of run_in_thread would get the thread back until the
+        daemon stops
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            result = context.run(fn, *args)
+        except Exception as e:
+            resolution = functools.partial(_resolve, future, error=e)
+        else:
+            resolution = functools.partial(_resolve, future, result)
+        try:
+            loop.call_soon_threadsafe(resolution)
+        except RuntimeError:
+            # loop closed on operator exit
+            pass
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return await future
+
+
+def close_api_client():
+    global _api_client, _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        if _api_client is not None:
+            _api_client.rest_client.pool_manager.clear()
+        _api_client = _executor = None
+        _apis.clear()
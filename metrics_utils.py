@@ -0,0 +1,286 @@
+import asyncio
+import functools
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+import constants
+
+
+HANDLER_DURATION = Histogram(
+    'celery_operator_handler_duration_seconds',
+    'Time spent in kopf handlers',
+    ['handler']
+)
+HANDLER_ERRORS = Counter(
+    'celery_operator_handler_errors_total',
+    'Kopf handler invocations that raised',
+    ['handler']
+)
+API_CALL_DURATION = Histogram(
+    'celery_operator_kubernetes_api_duration_seconds',
+    'Kubernetes API call latency',
+    ['verb', 'resource']
+)
+API_CALL_ERRORS = Counter(
+    'celery_operator_kubernetes_api_errors_total',
+    'Kubernetes API calls that failed',
+    ['verb', 'resource']
+)
+FLOWER_POLL_DURATION = Histogram(
+    'celery_operator_flower_poll_duration_seconds',
+    'Flower API request latency',
+    ['path']
+)
+POLL_ERRORS = Counter(
+    'celery_operator_poll_errors_total',
+    'Failed queue length polls',
+    ['source']
+)
+QUEUE_LENGTH = Gauge(
+    'celery_operator_queue_length',
+    'Messages waiting in a queue as last polled',
+    ['namespace', 'name', 'queue']
+)
+DESIRED_REPLICAS = Gauge(
+    'celery_operator_desired_replicas',
+    'Replicas recommended by the metrics before stabilization and rate limits',
+    ['namespace', 'name', 'deployment']
+)
+UPDATED_REPLICAS = Gauge(
+    'celery_operator_updated_replicas',
+    'Replicas the autoscaler left the deployment with',
+    ['namespace', 'name', 'deployment']
+)
+CURRENT_REPLICAS = Gauge(
+    'celery_operator_current_replicas',
+    'Replicas of the deployment before the autoscaling evaluation',
+    ['namespace', 'name', 'deployment']
+)
+SMOOTHED_QUEUE_LENGTH = Gauge(
+    'celery_operator_smoothed_queue_length',
+    'EWMA smoothed queue length the autoscaler sized the deployment for',
+    ['namespace', 'name', 'deployment']
+)
+ESTIMATED_WAIT = Gauge(
+    'celery_operator_estimated_wait_seconds',
+    'Time a message queued now is estimated to wait, from measured throughput',
+    ['namespace', 'name', 'deployment']
+)
+SCALE_UP_LATENCY = Histogram(
+    'celery_operator_scale_up_latency_seconds',
+    'Time from a scale up decision to new consumers: warm workers activated or cold pods ready',
+    ['namespace', 'name', 'deployment', 'path'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+)
+WARM_WORKERS_ACTIVE = Gauge(
+    'celery_operator_warm_workers_active',
+    'Warm workers consuming the pool\'s queues until its new pods are ready',
+    ['namespace', 'name', 'deployment']
+)
+WORKER_OOM_KILLS = Counter(
+    'celery_operator_worker_oom_kills_total',
+    'Worker containers seen OOMKilled',
+    ['namespace', 'name', 'deployment']
+)
+BUDGET_REPLICAS = Gauge(
+    'celery_operator_budget_replicas',
+    'Autoscaled worker replicas of a replica budget',
+    ['budget', 'kind']
+)
+SCALE_EVENTS = Counter(
+    'celery_operator_scale_events_total',
+    'Replica changes applied by the autoscaler',
+    ['namespace', 'name', 'deployment', 'direction']
+)
+DRIFT_CORRECTIONS = Counter(
+    'celery_operator_drift_corrections_total',
+    'Children re-applied after they were changed or deleted outside the operator',
+    ['kind']
+)
+OWNED_SHARDS = Gauge(
+    'celery_operator_owned_shards',
+    'Shards of Celery resources this replica holds the lease of'
+)
+SHARD_HANDOFFS = Counter(
+    'celery_operator_shard_handoffs_total',
+    'Shard leases acquired or released by this replica',
+    ['direction']
+)
+
+
+class WriteCountersCollector:
+    """
+        Exports scaling_utils.write_counters, API writes made and avoided
+        by the autoscaling loop
+    """
+
+    def collect(self):
+        from scaling_utils import write_counters
+
+        family = CounterMetricFamily(
+            'celery_operator_autoscaler_writes',
+            'API writes made and avoided by the autoscaling loop',
+            labels=['write']
+        )
+        for write, count in write_counters.items():
+            family.add_metric([write], count)
+        yield family
+
+
+class TaskEventsCollector:
+    """
+        Exports the task statistics of the task event consumers, summarized
+        on scrape rather than on every event
+    """
+
+    def collect(self):
+        from task_event_utils import all_task_summaries
+
+        labels = ['namespace', 'name', 'task']
+        rates = GaugeMetricFamily(
+            'celery_operator_task_rate',
+            'Tasks/sec received or finished, averaged over the rate window',
+            labels=labels + ['event']
+        )
+        finished = CounterMetricFamily(
+            'celery_operator_tasks_finished',
+            'Tasks finished since the consumer started',
+            labels=labels + ['state']
+        )
+        runtimes = GaugeMetricFamily(
+            'celery_operator_task_runtime_seconds',
+            'Task runtime quantiles over the recent sketch windows',
+            labels=labels + ['quantile']
+        )
+        waits = GaugeMetricFamily(
+            'celery_operator_task_wait_seconds',
+            'Quantiles of the time from task sent or received to started',
+            labels=labels + ['quantile']
+        )
+        quantiles = (
+            (runtimes, '0.5', 'runtime_p50'),
+            (runtimes, '0.95', 'runtime_p95'),
+            (runtimes, '0.99', 'runtime_p99'),
+            (waits, '0.5', 'wait_p50'),
+            (waits, '0.99', 'wait_p99'),
+        )
+        for (namespace, name), tasks in all_task_summaries().items():
+            for task, summary in tasks.items():
+                task_labels = [namespace, name, task]
+                rates.add_metric(task_labels + ['received'], summary['received_per_sec'])
+                rates.add_metric(task_labels + ['finished'], summary['finished_per_sec'])
+                finished.add_metric(task_labels + ['succeeded'], summary['succeeded'])
+                finished.add_metric(task_labels + ['failed'], summary['failed'])
+                for family, quantile, key in quantiles:
+                    if summary[key] is not None:
+                        family.add_metric(task_labels + [quantile], summary[key])
+        yield from (rates, finished, runtimes, waits)
+
+
+REGISTRY.register(WriteCountersCollector())
+REGISTRY.register(TaskEventsCollector())
+
+
+def start_metrics_server():
+    start_http_server(constants.METRICS_PORT)
+
+
+def timed_handler(handler_name):
+    """
+        Records a kopf handler's latency and errors. Goes below the kopf
+        decorator so kopf still sees whether the handler is async
+    """
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with HANDLER_DURATION.labels(handler_name).time(), \
+                        HANDLER_ERRORS.labels(handler_name).count_exceptions():
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with HANDLER_DURATION.labels(handler_name).time(), \
+                        HANDLER_ERRORS.labels(handler_name).count_exceptions():
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_api_call(verb, resource, seconds, error=False):
+    API_CALL_DURATION.labels(verb, resource).observe(seconds)
+    if error:
+        API_CALL_ERRORS.labels(verb, resource).inc()
+
+
+def record_queue_lengths(namespace, name, queue_lengths):
+    for queue in queue_lengths:
+        QUEUE_LENGTH.labels(namespace, name, queue.get('name')).set(
+            queue.get('messages') or 0
+        )
+
+
+def record_scaling_decision(namespace, name, deployment, current, decision):
+    """
+        @param: decision - status dict returned for one autoscaled pool
+    """
+    updated = decision['updated_num_of_replicas']
+    CURRENT_REPLICAS.labels(namespace, name, deployment).set(current)
+    UPDATED_REPLICAS.labels(namespace, name, deployment).set(updated)
+    if decision.get('desired_replicas') is not None:
+        DESIRED_REPLICAS.labels(namespace, name, deployment).set(decision['desired_replicas'])
+    if decision.get('smoothed_queue_length') is not None:
+        SMOOTHED_QUEUE_LENGTH.labels(namespace, name, deployment).set(
+            decision['smoothed_queue_length']
+        )
+    if decision.get('estimated_wait_seconds') is not None:
+        ESTIMATED_WAIT.labels(namespace, name, deployment).set(
+            decision['estimated_wait_seconds']
+        )
+    if updated != current:
+        direction = 'up' if updated > current else 'down'
+        SCALE_EVENTS.labels(namespace, name, deployment, direction).inc()
+
+
+def record_scale_up_latency(namespace, name, deployment, path, seconds):
+    """
+        @param: path - warm or cold
+    """
+    SCALE_UP_LATENCY.labels(namespace, name, deployment, path).observe(seconds)
+
+
+def record_warm_workers(namespace, name, deployment, active):
+    WARM_WORKERS_ACTIVE.labels(namespace, name, deployment).set(active)
+
+
+def record_worker_oom_kills(namespace, name, deployment, kills):
+    WORKER_OOM_KILLS.labels(namespace, name, deployment).inc(kills)
+
+
+def record_budget(budget, summary):
+    """
+        @param: summary - status of the budget, see allocate_budgets
+    """
+    BUDGET_REPLICAS.labels(budget, 'limit').set(summary['maxReplicas'])
+    BUDGET_REPLICAS.labels(budget, 'demanded').set(summary['demandedReplicas'])
+    BUDGET_REPLICAS.labels(budget, 'allocated').set(summary['allocatedReplicas'])
+
+
+def forget_budget_metrics(budget):
+    for labels in list(BUDGET_REPLICAS._metrics):
+        if labels[0] == budget:
+            BUDGET_REPLICAS.remove(*labels)
+
+
+def forget_cr_metrics(namespace, name):
+    """
+        Drops per CR series of a deleted Celery resource
+    """
+    for metric in (QUEUE_LENGTH, DESIRED_REPLICAS, UPDATED_REPLICAS,
+                   CURRENT_REPLICAS, SMOOTHED_QUEUE_LENGTH, ESTIMATED_WAIT,
+                   SCALE_UP_LATENCY, WARM_WORKERS_ACTIVE, WORKER_OOM_KILLS,
+                   SCALE_EVENTS):
+        for labels in list(metric._metrics):
+            if labels[:2] == (namespace, name):
+                metric.remove(*labels)
@@ -0,0 +1,204 @@
+import copy
+from dataclasses import dataclass, replace
+from typing import Any, List, Optional
+
+import constants
+
+
+# Pool fields that define how the pool is autoscaled
+SCALING_FIELDS = (
+    'minReplicas', 'maxReplicas', 'metrics', 'behavior', 'smoothingAlpha',
+    'scaleToZero', 'gracefulScaleDown', 'warmPool'
+)
+
+
+@dataclass
+class WorkerPool:
+    """
+        One worker deployment. A workerSpec without `pools` is a single
+        unnamed pool, scaled by the `worker` kind scaleTargetRef
+    """
+    name: Optional[str]
+    app_name: str
+    deployment_name: str
+    queues: str
+    log_level: str
+    concurrency: int
+    pool: Optional[str]
+    prefetch_multiplier: Optional[int]
+    max_tasks_per_child: Optional[int]
+    max_memory_per_child: Optional[int]  # KiB
+    optimization: Optional[str]
+    replicas: int
+    resources: dict
+    scaling_target: Optional[dict]
+    autotune: Optional[dict]
+    rightsizing: Optional[dict]
+    probes: Optional[dict]
+    rollout: Optional[dict]
+
+    @property
+    def queue_names(self) -> List[str]:
+        return [queue.strip() for queue in self.queues.split(',') if queue.strip()]
+
+    @property
+    def labels(self) -> dict:
+        """
+            Pod labels and deployment selector of the pool
+        """
+        labels = {'app': self.app_name}
+        if self.name:
+            labels['celery-pool'] = self.name
+        return labels
+
+    @property
+    def autotuned(self) -> bool:
+        return bool((self.autotune or {}).get('enabled'))
+
+    @property
+    def rightsized(self) -> bool:
+        """
+            Resources are applied by the operator, rather than recommended.
+            Not together with autotune, which sizes concurrency to fit
+            the resources
+        """
+        return (self.rightsizing or {}).get('mode') == constants.RIGHTSIZING_APPLY and \
+            not self.autotuned
+
+    @property
+    def warm_pool(self) -> Optional[dict]:
+        return (self.scaling_target or {}).get('warmPool')
+
+    @property
+    def warm_deployment_name(self) -> str:
+        """
+            Not prefixed with deployment_name, so the pool's own worker
+            hostnames never match the warm ones
+        """
+        name = f"{self.app_name}-celery-warm-worker"
+        return f"{name}-{self.name}" if self.name else name
+
+    @property
+    def warm_labels(self) -> dict:
+        """
+            Pod labels and deployment selector of the warm pool, disjoint
+            from the pool's selector
+        """
+        labels = {'app': f"{self.app_name}-warm", constants.WARM_WORKER_LABEL: 'true'}
+        if self.name:
+            labels['celery-pool'] = self.name
+        return labels
+
+    @property
+    def standby_queue(self) -> str:
+        """
+            Queue the warm workers consume until activated, nothing is
+            published to it
+        """
+        return f"{self.warm_deployment_name}-standby"
+
+    @property
+    def warm_resources(self) -> dict:
+        """
+            warmPool.resources, or minimal requests keeping the pool's
+            limits, so an activated worker can still use them
+        """
+        resources = (self.warm_pool or {}).get('resources')
+        if resources is not None:
+            return copy.deepcopy(resources)
+        resources = copy.deepcopy(constants.WARM_POOL_RESOURCES)
+        if (self.resources or {}).get('limits'):
+            resources['limits'] = copy.deepcopy(self.resources['limits'])
+        return resources
+
+    @staticmethod
+    def from_dict(obj: Any, app_name: str, defaults: Any,
+                  scaling_target: Optional[dict]) -> 'WorkerPool':
+        assert isinstance(obj, dict)
+        name = obj.get('name')
+        deployment_name = f"{app_name}-celery-worker"
+        if name:
+            deployment_name = f"{deployment_name}-{name}"
+
+        def get(key, default=None):
+            return obj.get(key, defaults.get(key, default))
+
+        return WorkerPool(
+            name=name,
+            app_name=app_name,
+            deployment_name=deployment_name,
+            queues=get('queues', 'celery'),
+            log_level=get('logLevel', 'info'),
+            concurrency=get('concurrency', 1),
+            pool=get('pool'),
+            prefetch_multiplier=get('prefetchMultiplier'),
+            max_tasks_per_child=get('maxTasksPerChild'),
+            max_memory_per_child=get('maxMemoryPerChild'),
+            optimization=get('optimization'),
+            replicas=get('numOfWorkers', 1),
+            resources=get('resources', {}),
+            scaling_target=scaling_target,
+            autotune=get('autotune'),
+            rightsizing=get('rightsizing'),
+            probes=get('probes'),
+            rollout=get('rollout')
+        )
+
+    def with_applied_settings(self, status: Optional[dict]) -> 'WorkerPool':
+        """
+            @param: status - CR status, holding what the operator applied to
+                the pool's deployment in status.autotune and
+                status.rightsizing, by deployment name
+            @returns the pool with its tuned concurrency, prefetch
+            multiplier and resources, as far as those are switched on
+        """
+        status = status or {}
+        pool = self
+        settings = (status.get('autotune') or {}).get(self.deployment_name)
+        if settings and self.autotuned:
+            pool = replace(
+                pool,
+                concurrency=settings.get('concurrency', pool.concurrency),
+                prefetch_multiplier=settings.get('prefetchMultiplier', pool.prefetch_multiplier)
+            )
+        rightsizing = (status.get('rightsizing') or {}).get(self.deployment_name) or {}
+        if rightsizing.get('resources') and self.rightsized:
+            pool = replace(pool, resources=copy.deepcopy(rightsizing['resources']))
+        return pool
+
+
+def worker_pools_from_spec(spec: Any, status: Optional[dict] = None) -> List[WorkerPool]:
+    """
+        @param: status - CR status, for the worker options and resources
+            the operator applied to the pools' deployments
+        @returns worker pools of a celery spec. Pools inherit unset fields
+        from workerSpec and carry their own scaling target if they set
+        maxReplicas
+    """
+    app_name = spec['common']['appName']
+    worker_spec = spec['workerSpec']
+    pools = worker_spec.get('pools')
+
+    if not pools:
+        scaling_target = next((
+            target for target in spec.get('scaleTargetRef') or []
+            if target.get('kind') == 'worker'
+        ), None)
+        return [
+            WorkerPool.from_dict({}, app_name, worker_spec, scaling_target)
+            .with_applied_settings(status)
+        ]
+
+    result = []
+    for pool in pools:
+        scaling_target = None
+        if pool.get('maxReplicas'):
+            scaling_target = {
+                'kind': 'worker',
+                **{key: pool[key] for key in SCALING_FIELDS if key in pool}
+            }
+        result.append(
+            WorkerPool.from_dict(pool, app_name, worker_spec, scaling_target)
+            .with_applied_settings(status)
+        )
+    return result
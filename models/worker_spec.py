@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Any, List, TypeVar, Type, cast, Callable
+from typing import Any, List, Optional, TypeVar, Type, cast, Callable
 
 
 T = TypeVar("T")
@@ -90,15 +90,32 @@ def args_list_from_spec_params(
     celery_app: str,
     queues: str,
     loglevel: str,
-    concurrency: int
+    concurrency: int,
+    pool: Optional[str] = None,
+    prefetch_multiplier: Optional[int] = None,
+    max_tasks_per_child: Optional[int] = None,
+    max_memory_per_child: Optional[int] = None,
+    optimization: Optional[str] = None
 ) -> List[str]:
-    return [
+    args = [
         f"--app={celery_app}",
         "worker",
         f"--queues={queues}",
         f"--loglevel={loglevel}",
         f"--concurrency={concurrency}"
     ]
+    if pool:
+        args.append(f"--pool={pool}")
+    if prefetch_multiplier:
+        args.append(f"--prefetch-multiplier={prefetch_multiplier}")
+    if max_tasks_per_child:
+        args.append(f"--max-tasks-per-child={max_tasks_per_child}")
+    if max_memory_per_child:
+        args.append(f"--max-memory-per-child={max_memory_per_child}")
+    if optimization:
+        # celery worker has no long form of -O
+        args.extend(["-O", optimization])
+    return args
 
 
 def worker_spec_from_dict(s: Any) -> WorkerSpec:
@@ -0,0 +1,73 @@
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import constants
+
+
+@dataclass
+class PollingState:
+    interval: float = constants.POLL_INITIAL_INTERVAL
+    next_poll_at: float = 0
+    last_total: Optional[int] = None
+
+
+# (namespace, name) -> PollingState
+_states: Dict[Tuple[str, str], PollingState] = {}
+
+
+def get_polling_state(namespace, name):
+    return _states.setdefault((namespace, name), PollingState())
+
+
+def forget_polling_state(namespace, name):
+    _states.pop((namespace, name), None)
+
+
+def get_interval_bounds(spec):
+    polling = spec.get('polling') or {}
+    min_interval = max(
+        polling.get('minIntervalSeconds', constants.POLL_MIN_INTERVAL),
+        constants.POLL_BASE_INTERVAL
+    )
+    max_interval = max(
+        polling.get('maxIntervalSeconds', constants.POLL_MAX_INTERVAL),
+        min_interval
+    )
+    return min_interval, max_interval
+
+
+def is_poll_due(namespace, name, now=None):
+    now = time.monotonic() if now is None else now
+    return now >= get_polling_state(namespace, name).next_poll_at
+
+
+def request_poll(namespace, name):
+    """
+        Makes the next timer tick poll and evaluate scaling right away,
+        e.g. when a push notification says messages were queued
+    """
+    get_polling_state(namespace, name).next_poll_at = 0
+
+
+def schedule_next_poll(namespace, name, spec, total_queue_length, now=None):
+    """
+        Adapts the polling interval to queue dynamics: back to the minimum
+        while backlog grows, doubling while queues are flat or empty, and
+        unchanged while backlog drains
+        @returns the interval until the next poll
+    """
+    now = time.monotonic() if now is None else now
+    state = get_polling_state(namespace, name)
+    min_interval, max_interval = get_interval_bounds(spec)
+
+    if state.last_total is not None:
+        if total_queue_length > state.last_total:
+            state.interval = min_interval
+        elif total_queue_length == state.last_total:
+            state.interval = state.interval * 2
+
+    state.interval = min(max(state.interval, min_interval), max_interval)
+    state.last_total = total_queue_length
+    state.next_poll_at = now + state.interval
+    return state.interval
@@ -0,0 +1,74 @@
+import re
+from collections import defaultdict
+
+import constants
+
+
+QUANTITY_RE = re.compile(r'^([+-]?[0-9.]+(?:[eE][+-]?[0-9]+)?)([a-zA-Z]*)$')
+QUANTITY_SUFFIXES = {
+    'n': 1e-9, 'u': 1e-6, 'm': 1e-3, '': 1,
+    'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18,
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+}
+
+
+def parse_quantity(quantity):
+    """
+        Parses a kubernetes quantity e.g. 250m, 12345n, 128Mi or 1e3
+        @returns the quantity in base units(cores, bytes)
+    """
+    if isinstance(quantity, (int, float)):
+        return float(quantity)
+    match = QUANTITY_RE.match(str(quantity).strip())
+    if not match or match.group(2) not in QUANTITY_SUFFIXES:
+        raise ValueError(f"Invalid quantity: {quantity}")
+    return float(match.group(1)) * QUANTITY_SUFFIXES[match.group(2)]
+
+
+def label_selector(labels):
+    return ','.join(f"{key}={value}" for key, value in sorted(labels.items()))
+
+
+def utilization_resources(scaling_target):
+    """
+        @returns resource names of a scaling target's utilization metrics
+    """
+    return {
+        metric.get('name') for metric in scaling_target.get('metrics', [])
+        if (metric.get('target') or {}).get('type') == constants.METRIC_TARGET_UTILIZATION
+    }
+
+
+def pod_usage(pod_metrics):
+    """
+        @param: pod_metrics - PodMetricsList of the metrics.k8s.io API
+        @returns resource name -> usage of every pod, summed over containers
+    """
+    usage = defaultdict(list)
+    for pod in pod_metrics.get('items', []):
+        totals = defaultdict(float)
+        for container in pod.get('containers', []):
+            for resource, quantity in (container.get('usage') or {}).items():
+                totals[resource] += parse_quantity(quantity)
+        for resource in constants.UTILIZATION_RESOURCES:
+            usage[resource].append(totals[resource])
+    return usage
+
+
+def resource_utilization(usage, requests, resources):
+    """
+        Average utilization of the pods relative to their requests, like
+        HPA's Utilization target
+        @param: requests - resource requests of a worker container
+        @returns resource name -> (utilization percent, pods measured), a
+        resource without requests or measured pods is left out
+    """
+    utilization = {}
+    for resource in resources:
+        request = requests.get(resource)
+        pods = usage.get(resource)
+        if not request or not pods:
+            continue
+        percent = 100 * sum(pods) / (len(pods) * parse_quantity(request))
+        utilization[resource] = (round(percent, 1), len(pods))
+    return utilization
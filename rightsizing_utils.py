@@ -0,0 +1,319 @@
+import time
+import datetime
+from collections import deque
+from dataclasses import dataclass, field
+from math import ceil
+from typing import Deque, Dict, Optional, Tuple
+
+import constants
+from resource_metrics_utils import label_selector, parse_quantity
+
+
+@dataclass
+class UsageSample:
+    sampled_at: float
+    cpu: float  # cores of the busiest pod
+    memory: float  # bytes of the biggest pod
+    throttled: bool  # a pod ran at its cpu limit
+
+
+@dataclass
+class RightsizingState:
+    """
+        Per worker deployment evidence of the resources its pods need
+    """
+    samples: Deque[UsageSample] = field(default_factory=deque)
+    oom_kills: Optional[int] = None  # restored from status on the first evaluation
+    oom_kills_applied: int = 0  # oom_kills when resources were last applied
+    last_oom_kill_at: Optional[float] = None  # epoch seconds the latest kill finished at
+    oom_memory_limit: Optional[float] = None  # bytes, memory limit the latest kill hit
+    last_applied_at: Optional[float] = None
+    last_status: Optional[dict] = None  # as last written to status.rightsizing
+
+
+# (namespace, name, worker pool) -> RightsizingState
+_states: Dict[Tuple[str, str, Optional[str]], RightsizingState] = {}
+
+
+def get_rightsizing_state(namespace, name, pool=None):
+    return _states.setdefault((namespace, name, pool), RightsizingState())
+
+
+def forget_rightsizing_state(namespace, name):
+    for key in [key for key in _states if key[:2] == (namespace, name)]:
+        del _states[key]
+
+
+def resource_quantity(resources, kind, resource):
+    """
+        @param: kind - requests or limits
+        @returns cores or bytes, None if not set
+    """
+    quantity = ((resources or {}).get(kind) or {}).get(resource)
+    return parse_quantity(quantity) if quantity else None
+
+
+def format_quantity(resource, value):
+    """
+        Rounds up to 10m cores or 1Mi
+    """
+    if resource == 'cpu':
+        return f"{ceil(round(value * 100, 6)) * 10}m"
+    return f"{ceil(round(value / 2 ** 20, 6))}Mi"
+
+
+def parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value.rstrip('Z')).replace(
+        tzinfo=datetime.timezone.utc
+    ).timestamp()
+
+
+def format_timestamp(value):
+    return datetime.datetime.utcfromtimestamp(value).isoformat() + 'Z'
+
+
+def restore_evidence(state, pool_status):
+    """
+        Picks the OOM kill count up where status.rightsizing left it, so
+        kills still shown in the pods' last state aren't counted twice
+        after a restart of the operator
+    """
+    if state.oom_kills is not None:
+        return
+    state.oom_kills = state.oom_kills_applied = pool_status.get('oomKills', 0)
+    if pool_status.get('lastOOMKillAt'):
+        state.last_oom_kill_at = parse_timestamp(pool_status['lastOOMKillAt'])
+
+
+def list_pool_pods(core_api, pool, namespace):
+    """
+        @returns the pool's pods as dicts
+    """
+    pods = core_api.list_namespaced_pod(namespace, label_selector=label_selector(pool.labels))
+    return [pod.to_dict() for pod in pods.items]
+
+
+def container_memory_limit(pod, container_name):
+    for container in (pod.get('spec') or {}).get('containers') or []:
+        if container.get('name') == container_name:
+            return resource_quantity(container.get('resources'), 'limits', 'memory')
+    return None
+
+
+def container_terminations(pod, container_name):
+    """
+        @param: pod - V1Pod as a dict
+        @returns [(reason, finished at)] of the container's current and
+        previous termination
+    """
+    terminations = []
+    for container in (pod.get('status') or {}).get('container_statuses') or []:
+        if container.get('name') != container_name:
+            continue
+        for container_state in (container.get('state'), container.get('last_state')):
+            terminated = (container_state or {}).get('terminated')
+            if terminated and terminated.get('finished_at'):
+                terminations.append((terminated.get('reason'), terminated['finished_at']))
+    return terminations
+
+
+def count_oom_kills(state, pods, container_name):
+    """
+        Counts the worker containers OOMKilled since the latest kill seen
+        @returns number of new kills
+    """
+    watermark = state.last_oom_kill_at or 0
+    kills = 0
+    for pod in pods:
+        for reason, finished_at in container_terminations(pod, container_name):
+            finished_at = finished_at.timestamp()
+            if reason != 'OOMKilled' or finished_at <= watermark:
+                continue
+            kills += 1
+            if finished_at > (state.last_oom_kill_at or 0):
+                state.last_oom_kill_at = finished_at
+                state.oom_memory_limit = container_memory_limit(pod, container_name)
+    state.oom_kills = (state.oom_kills or 0) + kills
+    return kills
+
+
+def record_usage(state, usage, resources, now):
+    """
+        @param: usage - resource name -> usage of every pod, see pod_usage
+        @param: resources - the worker container's current resources
+    """
+    cpu = usage.get('cpu') or []
+    memory = usage.get('memory') or []
+    if not cpu and not memory:
+        return
+    cpu_limit = resource_quantity(resources, 'limits', 'cpu')
+    state.samples.append(UsageSample(
+        sampled_at=now,
+        cpu=max(cpu, default=0),
+        memory=max(memory, default=0),
+        throttled=bool(cpu_limit) and any(
+            pod >= cpu_limit * constants.RIGHTSIZING_THROTTLE_RATIO for pod in cpu
+        )
+    ))
+    while now - state.samples[0].sampled_at > constants.RIGHTSIZING_WINDOW:
+        state.samples.popleft()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, ceil(len(values) * pct / 100) - 1)]
+
+
+def size_resource(resources, resource, request, min_limit=None):
+    """
+        Keeps the container's limit to request ratio, like VPA
+        @param: min_limit - the limit must grow to at least this
+        @returns (request, limit), limit is None without a current limit
+    """
+    current_request = resource_quantity(resources, 'requests', resource)
+    current_limit = resource_quantity(resources, 'limits', resource)
+    if current_limit is None:
+        return max(request, min_limit or 0), None
+    ratio = current_limit / current_request if current_request else 1
+    limit = request * ratio
+    if min_limit is not None and limit < min_limit:
+        limit = min_limit
+        request = limit / ratio
+    return request, limit
+
+
+def oom_memory_floor(state, now=None):
+    """
+        @returns bytes the memory limit has to grow to after an OOM kill
+        within RIGHTSIZING_WINDOW, or None
+    """
+    now = time.time() if now is None else now
+    if not state.oom_memory_limit or state.last_oom_kill_at is None or \
+            now - state.last_oom_kill_at > constants.RIGHTSIZING_WINDOW:
+        return None
+    return max(
+        state.oom_memory_limit * constants.RIGHTSIZING_OOM_BUMP,
+        state.oom_memory_limit + constants.RIGHTSIZING_OOM_MIN_BUMP
+    )
+
+
+def recommend_resources(state, resources, policy, now=None):
+    """
+        From RIGHTSIZING_MIN_SAMPLES usage samples on, cpu requests cover the
+        busiest pod's 90th percentile and memory requests its peak, with
+        RIGHTSIZING_MARGIN headroom. A cpu limit the pods keep running into
+        grows by RIGHTSIZING_THROTTLE_BUMP, a memory limit hit by an OOM
+        kill by RIGHTSIZING_OOM_BUMP. Limits keep their ratio to requests
+        and everything stays within the policy's minAllowed/maxAllowed
+        @param: policy - rightsizing spec of the pool
+        @returns recommended resources or None without evidence
+    """
+    resources = resources or {}
+    samples = state.samples
+    sized = {}
+    if len(samples) >= constants.RIGHTSIZING_MIN_SAMPLES:
+        throttled = sum(sample.throttled for sample in samples) / len(samples) >= \
+            constants.RIGHTSIZING_THROTTLED_FRACTION
+        cpu_limit = resource_quantity(resources, 'limits', 'cpu')
+        sized['cpu'] = size_resource(
+            resources, 'cpu',
+            percentile([sample.cpu for sample in samples], constants.RIGHTSIZING_CPU_PERCENTILE) *
+            (1 + constants.RIGHTSIZING_MARGIN),
+            cpu_limit * constants.RIGHTSIZING_THROTTLE_BUMP if throttled and cpu_limit else None
+        )
+        sized['memory'] = size_resource(
+            resources, 'memory',
+            max(sample.memory for sample in samples) * (1 + constants.RIGHTSIZING_MARGIN),
+            oom_memory_floor(state, now)
+        )
+    elif oom_memory_floor(state, now):
+        current = resource_quantity(resources, 'requests', 'memory') or \
+            resource_quantity(resources, 'limits', 'memory') or 0
+        sized['memory'] = size_resource(resources, 'memory', current, oom_memory_floor(state, now))
+    if not sized:
+        return None
+
+    recommended = {
+        'requests': dict(resources.get('requests') or {}),
+        'limits': dict(resources.get('limits') or {})
+    }
+    floors = {'cpu': constants.RIGHTSIZING_MIN_CPU, 'memory': constants.RIGHTSIZING_MIN_MEMORY}
+    for resource, values in sized.items():
+        low = resource_quantity(policy, 'minAllowed', resource) or floors[resource]
+        high = resource_quantity(policy, 'maxAllowed', resource)
+        for kind, value in zip(('requests', 'limits'), values):
+            if value is None:
+                continue
+            value = max(value, low)
+            if high is not None:
+                value = min(value, high)
+            recommended[kind][resource] = format_quantity(resource, value)
+    return {kind: values for kind, values in recommended.items() if values}
+
+
+def resources_changed(current, recommended):
+    """
+        @returns True if a cpu/memory request or limit moves by at least
+        RIGHTSIZING_MIN_CHANGE
+    """
+    for kind in ('requests', 'limits'):
+        for resource in constants.UTILIZATION_RESOURCES:
+            old = resource_quantity(current, kind, resource)
+            new = resource_quantity(recommended, kind, resource)
+            if old is None or new is None:
+                if old != new:
+                    return True
+            elif abs(new - old) >= old * constants.RIGHTSIZING_MIN_CHANGE:
+                return True
+    return False
+
+
+def should_apply(state, current, recommended, now):
+    """
+        Every change rolls the pool's pods, so changes are rate limited,
+        less so after new OOM kills
+    """
+    if not resources_changed(current, recommended):
+        return False
+    if state.last_applied_at is None:
+        return True
+    interval = constants.RIGHTSIZING_MIN_INTERVAL
+    if (state.oom_kills or 0) > state.oom_kills_applied:
+        interval = constants.RIGHTSIZING_OOM_MIN_INTERVAL
+    return now - state.last_applied_at >= interval
+
+
+def mark_applied(state, now):
+    state.last_applied_at = now
+    state.oom_kills_applied = state.oom_kills or 0
+
+
+def evidence_status(state, recommended):
+    """
+        @returns the pool's entry of status.rightsizing
+    """
+    samples = state.samples
+    status = {'oomKills': state.oom_kills or 0, 'samples': len(samples)}
+    if state.last_oom_kill_at:
+        status['lastOOMKillAt'] = format_timestamp(state.last_oom_kill_at)
+    if samples:
+        status['cpuP90'] = format_quantity(
+            'cpu', percentile([sample.cpu for sample in samples], constants.RIGHTSIZING_CPU_PERCENTILE)
+        )
+        status['memoryPeak'] = format_quantity('memory', max(sample.memory for sample in samples))
+        status['cpuThrottledFraction'] = round(
+            sum(sample.throttled for sample in samples) / len(samples), 2
+        )
+    if recommended:
+        status['recommended'] = recommended
+    return status
+
+
+def status_changed(old, new):
+    """
+        Usage figures change on every sample, only new kills and
+        recommendations are worth a status write
+    """
+    if old is None:
+        return True
+    return any(old.get(key) != new.get(key) for key in ('oomKills', 'recommended', 'resources'))
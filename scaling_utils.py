@@ -0,0 +1,515 @@
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from math import ceil, floor
+from typing import Deque, Dict, List, Optional, Tuple
+
+import constants
+
+
+# Mirrors the HPA defaults for `behavior`
+DEFAULT_BEHAVIOR = {
+    'scaleUp': {
+        'stabilizationWindowSeconds': 0,
+        'selectPolicy': 'Max',
+        'policies': [
+            {'type': 'Percent', 'value': 100, 'periodSeconds': 15},
+            {'type': 'Pods', 'value': 4, 'periodSeconds': 15}
+        ]
+    },
+    'scaleDown': {
+        'stabilizationWindowSeconds': 300,
+        'selectPolicy': 'Max',
+        'policies': [
+            {'type': 'Percent', 'value': 100, 'periodSeconds': 15}
+        ]
+    }
+}
+DEFAULT_SMOOTHING_ALPHA = 0.5
+
+
+@dataclass
+class Drain:
+    """
+        A scale down waiting for the workers picked to go to finish their tasks
+    """
+    target_replicas: int
+    started_at: float
+    # hostnames of the workers told to stop consuming
+    workers: List[str] = field(default_factory=list)
+    cancelled: bool = False
+
+
+@dataclass
+class ScaleUp:
+    """
+        A scale up of a pool with a warm pool, waiting for its new pods to
+        get ready while warm workers consume the pool's queues
+    """
+    target_replicas: int
+    started_at: float
+    # hostnames of the warm workers activated for it
+    warm_workers: List[str] = field(default_factory=list)
+    activated_at: Optional[float] = None
+    # scaled down again before the new pods got ready
+    lowered: bool = False
+
+
+@dataclass
+class ScalingState:
+    """
+        Per worker deployment memory of the autoscaler between ticks
+    """
+    smoothed_queue_length: Optional[float] = None
+    last_queue_length: Optional[float] = None
+    last_processed: Optional[int] = None
+    last_sample_at: Optional[float] = None
+    first_sample_at: Optional[float] = None
+    last_patched_at: Optional[float] = None
+    current_replicas: Optional[int] = None  # as seen on the last evaluation
+    idle_since: Optional[float] = None  # queues empty since
+    activation_started_at: Optional[float] = None  # woke up from zero at
+    arrival_rate: Optional[float] = None  # tasks/sec entering the queue
+    per_worker_rate: Optional[float] = None  # tasks/sec drained by one worker
+    # (timestamp, recommended replicas)
+    recommendations: Deque[Tuple[float, int]] = field(default_factory=deque)
+    # (timestamp, replica delta)
+    scale_events: Deque[Tuple[float, int]] = field(default_factory=deque)
+    drain: Optional[Drain] = None  # graceful scale down in progress
+    scale_up: Optional[ScaleUp] = None  # scale up covered by warm workers
+    last_tuned_at: Optional[float] = None  # worker options autotuned at
+
+
+# (namespace, name, worker pool) -> ScalingState
+_states: Dict[Tuple[str, str, Optional[str]], ScalingState] = {}
+
+# (namespace, name) -> monotonic time of the last queue length status write
+_status_writes: Dict[Tuple[str, str], float] = {}
+
+# API writes made and avoided by the autoscaling loop, operator wide
+write_counters: Counter = Counter()
+
+
+def get_scaling_state(namespace, name, pool=None):
+    return _states.setdefault((namespace, name, pool), ScalingState())
+
+
+def forget_scaling_state(namespace, name):
+    for key in [key for key in _states if key[:2] == (namespace, name)]:
+        del _states[key]
+    _status_writes.pop((namespace, name), None)
+
+
+def ewma(previous, sample, alpha):
+    if previous is None:
+        return float(sample)
+    return alpha * sample + (1 - alpha) * previous
+
+
+def observe(state, queue_length, processed_total, consuming_replicas, alpha, now):
+    """
+        Folds a new queue length (and optionally cumulative processed
+        task count) sample into the state's smoothed metrics
+        @param: consuming_replicas - workers the drain rate is shared by
+    """
+    if state.last_sample_at is not None and now > state.last_sample_at:
+        elapsed = now - state.last_sample_at
+        drain_rate = None
+        if processed_total is not None and state.last_processed is not None:
+            # a restarted worker resets its counters, ignore that sample
+            if processed_total >= state.last_processed:
+                drain_rate = (processed_total - state.last_processed) / elapsed
+
+        if drain_rate is not None:
+            growth_rate = (queue_length - state.last_queue_length) / elapsed
+            state.arrival_rate = ewma(
+                state.arrival_rate, max(growth_rate + drain_rate, 0), alpha
+            )
+            # only busy workers tell us how fast a worker can go
+            if consuming_replicas and state.last_queue_length:
+                state.per_worker_rate = ewma(
+                    state.per_worker_rate, drain_rate / consuming_replicas, alpha
+                )
+
+    state.smoothed_queue_length = ewma(
+        state.smoothed_queue_length, queue_length, alpha
+    )
+    state.last_queue_length = queue_length
+    state.last_processed = processed_total
+    state.last_sample_at = now
+    if state.first_sample_at is None:
+        state.first_sample_at = now
+
+
+def estimated_wait(state, replicas):
+    """
+        Time a message queued now waits for the backlog ahead of it to be
+        worked off at the workers' measured rate
+        @returns seconds or None while throughput isn't measured
+    """
+    if not state.per_worker_rate or not replicas:
+        return None
+    return (state.smoothed_queue_length or 0) / (replicas * state.per_worker_rate)
+
+
+def desired_for_wait_time(state, wait_seconds, current_replicas, oldest_message_age=None):
+    """
+        Replicas keeping the time messages wait in the queue under
+        wait_seconds. From measured throughput, the backlog must be worked
+        off within wait_seconds and arrivals must not outgrow the workers.
+        The oldest message's age, where the broker exposes it, scales up
+        in proportion once messages already waited too long
+        @returns replicas or None if neither is known yet
+    """
+    recommendations = []
+    if state.per_worker_rate and state.arrival_rate is not None:
+        backlog = state.smoothed_queue_length or 0
+        wanted_rate = max(state.arrival_rate, backlog / wait_seconds)
+        recommendations.append(ceil(wanted_rate / state.per_worker_rate))
+
+    if oldest_message_age is not None:
+        ratio = oldest_message_age / wait_seconds
+        # the age lags behind the backlog, so it is only trusted to scale up
+        if ratio > 1:
+            recommendations.append(ceil(max(current_replicas or 0, 1) * ratio))
+        elif not recommendations:
+            return current_replicas
+
+    return max(recommendations) if recommendations else None
+
+
+def desired_from_metric(state, metric, utilization=None, current_replicas=None,
+                        oldest_message_age=None):
+    """
+        @param: utilization - resource name -> (percent, pods measured)
+        @param: oldest_message_age - seconds the oldest message of the pool's
+            queues has waited, if the broker tells
+        @returns replicas wanted by a single metric or None if it can't tell yet
+    """
+    target = metric.get('target') or {}
+    backlog = state.smoothed_queue_length or 0
+
+    if target.get('type') == constants.METRIC_TARGET_WAIT_TIME:
+        desired = desired_for_wait_time(
+            state, target['waitSeconds'], current_replicas, oldest_message_age
+        )
+        if desired is not None:
+            return desired
+        # nothing measured yet, use averageValue if given
+        if not target.get('averageValue'):
+            return None
+
+    if target.get('type') == constants.METRIC_TARGET_UTILIZATION:
+        measured = (utilization or {}).get(metric.get('name'))
+        if measured is None:
+            return None
+        percent, pods = measured
+        ratio = percent / target['averageUtilization']
+        if abs(ratio - 1) <= constants.UTILIZATION_TOLERANCE:
+            return current_replicas
+        return ceil(ratio * pods)
+
+    if target.get('type') == constants.METRIC_TARGET_DRAIN_TIME:
+        if state.per_worker_rate and state.arrival_rate is not None:
+            drain_seconds = target['drainSeconds']
+            wanted_rate = state.arrival_rate + backlog / drain_seconds
+            return ceil(wanted_rate / state.per_worker_rate)
+        # no throughput measured yet, use averageValue if given
+        if not target.get('averageValue'):
+            return None
+
+    return ceil(backlog / target['averageValue'])
+
+
+def stabilize(state, desired, current, behavior, now):
+    """
+        HPA style stabilization: scale up to the lowest and down to the
+        highest recommendation seen within the respective windows
+    """
+    up_window = behavior['scaleUp']['stabilizationWindowSeconds']
+    down_window = behavior['scaleDown']['stabilizationWindowSeconds']
+
+    state.recommendations.append((now, desired))
+    horizon = now - max(up_window, down_window)
+    while state.recommendations and state.recommendations[0][0] < horizon:
+        state.recommendations.popleft()
+
+    up_recommendation = min(
+        r for t, r in state.recommendations if t >= now - up_window
+    )
+    down_recommendation = max(
+        r for t, r in state.recommendations if t >= now - down_window
+    )
+
+    # Nothing is known about the past after an operator restart, so
+    # hold current replicas for a full scale down window
+    if now - state.first_sample_at < down_window:
+        down_recommendation = max(down_recommendation, current)
+
+    recommendation = current
+    if recommendation < up_recommendation:
+        recommendation = up_recommendation
+    if recommendation > down_recommendation:
+        recommendation = down_recommendation
+    return recommendation
+
+
+def _replicas_changed_within(state, period, now, scale_up):
+    return sum(
+        delta for t, delta in state.scale_events
+        if t >= now - period and (delta > 0) == scale_up
+    )
+
+
+def limit_rate(state, desired, current, behavior, now):
+    """
+        Applies scaleUp/scaleDown policies bounding how many replicas
+        may be added or removed per period
+    """
+    if desired == current:
+        return desired
+
+    scale_up = desired > current
+    rules = behavior['scaleUp' if scale_up else 'scaleDown']
+    select_policy = rules.get('selectPolicy', 'Max')
+    if select_policy == 'Disabled':
+        return current
+
+    limits = []
+    for policy in rules.get('policies', []):
+        changed = _replicas_changed_within(
+            state, policy['periodSeconds'], now, scale_up
+        )
+        period_start = current - changed
+        if policy['type'] == 'Pods':
+            limit = period_start + policy['value'] if scale_up \
+                else period_start - policy['value']
+        elif scale_up:
+            limit = ceil(period_start * (1 + policy['value'] / 100))
+        else:
+            limit = floor(period_start * (1 - policy['value'] / 100))
+        limits.append(limit)
+
+    if not limits:
+        return desired
+
+    # Max selects the policy allowing the biggest change
+    if scale_up:
+        limit = max(limits) if select_policy == 'Max' else min(limits)
+        return min(desired, max(limit, current))
+    limit = min(limits) if select_policy == 'Max' else max(limits)
+    return max(desired, min(limit, current))
+
+
+def record_scale_event(state, current, updated, now, period=None):
+    if updated != current:
+        state.scale_events.append((now, updated - current))
+    period = period or constants.SCALE_EVENT_HISTORY
+    while state.scale_events and state.scale_events[0][0] < now - period:
+        state.scale_events.popleft()
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def get_behavior(scaling_target):
+    behavior = scaling_target.get('behavior') or {}
+    return {
+        direction: {**DEFAULT_BEHAVIOR[direction], **(behavior.get(direction) or {})}
+        for direction in ('scaleUp', 'scaleDown')
+    }
+
+
+def scale_to_zero_replicas(state, scale_to_zero, current_replicas, queue_length, now):
+    """
+        @returns 0 if the pool is or should go idle, None if regular
+        scaling applies
+    """
+    if queue_length > 0:
+        state.idle_since = None
+        if current_replicas == 0:
+            mark_activation(state, now)
+        return None
+
+    if state.idle_since is None:
+        state.idle_since = now
+    if current_replicas == 0:
+        return 0
+
+    idle_seconds = scale_to_zero.get('idleSeconds', constants.SCALE_TO_ZERO_IDLE_SECONDS)
+    if now - state.idle_since >= idle_seconds:
+        # a wake up that never got a ready worker is not worth reporting
+        state.activation_started_at = None
+        return 0
+    return None
+
+
+def mark_activation(state, now):
+    """
+        Remembers when queued work for a pool at zero replicas was first seen
+    """
+    if state.activation_started_at is None:
+        state.activation_started_at = now
+
+
+def is_idle_or_waking(state):
+    """
+        Checks if a pool is at zero replicas or waiting for its first
+        worker after waking up
+    """
+    return state.current_replicas == 0 or state.activation_started_at is not None
+
+
+def recommend_replicas(state, scaling_target, current_replicas, queue_length,
+                       processed_total=None, now=None, min_replicas=None,
+                       utilization=None, oldest_message_age=None, ready_replicas=None):
+    """
+        Runs one autoscaling evaluation for a worker scaleTargetRef.
+        Callers record_scale_event once the recommendation is applied
+        @param: state - ScalingState of the worker deployment
+        @param: queue_length - total messages waiting in worker's queues
+        @param: processed_total - cumulative tasks processed by the workers,
+            needed by drainTime and waitTime metrics
+        @param: utilization - resource name -> (percent, pods measured) of
+            the workers, needed by utilization metrics
+        @param: oldest_message_age - seconds the oldest queued message
+            waited, optional for waitTime metrics
+        @param: ready_replicas - workers passing their readiness probe. Pods
+            still booting don't consume, so throughput is measured per
+            ready worker. Defaults to current_replicas
+        @returns (replicas, details dict describing the decision)
+    """
+    now = time.monotonic() if now is None else now
+    behavior = get_behavior(scaling_target)
+    alpha = scaling_target.get('smoothingAlpha', DEFAULT_SMOOTHING_ALPHA)
+    if min_replicas is None:
+        min_replicas = scaling_target.get('minReplicas', 1)
+    max_replicas = scaling_target.get('maxReplicas')
+
+    consuming_replicas = current_replicas if ready_replicas is None else ready_replicas
+    observe(state, queue_length, processed_total, consuming_replicas, alpha, now)
+    state.current_replicas = current_replicas
+
+    scale_to_zero = scaling_target.get('scaleToZero')
+    if scale_to_zero is not None:
+        replicas = scale_to_zero_replicas(
+            state, scale_to_zero, current_replicas, queue_length, now
+        )
+        if replicas is not None:
+            return replicas, {
+                'smoothed_queue_length': round(state.smoothed_queue_length, 2),
+                'idle_since': state.idle_since
+            }
+        # while active a scale to zero pool keeps at least one worker
+        min_replicas = max(min_replicas, 1)
+
+    recommendations = [
+        desired for desired in (
+            desired_from_metric(
+                state, metric, utilization, current_replicas, oldest_message_age
+            )
+            for metric in scaling_target.get('metrics', [])
+        ) if desired is not None
+    ]
+    # like HPA, the metric asking for most replicas wins
+    desired = max(recommendations) if recommendations else current_replicas
+    desired = min(max(desired, min_replicas), max_replicas)
+
+    stabilized = stabilize(state, desired, current_replicas, behavior, now)
+    updated = limit_rate(state, stabilized, current_replicas, behavior, now)
+    updated = min(max(updated, min_replicas), max_replicas)
+
+    return updated, {
+        'smoothed_queue_length': round(state.smoothed_queue_length, 2),
+        'arrival_rate': _round(state.arrival_rate),
+        'per_worker_rate': _round(state.per_worker_rate),
+        'estimated_wait_seconds': _round(estimated_wait(state, consuming_replicas)),
+        'ready_replicas': consuming_replicas,
+        'oldest_message_age': _round(oldest_message_age),
+        'desired_replicas': desired,
+        'stabilized_replicas': stabilized,
+        **{
+            f"{resource}_utilization": percent
+            for resource, (percent, _) in (utilization or {}).items()
+        }
+    }
+
+
+def note_scale_up(state, current, updated, now):
+    """
+        Tracks a replica change of a pool with a warm pool: a scale up is
+        covered by warm workers until the deployment has `target_replicas`
+        ready pods, a scale down lowers that target
+    """
+    scale_up = state.scale_up
+    if updated > current:
+        if scale_up is None:
+            state.scale_up = ScaleUp(target_replicas=updated, started_at=now)
+        else:
+            scale_up.target_replicas = max(scale_up.target_replicas, updated)
+    elif scale_up is not None and updated < scale_up.target_replicas:
+        scale_up.target_replicas = updated
+        scale_up.lowered = True
+
+
+def is_patch_rate_limited(state, now=None, current=None):
+    """
+        @returns True if the deployment was patched too recently to patch again.
+        Waking up from zero replicas is never rate limited
+    """
+    now = time.monotonic() if now is None else now
+    return current != 0 and state.last_patched_at is not None and \
+        now - state.last_patched_at < constants.MIN_SCALE_PATCH_INTERVAL
+
+
+def record_scale_patch(state, current, updated, now=None):
+    now = time.monotonic() if now is None else now
+    state.last_patched_at = now
+    state.current_replicas = updated
+    record_scale_event(state, current, updated, now)
+
+
+def queue_length_changed(old, new):
+    """
+        Checks if a queue length moved enough to be worth a status write
+    """
+    old, new = old or 0, new or 0
+    if (old == 0) != (new == 0):
+        return True
+    threshold = max(
+        constants.STATUS_MIN_ABS_CHANGE,
+        constants.STATUS_MIN_REL_CHANGE * old
+    )
+    return abs(new - old) >= threshold
+
+
+def queue_lengths_changed(old_queue_lengths, new_queue_lengths):
+    """
+        @param: old_queue_lengths, new_queue_lengths - [{'name': .., 'messages': ..}]
+        @returns True if any queue appeared, disappeared or meaningfully changed
+    """
+    old = {q.get('name'): q.get('messages') for q in old_queue_lengths or []}
+    new = {q.get('name'): q.get('messages') for q in new_queue_lengths or []}
+    if old.keys() != new.keys():
+        return True
+    return any(queue_length_changed(old[name], new[name]) for name in new)
+
+
+def should_write_queue_status(namespace, name, old_queue_lengths,
+                              new_queue_lengths, now=None):
+    """
+        Coalesces status writes: only when the metric meaningfully changed,
+        or the last write is older than STATUS_MAX_WRITE_INTERVAL
+    """
+    now = time.monotonic() if now is None else now
+    last_write_at = _status_writes.get((namespace, name))
+    stale = last_write_at is None or \
+        now - last_write_at >= constants.STATUS_MAX_WRITE_INTERVAL
+    if stale or queue_lengths_changed(old_queue_lengths, new_queue_lengths):
+        _status_writes[namespace, name] = now
+        write_counters['status_writes'] += 1
+        return True
+
+    write_counters['status_writes_skipped'] += 1
+    return False
@@ -0,0 +1,336 @@
+import os
+import zlib
+import asyncio
+import socket
+import datetime
+from dataclasses import dataclass, field
+from math import ceil
+from typing import Dict, FrozenSet, Optional
+
+import kopf
+from kubernetes.client.rest import ApiException
+
+import constants
+from k8s_utils import (
+    coordination_v1_api,
+    custom_objects_api,
+    run_in_thread
+)
+from metrics_utils import (
+    OWNED_SHARDS,
+    SHARD_HANDOFFS
+)
+
+
+@dataclass
+class ShardOwnership:
+    """
+        Shards one operator replica holds the leases of
+    """
+    identity: str
+    shard_count: int
+    namespace: str
+    owned: FrozenSet[int] = frozenset()
+    # shard -> when its lease was last acquired or renewed by us
+    renewed_at: Dict[int, datetime.datetime] = field(default_factory=dict)
+    # published on our member lease, e.g. the demands of our replica budgets
+    announced: Dict[str, str] = field(default_factory=dict)
+    # identity -> annotations of the other live replicas' member leases
+    peers: Dict[str, Dict[str, str]] = field(default_factory=dict)
+
+
+_ownership: Optional[ShardOwnership] = None
+
+
+def get_ownership():
+    """
+        Ownership of this replica, configured from the environment:
+        OPERATOR_SHARDS, POD_NAME and POD_NAMESPACE
+    """
+    global _ownership
+    if _ownership is None:
+        _ownership = ShardOwnership(
+            identity=os.environ.get(constants.IDENTITY_ENV) or socket.gethostname(),
+            shard_count=max(int(os.environ.get(constants.SHARD_COUNT_ENV) or 1), 1),
+            namespace=os.environ.get(constants.LEASE_NAMESPACE_ENV) or 'default'
+        )
+    return _ownership
+
+
+def is_sharded(ownership=None):
+    return (ownership or get_ownership()).shard_count > 1
+
+
+def shard_of(namespace, name, shard_count):
+    """
+        Stable across processes, unlike hash()
+    """
+    return zlib.crc32(f"{namespace}/{name}".encode()) % shard_count
+
+
+def owns_resource(namespace, name, **_):
+    """
+        Whether this replica handles a Celery resource. Usable as a kopf
+        `when` filter
+    """
+    ownership = get_ownership()
+    if not is_sharded(ownership):
+        return True
+    return shard_of(namespace, name, ownership.shard_count) in ownership.owned
+
+
+class ShardedDiffBaseStorage(kopf.AnnotationsDiffBaseStorage):
+    """
+        kopf stores the last handled configuration even when every handler
+        was filtered out. Replicas not owning a resource must not, or the
+        owner would never see the change
+    """
+
+    def store(self, *, body, patch, essence):
+        if owns_resource(body.get('metadata', {}).get('namespace'),
+                         body.get('metadata', {}).get('name')):
+            super().store(body=body, patch=patch, essence=essence)
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def shard_lease_name(shard):
+    return f"{constants.LEASE_PREFIX}-shard-{shard}"
+
+
+def member_lease_name(identity):
+    return f"{constants.LEASE_PREFIX}-member-{identity}"
+
+
+def lease_body(ownership, name, kind, holder, now, resource_version=None, annotations=None):
+    metadata = {
+        'name': name,
+        'namespace': ownership.namespace,
+        'labels': {constants.LEASE_LABEL: kind}
+    }
+    if annotations:
+        metadata['annotations'] = annotations
+    if resource_version:
+        metadata['resourceVersion'] = resource_version
+    return {
+        'apiVersion': 'coordination.k8s.io/v1',
+        'kind': 'Lease',
+        'metadata': metadata,
+        'spec': {
+            'holderIdentity': holder,
+            'leaseDurationSeconds': constants.LEASE_DURATION,
+            'renewTime': now.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        }
+    }
+
+
+def is_lease_live(lease, now):
+    spec = lease.spec
+    if not spec.holder_identity or spec.renew_time is None:
+        return False
+    expires_at = spec.renew_time + datetime.timedelta(
+        seconds=spec.lease_duration_seconds or constants.LEASE_DURATION
+    )
+    return expires_at > now
+
+
+def balance_shards(shard_count, holders, members, identity):
+    """
+        Decides which shards to take and which to give away so every live
+        replica ends up with an even share
+        @param: holders - shard -> identity holding its live lease
+        @param: members - number of live replicas, including this one
+        @returns (shards to acquire, shards to release)
+    """
+    target = ceil(shard_count / max(members, 1))
+    mine = sorted(shard for shard, holder in holders.items() if holder == identity)
+    free = [shard for shard in range(shard_count) if shard not in holders]
+
+    if len(mine) > target:
+        return [], mine[target:]
+    return free[:target - len(mine)], []
+
+
+def sync_leases(coordination_api, ownership, logger, now=None):
+    """
+        One lease round of a replica: renews its member lease and the shard
+        leases it holds, takes over free or expired shards up to its fair
+        share and gives away shards above it
+        @returns shards acquired in this round
+    """
+    now = now or utcnow()
+    namespace = ownership.namespace
+    leases = {
+        lease.metadata.name: lease
+        for lease in coordination_api.list_namespaced_lease(
+            namespace, label_selector=constants.LEASE_LABEL
+        ).items
+    }
+
+    renew_lease(
+        coordination_api, ownership, leases.get(member_lease_name(ownership.identity)),
+        member_lease_name(ownership.identity), 'member', now,
+        annotations=ownership.announced
+    )
+    member_leases = [
+        lease for lease in leases.values()
+        if (lease.metadata.labels or {}).get(constants.LEASE_LABEL) == 'member'
+        and is_lease_live(lease, now)
+    ]
+    members = {lease.spec.holder_identity for lease in member_leases} | {ownership.identity}
+    ownership.peers = {
+        lease.spec.holder_identity: dict(lease.metadata.annotations or {})
+        for lease in member_leases if lease.spec.holder_identity != ownership.identity
+    }
+
+    holders = {}
+    for shard in range(ownership.shard_count):
+        lease = leases.get(shard_lease_name(shard))
+        if lease is not None and is_lease_live(lease, now):
+            holders[shard] = lease.spec.holder_identity
+
+    acquire, release = balance_shards(
+        ownership.shard_count, holders, len(members), ownership.identity
+    )
+    # stop handling before giving the lease away
+    ownership.owned = ownership.owned - set(release)
+    for shard in release:
+        renew_lease(
+            coordination_api, ownership, leases[shard_lease_name(shard)],
+            shard_lease_name(shard), 'shard', now, release=True
+        )
+        ownership.renewed_at.pop(shard, None)
+        SHARD_HANDOFFS.labels('released').inc()
+        logger.info("Released shard %s of %s", shard, ownership.shard_count)
+
+    owned = set()
+    for shard, holder in holders.items():
+        if holder == ownership.identity and shard not in release and renew_lease(
+                coordination_api, ownership, leases[shard_lease_name(shard)],
+                shard_lease_name(shard), 'shard', now):
+            owned.add(shard)
+            ownership.renewed_at[shard] = now
+
+    acquired = []
+    for shard in acquire:
+        if renew_lease(coordination_api, ownership, leases.get(shard_lease_name(shard)),
+                       shard_lease_name(shard), 'shard', now):
+            acquired.append(shard)
+            ownership.renewed_at[shard] = now
+            SHARD_HANDOFFS.labels('acquired').inc()
+            logger.info("Acquired shard %s of %s", shard, ownership.shard_count)
+
+    ownership.owned = frozenset(owned | set(acquired))
+    OWNED_SHARDS.set(len(ownership.owned))
+    return acquired
+
+
+def renew_lease(coordination_api, ownership, lease, name, kind, now, release=False,
+                annotations=None):
+    """
+        Writes a lease with optimistic concurrency, so of two replicas
+        racing for a shard only one wins
+        @param: release - give the lease away instead of holding it
+        @param: annotations - replace the lease's annotations
+        @returns whether the write went through
+    """
+    holder = None if release else ownership.identity
+    try:
+        if lease is None:
+            coordination_api.create_namespaced_lease(
+                ownership.namespace, lease_body(ownership, name, kind, holder, now,
+                                                annotations=annotations)
+            )
+        else:
+            coordination_api.replace_namespaced_lease(
+                name, ownership.namespace,
+                lease_body(ownership, name, kind, holder, now, lease.metadata.resource_version,
+                           annotations)
+            )
+    except ApiException as e:
+        if e.status != 409:
+            raise
+        return False
+    return True
+
+
+def drop_expired_shards(ownership, now=None):
+    """
+        Stops handling shards whose lease could not be renewed in time,
+        another replica may own them by now
+        @returns dropped shards
+    """
+    now = now or utcnow()
+    expired = {
+        shard for shard in ownership.owned
+        if now - ownership.renewed_at.get(shard, now) >=
+        datetime.timedelta(seconds=constants.LEASE_DURATION)
+    }
+    if expired:
+        ownership.owned = ownership.owned - expired
+        OWNED_SHARDS.set(len(ownership.owned))
+    return expired
+
+
+def release_all_shards(coordination_api, ownership, logger):
+    """
+        Gives all shards away on shutdown, so others don't wait for expiry
+    """
+    shards, ownership.owned = ownership.owned, frozenset()
+    now = utcnow()
+    for shard in shards:
+        name = shard_lease_name(shard)
+        try:
+            lease = coordination_api.read_namespaced_lease(name, ownership.namespace)
+            if lease.spec.holder_identity == ownership.identity:
+                renew_lease(coordination_api, ownership, lease, name, 'shard', now, release=True)
+        except ApiException as e:
+            logger.warning("Failed to release shard %s: %r", shard, e)
+
+
+def touch_shard_resources(custom_api, ownership, shards, logger):
+    """
+        Records the new owner in the status of the Celery resources of newly
+        acquired shards. The resulting events let kopf run handlers that
+        were skipped while the shards had no owner
+    """
+    shards = set(shards)
+    resources = custom_api.list_cluster_custom_object(
+        'celeryproject.org', 'v1alpha1', 'celery'
+    )
+    for resource in resources.get('items', []):
+        metadata = resource['metadata']
+        shard = shard_of(metadata['namespace'], metadata['name'], ownership.shard_count)
+        if shard not in shards:
+            continue
+        try:
+            custom_api.patch_namespaced_custom_object(
+                'celeryproject.org', 'v1alpha1', metadata['namespace'], 'celery',
+                metadata['name'],
+                {'status': {'shard': {'index': shard, 'owner': ownership.identity}}}
+            )
+        except ApiException as e:
+            logger.warning("Failed to touch %s/%s: %r", metadata['namespace'], metadata['name'], e)
+
+
+async def maintain_shard_leases(logger):
+    """
+        Lease loop of a sharded replica, runs until cancelled on cleanup
+    """
+    ownership = get_ownership()
+    while True:
+        try:
+            acquired = await run_in_thread(
+                sync_leases, coordination_v1_api(), ownership, logger
+            )
+            if acquired:
+                await run_in_thread(
+                    touch_shard_resources, custom_objects_api(), ownership, acquired, logger
+                )
+        except Exception as e:
+            logger.warning("Shard lease round failed: %r", e)
+            for shard in drop_expired_shards(ownership):
+                logger.warning("Lease of shard %s expired, stopped handling it", shard)
+        await asyncio.sleep(constants.LEASE_RENEW_INTERVAL)
@@ -0,0 +1,410 @@
+import math
+import time
+import socket
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import constants
+
+
+class RateWindow:
+    """
+        Ring buffer of per second event counts over the last `seconds`
+    """
+
+    def __init__(self, seconds=constants.TASK_EVENTS_RATE_WINDOW):
+        self.counts = [0] * seconds
+        self.last_second = None
+
+    def add(self, timestamp):
+        second = int(timestamp)
+        size = len(self.counts)
+        if self.last_second is None:
+            self.last_second = second
+        elif second > self.last_second:
+            # zero the slots of the seconds without events
+            for skipped in range(self.last_second + 1, min(second, self.last_second + size) + 1):
+                self.counts[skipped % size] = 0
+            self.last_second = second
+        elif self.last_second - second >= size:
+            # too late for the window
+            return
+        self.counts[second % size] += 1
+
+    def rate(self, now):
+        """
+            Doesn't touch the ring, so it's safe to call from other threads
+            @returns events/sec averaged over the window
+        """
+        if self.last_second is None:
+            return 0.0
+        size = len(self.counts)
+        stale = min(max(int(now) - self.last_second, 0), size)
+        total = sum(self.counts) - sum(
+            self.counts[(self.last_second + k) % size] for k in range(1, stale + 1)
+        )
+        return total / size
+
+
+class QuantileSketch:
+    """
+        Log bucketed histogram: bucket i counts values up to
+        SKETCH_MIN * SKETCH_GROWTH ** i, so quantiles have a fixed relative
+        error and memory doesn't grow with the number of values
+    """
+    log_min = math.log(constants.TASK_EVENTS_SKETCH_MIN)
+    log_growth = math.log(constants.TASK_EVENTS_SKETCH_GROWTH)
+    size = math.ceil(
+        math.log(constants.TASK_EVENTS_SKETCH_MAX / constants.TASK_EVENTS_SKETCH_MIN) / log_growth
+    ) + 1
+
+    def __init__(self):
+        self.counts = [0] * self.size
+        self.total = 0
+
+    def add(self, value):
+        index = 0
+        if value > constants.TASK_EVENTS_SKETCH_MIN:
+            index = min(
+                math.ceil((math.log(value) - self.log_min) / self.log_growth), self.size - 1
+            )
+        self.counts[index] += 1
+        self.total += 1
+
+    @classmethod
+    def bucket_value(cls, index):
+        """
+            Geometric middle of a bucket's bounds
+        """
+        if index == 0:
+            return constants.TASK_EVENTS_SKETCH_MIN
+        return math.exp(cls.log_min + (index - 0.5) * cls.log_growth)
+
+
+def sketch_quantiles(sketches, quantiles):
+    """
+        @param: sketches - QuantileSketches merged for the query
+        @returns quantile -> value, None for empty sketches
+    """
+    total = sum(sketch.total for sketch in sketches)
+    if not total:
+        return {q: None for q in quantiles}
+    ranks = sorted((max(math.ceil(q * total), 1), q) for q in quantiles)
+    result = {}
+    seen = 0
+    for index, counts in enumerate(zip(*(sketch.counts for sketch in sketches))):
+        seen += sum(counts)
+        while ranks and seen >= ranks[0][0]:
+            result[ranks.pop(0)[1]] = QuantileSketch.bucket_value(index)
+        if not ranks:
+            break
+    return result
+
+
+class WindowedSketch:
+    """
+        Two QuantileSketches taking turns, so quantiles describe the last one
+        to two windows instead of everything since start up
+    """
+
+    def __init__(self, window=constants.TASK_EVENTS_SKETCH_WINDOW):
+        self.window = window
+        self.current = QuantileSketch()
+        self.previous = QuantileSketch()
+        self.started_at = None
+
+    def add(self, value, now):
+        if self.started_at is None:
+            self.started_at = now
+        elif now - self.started_at >= self.window:
+            elapsed_windows = (now - self.started_at) // self.window
+            self.previous = self.current if elapsed_windows == 1 else QuantileSketch()
+            self.current = QuantileSketch()
+            self.started_at += elapsed_windows * self.window
+        self.current.add(value)
+
+    def quantiles(self, quantiles):
+        return sketch_quantiles((self.previous, self.current), quantiles)
+
+
+@dataclass
+class TaskStats:
+    """
+        Counters, rates and runtime/wait quantiles of one task name
+    """
+    received: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    received_rate: RateWindow = field(default_factory=RateWindow)
+    finished_rate: RateWindow = field(default_factory=RateWindow)
+    runtime: WindowedSketch = field(default_factory=WindowedSketch)
+    # sent(or received, without task-sent events) to started
+    wait: WindowedSketch = field(default_factory=WindowedSketch)
+
+
+@dataclass
+class TaskEventStats:
+    """
+        Task statistics of one Celery resource, folded from its event stream.
+        Everything is bounded: task names, tasks in flight and workers
+    """
+    tasks: Dict[str, TaskStats] = field(default_factory=dict)
+    # task id -> (task name, sent or received at), oldest first
+    pending: Dict[str, Tuple[Optional[str], float]] = field(default_factory=OrderedDict)
+    # worker hostname -> tasks finished, least recently active first
+    processed: Dict[str, int] = field(default_factory=OrderedDict)
+    # worker group, see worker_group -> runtimes of all its task names
+    group_runtimes: Dict[str, WindowedSketch] = field(default_factory=dict)
+    events: int = 0
+    last_published_at: Optional[float] = None
+    # held by the consumer thread while it changes processed
+    processed_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+# (namespace, name) -> TaskEventStats
+_stats: Dict[Tuple[str, str], TaskEventStats] = {}
+
+
+def get_task_event_stats(namespace, name):
+    return _stats.setdefault((namespace, name), TaskEventStats())
+
+
+def forget_task_event_stats(namespace, name):
+    _stats.pop((namespace, name), None)
+
+
+def get_task_stats(stats, task_name):
+    """
+        @returns TaskStats of a task name, task names past
+        TASK_EVENTS_MAX_TASK_NAMES(and unknown ones) share TASK_EVENTS_OTHER
+    """
+    task = stats.tasks.get(task_name)
+    if task is None:
+        if task_name is None or len(stats.tasks) >= constants.TASK_EVENTS_MAX_TASK_NAMES:
+            task_name = constants.TASK_EVENTS_OTHER
+            task = stats.tasks.get(task_name)
+        if task is None:
+            task = stats.tasks[task_name] = TaskStats()
+    return task
+
+
+def worker_group(hostname):
+    """
+        Pods of a deployment are named <deployment>-<template hash>-<suffix>,
+        so the default celery@<pod name> hostnames of one deployment share
+        celery@<deployment>
+    """
+    return hostname.rsplit('-', 2)[0]
+
+
+def remember_pending(stats, event, timestamp):
+    pending = stats.pending
+    if event['uuid'] in pending:
+        # keep the sent time of a task once received
+        return
+    pending[event['uuid']] = (event.get('name'), timestamp)
+    if len(pending) > constants.TASK_EVENTS_MAX_PENDING:
+        pending.popitem(last=False)
+
+
+def on_task_sent(stats, event, now):
+    remember_pending(stats, event, event.get('timestamp', now))
+
+
+def on_task_received(stats, event, now):
+    task = get_task_stats(stats, event.get('name'))
+    task.received += 1
+    task.received_rate.add(now)
+    remember_pending(stats, event, event.get('timestamp', now))
+
+
+def on_task_started(stats, event, now):
+    pending = stats.pending.get(event.get('uuid'))
+    if pending is not None and event.get('timestamp') is not None:
+        task_name, queued_at = pending
+        get_task_stats(stats, task_name).wait.add(max(event['timestamp'] - queued_at, 0), now)
+
+
+def on_task_finished(stats, event, now):
+    pending = stats.pending.pop(event.get('uuid'), None)
+    task = get_task_stats(stats, pending[0] if pending else None)
+    task.finished_rate.add(now)
+    hostname = event.get('hostname')
+    if event['type'] == 'task-succeeded':
+        task.succeeded += 1
+        if event.get('runtime') is not None:
+            task.runtime.add(event['runtime'], now)
+            if hostname:
+                add_group_runtime(stats, worker_group(hostname), event['runtime'], now)
+    else:
+        task.failed += 1
+
+    processed = stats.processed
+    with stats.processed_lock:
+        processed[hostname] = processed.get(hostname, 0) + 1
+        processed.move_to_end(hostname)
+        if len(processed) > constants.TASK_EVENTS_MAX_WORKERS:
+            processed.popitem(last=False)
+
+
+def add_group_runtime(stats, group, runtime, now):
+    sketch = stats.group_runtimes.get(group)
+    if sketch is None:
+        if len(stats.group_runtimes) >= constants.TASK_EVENTS_MAX_WORKER_GROUPS:
+            return
+        sketch = stats.group_runtimes[group] = WindowedSketch()
+    sketch.add(runtime, now)
+
+
+EVENT_HANDLERS = {
+    'task-sent': on_task_sent,
+    'task-received': on_task_received,
+    'task-started': on_task_started,
+    'task-succeeded': on_task_finished,
+    'task-failed': on_task_finished,
+}
+
+
+def handle_task_event(stats, event):
+    """
+        Folds one Celery event into the stats in constant time
+        @param: event - event dict as delivered by celery's EventReceiver
+    """
+    handler = EVENT_HANDLERS.get(event.get('type'))
+    if handler is None:
+        return
+    stats.events += 1
+    # the operator's receive time, worker clocks may be off
+    now = event.get('local_received') or event.get('timestamp') or time.time()
+    handler(stats, event, now)
+
+
+def _round(value, digits=3):
+    return None if value is None else round(value, digits)
+
+
+def summarize_task(task, now):
+    runtime = task.runtime.quantiles((0.5, 0.95, 0.99))
+    wait = task.wait.quantiles((0.5, 0.99))
+    return {
+        'received_per_sec': _round(task.received_rate.rate(now)),
+        'finished_per_sec': _round(task.finished_rate.rate(now)),
+        'succeeded': task.succeeded,
+        'failed': task.failed,
+        'runtime_p50': _round(runtime[0.5]),
+        'runtime_p95': _round(runtime[0.95]),
+        'runtime_p99': _round(runtime[0.99]),
+        'wait_p50': _round(wait[0.5]),
+        'wait_p99': _round(wait[0.99]),
+    }
+
+
+def summarize_task_stats(stats, now=None, limit=None):
+    """
+        @param: limit - keep only the busiest task names
+        @returns task name -> summary dict
+    """
+    now = time.time() if now is None else now
+    # list() copies in one go, the consumer thread keeps adding task names
+    summaries = {
+        task_name: summarize_task(task, now) for task_name, task in list(stats.tasks.items())
+    }
+    if limit is not None and len(summaries) > limit:
+        busiest = sorted(
+            summaries, key=lambda task_name: summaries[task_name]['finished_per_sec'] +
+            summaries[task_name]['received_per_sec'], reverse=True
+        )[:limit]
+        summaries = {task_name: summaries[task_name] for task_name in busiest}
+    return summaries
+
+
+def all_task_summaries(now=None):
+    """
+        @returns (namespace, name) -> task name -> summary of every consumer
+    """
+    return {key: summarize_task_stats(stats, now) for key, stats in list(_stats.items())}
+
+
+def get_event_processed_counts(namespace, name):
+    """
+        @returns worker hostname -> tasks finished, like
+        flower_utils.get_flower_processed_counts, or None before any
+        worker finished a task
+    """
+    stats = _stats.get((namespace, name))
+    if stats is None or not stats.processed:
+        return None
+    # the consumer thread reorders the dict as events come in
+    with stats.processed_lock:
+        return dict(stats.processed)
+
+
+def get_deployment_runtime(namespace, name, deployment_name, quantile=0.5):
+    """
+        @returns runtime quantile of the tasks run by a worker deployment's
+        pods, or None without events
+    """
+    stats = _stats.get((namespace, name))
+    if stats is None:
+        return None
+    sketches = [
+        sketch
+        for group, windowed in list(stats.group_runtimes.items())
+        if group.endswith(f"@{deployment_name}")
+        for sketch in (windowed.previous, windowed.current)
+    ]
+    return sketch_quantiles(sketches, (quantile,))[quantile]
+
+
+def task_stats_status_if_due(namespace, name, now=None):
+    """
+        @returns compact summary for the CR status, at most every
+        TASK_EVENTS_STATUS_INTERVAL, otherwise None
+    """
+    stats = _stats.get((namespace, name))
+    now = time.time() if now is None else now
+    if stats is None or not stats.events or (
+            stats.last_published_at is not None and
+            now - stats.last_published_at < constants.TASK_EVENTS_STATUS_INTERVAL):
+        return None
+    stats.last_published_at = now
+    return {
+        'events': stats.events,
+        'tasks': summarize_task_stats(stats, now, constants.TASK_EVENTS_STATUS_TASKS)
+    }
+
+
+def consume_task_events(broker_url, stats, stopped, logger=None, keep_listening=None):
+    """
+        Blocks until `stopped` or keep_listening() turns false, folding the
+        Celery events published on the broker into stats. Workers only send
+        events with `-E`/worker_send_task_events, or after flower enabled them
+    """
+    from celery import Celery
+
+    app = Celery(broker=broker_url, set_as_current=False)
+    next_check_at = 0
+
+    def should_stop():
+        return bool(stopped) or (keep_listening is not None and not keep_listening())
+
+    def on_event(event):
+        nonlocal next_check_at
+        handle_task_event(stats, event)
+        now = time.monotonic()
+        if now >= next_check_at:
+            next_check_at = now + constants.TASK_EVENTS_CHECK_INTERVAL
+            receiver.should_stop = should_stop()
+
+    with app.connection_for_read() as connection:
+        receiver = app.events.Receiver(connection, handlers={'*': on_event})
+        if logger:
+            logger.info("Consuming task events")
+        while not receiver.should_stop and not should_stop():
+            try:
+                receiver.capture(limit=None, timeout=constants.TASK_EVENTS_CHECK_INTERVAL, wakeup=False)
+            except socket.timeout:
+                # no events for a while
+                pass
@@ -0,0 +1,121 @@
+import copy
+import datetime
+import logging
+from types import SimpleNamespace
+
+import pytest
+from kubernetes.client.rest import ApiException
+
+import budget_utils
+import constants
+import handlers
+import sharding_utils
+
+logger = logging.getLogger(__name__)
+BUDGET = {'metadata': {'name': 'budget'}, 'spec': {'maxReplicas': 10}}
+
+
+@pytest.fixture(autouse=True)
+def clean_budgets():
+    yield
+    forget_replica_state()
+
+
+def forget_replica_state():
+    budget_utils._budgets.clear()
+    budget_utils._demands.clear()
+    budget_utils._allocations.clear()
+
+
+class FakeLeaseApi:
+    """
+        The CoordinationV1Api calls of sharding_utils, conflicts included
+    """
+
+    def __init__(self):
+        self.leases = {}
+        self.version = 0
+
+    def _store(self, body):
+        self.version += 1
+        metadata, spec = body['metadata'], body['spec']
+        self.leases[metadata['name']] = SimpleNamespace(
+            metadata=SimpleNamespace(
+                name=metadata['name'],
+                labels=dict(metadata['labels']),
+                annotations=dict(metadata.get('annotations') or {}),
+                resource_version=str(self.version)
+            ),
+            spec=SimpleNamespace(
+                holder_identity=spec['holderIdentity'],
+                lease_duration_seconds=spec['leaseDurationSeconds'],
+                renew_time=datetime.datetime.strptime(
+                    spec['renewTime'], '%Y-%m-%dT%H:%M:%S.%fZ'
+                ).replace(tzinfo=datetime.timezone.utc)
+            )
+        )
+
+    def list_namespaced_lease(self, namespace, label_selector=None, **kwargs):
+        return SimpleNamespace(items=[copy.deepcopy(lease) for lease in self.leases.values()])
+
+    def create_namespaced_lease(self, namespace, body, **kwargs):
+        if body['metadata']['name'] in self.leases:
+            raise ApiException(status=409, reason='Conflict')
+        self._store(body)
+
+    def replace_namespaced_lease(self, name, namespace, body, **kwargs):
+        if body['metadata']['resourceVersion'] != self.leases[name].metadata.resource_version:
+            raise ApiException(status=409, reason='Conflict')
+        self._store(body)
+
+
+def test_sharded_budget_is_shared_fairly_across_replicas(monkeypatch):
+    monkeypatch.setattr(handlers, 'owns_resource', lambda namespace, name, **_: True)
+
+    # replica b owns a single, busy resource
+    busy = sharding_utils.ShardOwnership('b', 4, 'default', owned=frozenset({1}))
+    budget_utils.apply_budget_event('ADDED', BUDGET)
+    budget_utils.record_demand('default', 'busy', 'busy-celery-worker', 1, 1, 20)
+    assert handlers.allocate_sharded_budgets(busy) == {}
+    assert budget_utils.get_allocation('default', 'busy-celery-worker') is None
+
+    # replica a owns three idle ones and allocates for both
+    forget_replica_state()
+    idle = sharding_utils.ShardOwnership(
+        'a', 4, 'default', owned=frozenset({0, 2, 3}), peers={'b': busy.announced}
+    )
+    budget_utils.apply_budget_event('ADDED', BUDGET)
+    for index in range(3):
+        budget_utils.record_demand('default', f"idle-{index}", f"idle-{index}-celery-worker", 1, 1, 1)
+    status = handlers.allocate_sharded_budgets(idle)['budget']
+    assert status['demandedReplicas'] == 23
+    assert status['allocatedReplicas'] == 10
+    assert status['celeries'] == 4
+    # a static split by shards would leave the busy resource 2 replicas
+    assert {'celery': 'default/busy', 'replicas': 7} in status['allocations']
+    assert budget_utils.get_allocation('default', 'idle-0-celery-worker') == 1
+
+    # replica b reads its share from the budget's status
+    forget_replica_state()
+    budget_utils.apply_budget_event('MODIFIED', dict(BUDGET, status=status))
+    budget_utils.record_demand('default', 'busy', 'busy-celery-worker', 1, 1, 20)
+    handlers.allocate_sharded_budgets(busy)
+    assert budget_utils.get_allocation('default', 'busy-celery-worker') == 7
+
+
+def test_member_leases_carry_published_demands():
+    lease_api = FakeLeaseApi()
+    replicas = [
+        sharding_utils.ShardOwnership(identity, 4, 'default') for identity in ('a', 'b')
+    ]
+    demands = [budget_utils.CeleryDemand('default', 'busy', 2, 1, 20)]
+    replicas[1].announced = {
+        constants.BUDGET_DEMANDS_ANNOTATION: budget_utils.encode_demands(demands)
+    }
+    for ownership in replicas + replicas:
+        sharding_utils.sync_leases(lease_api, ownership, logger)
+
+    published = replicas[0].peers['b'][constants.BUDGET_DEMANDS_ANNOTATION]
+    assert budget_utils.decode_demands(published) == demands
+    assert set(replicas[1].peers) == {'a'}
+    assert constants.BUDGET_ALLOCATOR_SHARD in replicas[0].owned | replicas[1].owned
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+import yaml
+
+import cache_utils
+import constants
+from deployment_utils import (
+    render_flower_deployment,
+    render_flower_service,
+    render_warm_worker_deployment,
+    render_worker_deployment
+)
+from models.worker_pool import worker_pools_from_spec
+
+CR_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'deploy', 'cr.yaml')
+
+
+@pytest.fixture
+def spec():
+    with open(CR_PATH) as cr:
+        spec = yaml.safe_load(cr)['spec']
+    spec['scaleTargetRef'][0]['warmPool'] = {'size': 1}
+    return spec
+
+
+def test_objects_without_celery_owner_are_not_fingerprinted(monkeypatch):
+    def live_fingerprint(kind, spec):
+        raise AssertionError("fingerprinted an object the cache skips")
+
+    monkeypatch.setattr(cache_utils, 'live_fingerprint', live_fingerprint)
+    body = {
+        'metadata': {
+            'name': 'web', 'namespace': 'default', 'resourceVersion': '1',
+            'ownerReferences': [{'kind': 'ReplicaSet', 'apiVersion': 'apps/v1', 'name': 'web'}]
+        },
+        'spec': {'replicas': 3, 'template': {'spec': {'containers': [{'name': 'web'}]}}}
+    }
+    assert cache_utils.apply_watch_event(constants.DEPLOYMENT_KIND, 'MODIFIED', body) is None
+
+
+def test_children_carry_the_label_the_watches_filter_on(spec):
+    pool = worker_pools_from_spec(spec)[0]
+    assert pool.warm_pool
+    manifests = [
+        render_worker_deployment('default', spec, pool),
+        render_warm_worker_deployment('default', spec, pool),
+        render_flower_deployment('default', spec),
+        render_flower_service('default', spec)
+    ]
+    for manifest in manifests:
+        assert manifest['metadata']['labels'][constants.CHILD_LABEL] == 'true'
@@ -0,0 +1,313 @@
+"""
+    The per CR daemons run like kopf 0.27 runs them: sync daemons in
+    settings.execution.executor, async ones on the event loop
+"""
+import asyncio
+import copy
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import yaml
+
+import constants
+import handlers
+import polling_utils
+import task_event_utils
+
+NAMESPACE = 'default'
+CR_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'deploy', 'cr.yaml')
+logger = logging.getLogger(__name__)
+
+
+class Stopped:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def __bool__(self):
+        return self.event.is_set()
+
+
+async def invoke(fn, executor, **kwargs):
+    if asyncio.iscoroutinefunction(fn):
+        return await fn(**kwargs)
+    return await asyncio.get_event_loop().run_in_executor(
+        executor, functools.partial(fn, **kwargs)
+    )
+
+
+def load_spec():
+    with open(CR_PATH) as cr:
+        return yaml.safe_load(cr)['spec']
+
+
+def push_spec(push=True):
+    spec = copy.deepcopy(load_spec())
+    spec['queueMetrics'] = {'brokerUrl': 'redis://broker:6379/0'}
+    spec['polling'] = {'push': push}
+    return spec
+
+
+def events_spec(enabled=True):
+    spec = copy.deepcopy(load_spec())
+    spec['taskEvents'] = {'enabled': enabled, 'brokerUrl': 'redis://broker:6379/0'}
+    return spec
+
+
+@pytest.fixture
+def subscriptions(monkeypatch):
+    """
+        Stands in for the redis subscription and the event consumer, both
+        block until stopped or keep_listening() turns false
+        @returns names of the threads subscribed
+    """
+    subscribed = set()
+
+    def subscribe(*args):
+        stopped, keep_listening = args[-3], args[-1]
+        name = threading.current_thread().name
+        subscribed.add(name)
+        try:
+            while not stopped and keep_listening():
+                time.sleep(0.01)
+        finally:
+            subscribed.discard(name)
+
+    monkeypatch.setattr(handlers, 'listen_for_queue_pushes', subscribe)
+    monkeypatch.setattr(handlers, 'consume_task_events', subscribe)
+    return subscribed
+
+
+async def run_daemons(daemon, specs, subscribed, expected, workers):
+    """
+        Runs `daemon` for every CR in specs(name -> spec) until the
+        expected threads subscribed, then checks a sync handler still runs
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    stopped = Stopped()
+    daemons = [
+        asyncio.ensure_future(invoke(
+            daemon, executor, spec=spec, name=name, namespace=NAMESPACE,
+            logger=logger, stopped=stopped
+        ))
+        for name, spec in specs.items()
+    ]
+    try:
+        for _ in range(100):
+            if len(subscribed) == len(expected):
+                break
+            await asyncio.sleep(0.01)
+        assert subscribed == expected
+
+        # a sync handler, e.g. update_fn, still gets a thread
+        handled = executor.submit(lambda: 'handled')
+        assert await asyncio.wait_for(asyncio.wrap_future(handled), 1) == 'handled'
+    finally:
+        stopped.event.set()
+        await asyncio.sleep(0.1)
+        for task in daemons:
+            task.cancel()
+        await asyncio.gather(*daemons, return_exceptions=True)
+        executor.shutdown(wait=False)
+
+
+def test_queue_push_listeners_leave_kopf_executor_free(monkeypatch, subscriptions):
+    workers = 2
+    owned = {f"cr-{index}" for index in range(workers + 2)}
+    specs = {name: push_spec() for name in owned}
+    specs['not-owned'] = push_spec()
+    specs['push-off'] = push_spec(push=False)
+    monkeypatch.setattr(handlers, 'owns_resource', lambda namespace, name: name != 'not-owned')
+
+    asyncio.run(run_daemons(
+        handlers.queue_push_listener, specs, subscriptions,
+        {f"push-{NAMESPACE}-{name}" for name in owned}, workers
+    ))
+    assert not subscriptions
+
+
+def test_queue_push_listener_filter():
+    assert handlers.wants_queue_pushes(push_spec())
+    assert not handlers.wants_queue_pushes(push_spec(push=False))
+    spec = push_spec()
+    del spec['queueMetrics']
+    assert not handlers.wants_queue_pushes(spec)
+
+
+def test_task_event_consumers_leave_kopf_executor_free(monkeypatch, subscriptions):
+    workers = 2
+    owned = {f"cr-{index}" for index in range(workers + 2)}
+    specs = {name: events_spec() for name in owned}
+    specs['not-owned'] = events_spec()
+    monkeypatch.setattr(handlers, 'owns_resource', lambda namespace, name: name != 'not-owned')
+
+    asyncio.run(run_daemons(
+        handlers.task_event_consumer, specs, subscriptions,
+        {f"events-{NAMESPACE}-{name}" for name in owned}, workers
+    ))
+    assert not subscriptions
+
+
+def test_task_event_consumer_stops_when_events_are_turned_off(monkeypatch, subscriptions):
+    monkeypatch.setattr(handlers, 'owns_resource', lambda namespace, name: True)
+    spec = events_spec()
+    handlers.get_task_event_stats(NAMESPACE, 'cr')
+
+    async def run():
+        stopped = Stopped()
+        daemon = asyncio.ensure_future(handlers.task_event_consumer(
+            spec=spec, name='cr', namespace=NAMESPACE, logger=logger, stopped=stopped
+        ))
+        for _ in range(100):
+            if subscriptions:
+                break
+            await asyncio.sleep(0.01)
+        assert subscriptions
+
+        # kopf updates the spec in place, then stops the daemon on the filter mismatch
+        spec['taskEvents']['enabled'] = False
+        assert not handlers.task_events_broker_url(spec)
+        stopped.event.set()
+        await asyncio.wait_for(daemon, 1)
+
+    asyncio.run(run())
+    assert not subscriptions
+    assert (NAMESPACE, 'cr') not in task_event_utils._stats
+
+
+class FakePubSub:
+    """
+        Keyspace notifications are fed through `notify`, get_message waits
+        for one like redis-py does, only shorter
+    """
+
+    def __init__(self):
+        self.patterns = ()
+        self.messages = queue.Queue()
+        self.closed = False
+
+    def psubscribe(self, *patterns):
+        self.patterns = patterns
+
+    def notify(self, command):
+        self.messages.put({'type': 'pmessage', 'pattern': self.patterns[0], 'data': command})
+
+    def get_message(self, timeout=0.0):
+        try:
+            return self.messages.get(timeout=min(timeout, 0.01))
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool:
+    connection_kwargs = {'db': 0}
+
+    def disconnect(self):
+        pass
+
+
+class FakeRedis:
+    def __init__(self, subscriptions):
+        self.subscriptions = subscriptions
+        self.connection_pool = FakePool()
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        self.subscriptions.append(FakePubSub())
+        return self.subscriptions[-1]
+
+
+@pytest.fixture
+def pubsubs(monkeypatch):
+    """
+        @returns every subscription made to the fake redis broker, in order
+    """
+    import redis
+
+    subscriptions = []
+    monkeypatch.setattr(
+        redis.Redis, 'from_url', classmethod(lambda cls, url, **kwargs: FakeRedis(subscriptions))
+    )
+    return subscriptions
+
+
+async def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+def test_queue_pushes_request_a_poll(monkeypatch, pubsubs):
+    monkeypatch.setattr(handlers, 'owns_resource', lambda namespace, name: True)
+    polling = polling_utils.get_polling_state(NAMESPACE, 'pushed')
+
+    async def run():
+        stopped = Stopped()
+        daemon = asyncio.ensure_future(handlers.queue_push_listener(
+            spec=push_spec(), name='pushed', namespace=NAMESPACE, logger=logger, stopped=stopped
+        ))
+        try:
+            await wait_for(lambda: pubsubs)
+            subscription = pubsubs[0]
+            assert subscription.patterns == ('__keyspace@0__:celery*',)
+
+            for command in (b'lpush', b'rpush'):
+                polling.next_poll_at = float('inf')
+                subscription.notify(command)
+                await wait_for(lambda: polling.next_poll_at == 0)
+
+            # consumers popping don't ask for a poll
+            polling.next_poll_at = float('inf')
+            subscription.notify(b'brpop')
+            await asyncio.sleep(0.1)
+            assert polling.next_poll_at == float('inf')
+        finally:
+            stopped.event.set()
+            await asyncio.wait_for(daemon, 1)
+        assert subscription.closed
+
+    try:
+        asyncio.run(run())
+    finally:
+        polling_utils.forget_polling_state(NAMESPACE, 'pushed')
+
+
+def test_queue_push_subscription_is_rebuilt_when_it_goes_stale(monkeypatch, pubsubs):
+    owned = {'pushed'}
+    monkeypatch.setattr(handlers, 'owns_resource', lambda namespace, name: name in owned)
+    monkeypatch.setattr(constants, 'PUSH_LISTENER_RETRY_INTERVAL', 0.05)
+    spec = push_spec()
+
+    async def run():
+        stopped = Stopped()
+        daemon = asyncio.ensure_future(handlers.queue_push_listener(
+            spec=spec, name='pushed', namespace=NAMESPACE, logger=logger, stopped=stopped
+        ))
+        try:
+            await wait_for(lambda: pubsubs)
+
+            # kopf updates the spec in place, keep_listening turns false
+            spec['workerSpec']['queues'] = 'reports'
+            await wait_for(lambda: len(pubsubs) == 2)
+            assert pubsubs[0].closed
+            assert pubsubs[1].patterns == ('__keyspace@0__:reports*',)
+
+            # another replica took over the CR
+            owned.clear()
+            await wait_for(lambda: pubsubs[1].closed)
+            await asyncio.sleep(0.1)
+            assert len(pubsubs) == 2
+        finally:
+            stopped.event.set()
+            await asyncio.wait_for(daemon, 1)
+
+    asyncio.run(run())
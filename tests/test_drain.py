@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+
+import pytest
+import yaml
+
+import handlers
+from scaling_utils import Drain, ScalingState
+
+NAMESPACE = 'default'
+CR_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'deploy', 'cr.yaml')
+logger = logging.getLogger(__name__)
+
+
+class FakeAppsV1Api:
+    def __init__(self):
+        self.patches = []
+
+    def patch_namespaced_deployment(self, name, namespace, body, **kwargs):
+        self.patches.append((name, body['spec']['replicas']))
+
+
+@pytest.fixture
+def pool():
+    with open(CR_PATH) as cr:
+        spec = yaml.safe_load(cr)['spec']
+    spec['scaleTargetRef'][0]['gracefulScaleDown'] = {'drainTimeoutSeconds': 300}
+    return handlers.worker_pools_from_spec(spec)[0]
+
+
+@pytest.fixture
+def cluster(monkeypatch, pool):
+    """
+        Fakes flower and the API: 5 workers with 0 to 4 tasks in flight
+    """
+    hostnames = [f"celery@{pool.deployment_name}-5d8f7c9b4-{suffix}" for suffix in 'abcde']
+    fake = type('Cluster', (), {})()
+    fake.load = {hostname: tasks for tasks, hostname in enumerate(hostnames)}
+    fake.hostnames = hostnames
+    fake.deletion_costs = {}
+    fake.consuming = {hostname: True for hostname in hostnames}
+    fake.apps_api = FakeAppsV1Api()
+
+    async def get_flower_worker_load(flower_svc_host, logger=None):
+        return dict(fake.load)
+
+    async def set_flower_consumer(flower_svc_host, hostname, queue, consume, logger=None):
+        fake.consuming[hostname] = consume
+
+    def set_pod_deletion_cost(core_api, namespace, hostname, cost):
+        fake.deletion_costs[hostname] = cost
+
+    monkeypatch.setattr(handlers, 'get_flower_worker_load', get_flower_worker_load)
+    monkeypatch.setattr(handlers, 'set_flower_consumer', set_flower_consumer)
+    monkeypatch.setattr(handlers, 'set_pod_deletion_cost', set_pod_deletion_cost)
+    monkeypatch.setattr(handlers, 'core_v1_api', lambda: None)
+    monkeypatch.setattr(handlers, 'apps_v1_api', lambda: fake.apps_api)
+    return fake
+
+
+def test_raised_target_restores_surplus_drained_workers(pool, cluster):
+    state = ScalingState(current_replicas=5)
+    state.drain = Drain(target_replicas=2, started_at=0)
+
+    async def progress(now):
+        await handlers.progress_drain(pool, state, 'flower:5555', NAMESPACE, logger, now)
+
+    asyncio.run(progress(1))
+    a, b, c, d, e = cluster.hostnames
+    assert state.drain.workers == [a, b, c]
+    assert not any(cluster.consuming[hostname] for hostname in (a, b, c))
+
+    # a later evaluation wants 4 of the 5 replicas
+    replicas = handlers.apply_replicas(
+        cluster.apps_api, pool, NAMESPACE, state, 5, 4, logger, now=2
+    )
+    assert replicas == 5
+    assert state.drain.target_replicas == 4
+
+    asyncio.run(progress(3))
+    # the busiest drained workers consume again, the idle one goes
+    assert all(cluster.consuming[hostname] for hostname in (b, c, d, e))
+    assert cluster.deletion_costs[b] is None and cluster.deletion_costs[c] is None
+    assert not cluster.consuming[a]
+    assert cluster.deletion_costs[a] is not None
+    assert state.drain is None
+    assert cluster.apps_api.patches == [(pool.deployment_name, 4)]
+
+
+def test_lowered_target_drains_more_workers(pool, cluster):
+    state = ScalingState(current_replicas=5)
+    state.drain = Drain(target_replicas=4, started_at=0)
+
+    asyncio.run(handlers.progress_drain(pool, state, 'flower:5555', NAMESPACE, logger, 1))
+    handlers.apply_replicas(cluster.apps_api, pool, NAMESPACE, state, 5, 3, logger, now=2)
+    asyncio.run(handlers.progress_drain(pool, state, 'flower:5555', NAMESPACE, logger, 3))
+
+    a, b = cluster.hostnames[:2]
+    assert state.drain.workers == [a, b]
+    assert not cluster.apps_api.patches
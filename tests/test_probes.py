@@ -0,0 +1,61 @@
+import os
+
+import pytest
+import yaml
+
+import constants
+from deployment_utils import (
+    render_warm_worker_deployment,
+    render_worker_deployment
+)
+from models.worker_pool import worker_pools_from_spec
+
+CR_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'deploy', 'cr.yaml')
+
+
+@pytest.fixture
+def spec():
+    with open(CR_PATH) as cr:
+        spec = yaml.safe_load(cr)['spec']
+    spec['scaleTargetRef'][0]['warmPool'] = {'size': 1}
+    return spec
+
+
+def worker_containers(spec):
+    for pool in worker_pools_from_spec(spec):
+        renders = [render_worker_deployment]
+        if pool.warm_pool:
+            renders.append(render_warm_worker_deployment)
+        for render in renders:
+            yield render('default', spec, pool)['spec']['template']['spec']['containers'][0]
+
+
+def test_no_probes_unless_enabled(spec):
+    for container in worker_containers(spec):
+        assert 'readinessProbe' not in container
+        assert 'livenessProbe' not in container
+
+
+def test_enabled_probes_ping_the_worker(spec):
+    spec['workerSpec']['probes'] = {'enabled': True}
+    for container in worker_containers(spec):
+        for probe in ('readinessProbe', 'livenessProbe'):
+            command = container[probe]['exec']['command'][-1]
+            assert command.startswith(f"celery --app={spec['common']['celeryApp']} inspect ping")
+            assert '--destination=celery@$HOSTNAME' in command
+            assert container[probe]['timeoutSeconds'] > constants.WORKER_PING_TIMEOUT
+        assert container['livenessProbe']['initialDelaySeconds']
+        # no files that only an opted in app maintains
+        assert 'env' not in container or not any(
+            var['name'] == 'CELERY_WORKER_READY_FILE' for var in container['env']
+        )
+
+
+def test_file_probes_only_for_apps_that_opt_in(spec):
+    spec['workerSpec']['probes'] = {'enabled': True, 'mode': constants.WORKER_PROBE_FILES}
+    for container in worker_containers(spec):
+        env = {var['name']: var['value'] for var in container['env']}
+        assert env['CELERY_WORKER_READY_FILE'] == constants.WORKER_READY_FILE
+        readiness = container['readinessProbe']['exec']['command'][-1]
+        assert readiness.startswith(f"test -f {constants.WORKER_READY_FILE}")
+        assert 'inspect ping' not in container['livenessProbe']['exec']['command'][-1]
@@ -1,41 +1,41 @@
+import copy
+from kubernetes.client.rest import ApiException
+
 import constants
-from models.worker_spec import (
-    args_list_from_spec_params
+from cache_utils import (
+    cache_object,
+    get_cached_child,
+    has_drifted
+)
+from deployment_utils import (
+    render_worker_deployment,
+    render_warm_worker_deployment,
+    render_flower_deployment,
+    render_flower_service,
+    deploy_celery_workers,
+    deploy_warm_workers,
+    deploy_flower,
+    expose_flower_service,
+    child_status,
+    get_manifest_hash
+)
+from metrics_utils import (
+    DRIFT_CORRECTIONS
+)
+from models.worker_pool import (
+    worker_pools_from_spec
 )
 
 
-def update_all_deployments(api, apps_api_instance, spec, status, namespace):
-    worker_deployment = update_worker_deployment(
-        apps_api_instance, spec, status, namespace
-    )
-
-    flower_deployment = update_flower_deployment(
-        apps_api_instance, spec, status, namespace
-    )
-
-    flower_svc = update_flower_service(
-        api, spec, status, namespace
-    )
-
+def update_all_deployments(api, apps_api_instance, spec, status, namespace, logger):
+    """
+        Reconciles all children against the spec. Only children whose
+        rendered manifest hash changed since the last apply are patched
+    """
     children = [
-        {
-            'name': worker_deployment.metadata.name,
-            'replicas': worker_deployment.spec.replicas,
-            'kind': constants.DEPLOYMENT_KIND,
-            'type': constants.WORKER_TYPE
-        },
-        {
-            'name': flower_deployment.metadata.name,
-            'replicas': flower_deployment.spec.replicas,
-            'kind': constants.DEPLOYMENT_KIND,
-            'type': constants.FLOWER_TYPE
-        },
-        {
-            'name': flower_svc.metadata.name,
-            'spec': flower_svc.spec.to_dict(),
-            'kind': constants.SERVICE_KIND,
-            'type': constants.FLOWER_TYPE
-        }
+        *update_worker_deployments(apps_api_instance, spec, status, namespace, logger),
+        update_flower_deployment(apps_api_instance, spec, status, namespace),
+        update_flower_service(api, spec, status, namespace)
     ]
 
     return {
@@ -45,120 +45,330 @@ def update_all_deployments(api, apps_api_instance, spec, status, namespace):
     }
 
 
-def get_curr_deployment_from_handler_status(handler_name, status, child_type):
+def get_handler_status(status):
+    """
+        Latest handler status holding the children i.e. update_fn or create_fn
+    """
+    return status.get('update_fn') or status.get('create_fn')
+
+
+def get_curr_worker_children(status, child_type=constants.WORKER_TYPE):
+    """
+        @param: child_type - worker or warm-worker
+        @returns pool name -> copy of the worker deployment's status dict
+    """
+    return {
+        child.get('pool'): dict(child)
+        for child in get_handler_status(status).get('children')
+        if child.get('type') == child_type and child.get('kind') == constants.DEPLOYMENT_KIND  # NOQA
+    }
+
+
+def get_curr_child_from_handler_status(handler_name, status, child_type, kind):
     """
-        Get current deployment name from handler's status
+        Get current child's status from handler's status
         @param: handler_name - which handler to get from
         @param: child_type - worker or flower
-        @returns: current deployment name
+        @param: kind - Deployment or Service
+        @returns: copy of the child's status dict
     """
     for child in status.get(handler_name).get('children'):
-        if child.get('type') == child_type and child.get('kind') == constants.DEPLOYMENT_KIND:  # NOQA
-            return child.get('name')
+        if child.get('type') == child_type and child.get('kind') == kind:
+            return dict(child)
 
     return None
 
 
+def get_curr_child(status, child_type, kind=constants.DEPLOYMENT_KIND):
+    """
+        Get current child's status from parent's status
+        @param: child_type - worker or flower
+        @returns: copy of the child's status dict
+    """
+    if status.get('update_fn'):
+        return get_curr_child_from_handler_status('update_fn', status, child_type, kind)
+
+    return get_curr_child_from_handler_status('create_fn', status, child_type, kind)
+
+
 def get_curr_deployment_name(status, child_type):
     """
         Get current deployment name from parent's status
         @param: child_type - worker or flower
         @returns: current deployment name
     """
-    if status.get('update_fn'):
-        return get_curr_deployment_from_handler_status('update_fn', status, child_type)
-
-    return get_curr_deployment_from_handler_status('create_fn', status, child_type)
-
-
-def update_worker_deployment(apps_api_instance, spec, status, namespace):
-    worker_spec = spec['workerSpec']
-    worker_spec_dict = {
-        'args': args_list_from_spec_params(
-            celery_app=spec['common']['celeryApp'],
-            queues=worker_spec['queues'],
-            loglevel=worker_spec['logLevel'],
-            concurrency=worker_spec['concurrency']
-        ),
-        'command': ["celery"],
-        'image': spec['common']['image'],
-        'name': f"{spec['common']['appName']}-celery-worker",
-        'resources': worker_spec['resources']
-    }
+    child = get_curr_child(status, child_type)
+    return child and child.get('name')
+
 
-    # JSON way of submitting spec to deploy/patch
-    patch_body = {
-        "spec": {
-            "replicas": worker_spec['numOfWorkers'],
-            "template": {
-                "spec": {
-                    "containers": [
-                        worker_spec_dict
-                    ]
-                }
-            }
-        }
+def patch_body_from_manifest(manifest):
+    """
+        Builds a strategic merge patch applying a rendered manifest
+        to an existing child
+    """
+    metadata = manifest['metadata']
+    body = {
+        'metadata': {
+            'labels': metadata.get('labels', {}),
+            'annotations': metadata.get('annotations', {})
+        },
+        'spec': copy.deepcopy(manifest['spec'])
     }
 
-    worker_deployment_name = get_curr_deployment_name(
-        status, constants.WORKER_TYPE
+    if manifest['kind'] == constants.DEPLOYMENT_KIND:
+        # selector is immutable and pod labels must keep matching it
+        body['spec'].pop('selector', None)
+        body['spec']['template'].pop('metadata', None)
+        # replace containers rather than merge them by name
+        body['spec']['template']['spec']['containers'].append({'$patch': 'replace'})
+
+    return body
+
+
+def update_worker_deployments(apps_api_instance, spec, status, namespace, logger):
+    """
+        Creates deployments of new worker pools and warm pools, patches
+        changed ones and deletes the ones removed from the spec
+        @returns status entries of the worker deployments
+    """
+    curr_children = get_curr_worker_children(status)
+    curr_warm_children = get_curr_worker_children(status, constants.WARM_WORKER_TYPE)
+    children = []
+    for pool in worker_pools_from_spec(spec, status):
+        child = curr_children.pop(pool.name, None)
+        if child is None:
+            worker_deployment = deploy_celery_workers(
+                apps_api_instance, namespace, spec, logger, pool
+            )
+            children.append(child_status(
+                worker_deployment, constants.DEPLOYMENT_KIND,
+                constants.WORKER_TYPE, pool=pool.name
+            ))
+        else:
+            children.append(update_worker_deployment(
+                apps_api_instance, spec, pool, child, namespace
+            ))
+
+        if not pool.warm_pool:
+            continue
+        child = curr_warm_children.pop(pool.name, None)
+        if child is None:
+            warm_deployment = deploy_warm_workers(
+                apps_api_instance, namespace, spec, logger, pool
+            )
+            children.append(child_status(
+                warm_deployment, constants.DEPLOYMENT_KIND,
+                constants.WARM_WORKER_TYPE, pool=pool.name
+            ))
+        else:
+            children.append(update_warm_worker_deployment(
+                apps_api_instance, spec, pool, child, namespace
+            ))
+
+    for child in curr_children.values():
+        apps_api_instance.delete_namespaced_deployment(child['name'], namespace)
+        logger.info("Deleted deployment of removed worker pool: %s", child['name'])
+
+    for child in curr_warm_children.values():
+        apps_api_instance.delete_namespaced_deployment(child['name'], namespace)
+        logger.info("Deleted deployment of removed warm pool: %s", child['name'])
+
+    return children
+
+
+def update_worker_deployment(apps_api_instance, spec, pool, child, namespace):
+    """
+        @param: pool - WorkerPool of the deployment
+        @param: child - status entry the deployment was last applied with
+    """
+    manifest = render_worker_deployment(namespace, spec, pool)
+    if child.get('hash') == get_manifest_hash(manifest):
+        return child
+
+    patch_body = patch_body_from_manifest(manifest)
+    if pool.scaling_target:
+        # replicas belong to the autoscaler once it is set up
+        patch_body['spec'].pop('replicas', None)
+
+    worker_deployment = apps_api_instance.patch_namespaced_deployment(
+        child['name'], namespace, patch_body
     )
+    cache_object(constants.DEPLOYMENT_KIND, worker_deployment)
+    child.update({
+        'name': worker_deployment.metadata.name,
+        'replicas': worker_deployment.spec.replicas,
+        'hash': get_manifest_hash(manifest)
+    })
+    return child
 
-    return apps_api_instance.patch_namespaced_deployment(
-        worker_deployment_name, namespace, patch_body
+
+def update_warm_worker_deployment(apps_api_instance, spec, pool, child, namespace):
+    """
+        Unlike the pool's, the warm deployment's replicas are the warmPool
+        size and always applied
+        @param: child - status entry the deployment was last applied with
+    """
+    manifest = render_warm_worker_deployment(namespace, spec, pool)
+    if child.get('hash') == get_manifest_hash(manifest):
+        return child
+
+    warm_deployment = apps_api_instance.patch_namespaced_deployment(
+        child['name'], namespace, patch_body_from_manifest(manifest)
     )
+    cache_object(constants.DEPLOYMENT_KIND, warm_deployment)
+    child.update({
+        'name': warm_deployment.metadata.name,
+        'replicas': warm_deployment.spec.replicas,
+        'hash': get_manifest_hash(manifest)
+    })
+    return child
 
 
 def update_flower_deployment(apps_api_instance, spec, status, namespace):
-    flower_spec = spec['flowerSpec']
-
-    flower_spec_dict = {
-        'args': [spec['common']['celeryApp']],
-        'command': ['flower'],
-        'image': spec['common']['image'],
-        'name': f"{spec['common']['appName']}-flower",
-        'ports': [
-            {"containerPort": 5555}
-        ],
-        'resources': flower_spec['resources']
-    }
+    return apply_flower_deployment(
+        apps_api_instance, spec, get_curr_child(status, constants.FLOWER_TYPE), namespace
+    )
 
-    # JSON way of submitting spec to deploy/patch
-    patch_body = {
-        "spec": {
-            "replicas": flower_spec['replicas'],
-            "template": {
-                "spec": {
-                    "containers": [
-                        flower_spec_dict
-                    ]
-                }
-            }
-        }
-    }
 
-    flower_deployment_name = get_curr_deployment_name(
-        status, constants.FLOWER_TYPE
-    )
+def apply_flower_deployment(apps_api_instance, spec, child, namespace):
+    """
+        @param: child - status entry the deployment was last applied with
+    """
+    manifest = render_flower_deployment(namespace, spec)
+    if child.get('hash') == get_manifest_hash(manifest):
+        return child
 
-    return apps_api_instance.patch_namespaced_deployment(
-        flower_deployment_name, namespace, patch_body
+    flower_deployment = apps_api_instance.patch_namespaced_deployment(
+        child['name'], namespace, patch_body_from_manifest(manifest)
     )
+    cache_object(constants.DEPLOYMENT_KIND, flower_deployment)
+    child.update({
+        'name': flower_deployment.metadata.name,
+        'replicas': flower_deployment.spec.replicas,
+        'hash': get_manifest_hash(manifest)
+    })
+    return child
 
 
 def update_flower_service(api, spec, status, namespace):
-    # Only app_name change will affect flower service
-    patch_body = {
-        "spec": {
-            "selector": {
-                "run": f"{spec['common']['appName']}-flower"
-            }
-        }
-    }
+    return apply_flower_service(
+        api, spec, get_curr_child(status, constants.FLOWER_TYPE, constants.SERVICE_KIND),
+        namespace
+    )
+
+
+def apply_flower_service(api, spec, child, namespace):
+    """
+        @param: child - status entry the service was last applied with
+    """
+    manifest = render_flower_service(namespace, spec)
+    if child.get('hash') == get_manifest_hash(manifest):
+        return child
 
-    flower_svc_name = get_curr_deployment_name(
-        status, constants.FLOWER_TYPE
-    )  # flower svc is named same as flower deployment
-    return api.patch_namespaced_service(
-        flower_svc_name, namespace, patch_body
+    flower_svc = api.patch_namespaced_service(
+        child['name'], namespace, patch_body_from_manifest(manifest)
     )
+    cache_object(constants.SERVICE_KIND, flower_svc)
+    child.update({
+        'name': flower_svc.metadata.name,
+        'spec': flower_svc.spec.to_dict(),
+        'hash': get_manifest_hash(manifest)
+    })
+    return child
+
+
+def correct_child_drift(api, apps_api_instance, spec, namespace, logger, status=None):
+    """
+        Compares the cached children of a Celery resource against the spec
+        and re-applies the ones that were changed or deleted behind the
+        operator's back. Removed worker pools are left to update_fn
+        @param: status - CR status, for the options and resources applied
+            by autotune and rightsizing
+        @returns names of the corrected children
+    """
+    pools = worker_pools_from_spec(spec, status)
+    corrected = []
+    for pool in pools:
+        manifest = render_worker_deployment(namespace, spec, pool)
+        child = get_cached_child_or_read(
+            apps_api_instance.read_namespaced_deployment,
+            namespace, constants.DEPLOYMENT_KIND, pool.deployment_name
+        )
+        if child is None:
+            deploy_celery_workers(apps_api_instance, namespace, spec, logger, pool)
+        elif has_drifted(child, get_manifest_hash(manifest)) or \
+                (not pool.scaling_target and child['replicas'] != pool.replicas):
+            update_worker_deployment(
+                apps_api_instance, spec, pool, {'name': child['name']}, namespace
+            )
+        else:
+            continue
+        corrected.append((constants.DEPLOYMENT_KIND, pool.deployment_name))
+
+    for pool in pools:
+        if not pool.warm_pool:
+            continue
+        manifest = render_warm_worker_deployment(namespace, spec, pool)
+        child = get_cached_child_or_read(
+            apps_api_instance.read_namespaced_deployment,
+            namespace, constants.DEPLOYMENT_KIND, pool.warm_deployment_name
+        )
+        if child is None:
+            deploy_warm_workers(apps_api_instance, namespace, spec, logger, pool)
+        elif has_drifted(child, get_manifest_hash(manifest)) or \
+                child['replicas'] != manifest['spec']['replicas']:
+            update_warm_worker_deployment(
+                apps_api_instance, spec, pool, {'name': child['name']}, namespace
+            )
+        else:
+            continue
+        corrected.append((constants.DEPLOYMENT_KIND, pool.warm_deployment_name))
+
+    manifest = render_flower_deployment(namespace, spec)
+    child = get_cached_child_or_read(
+        apps_api_instance.read_namespaced_deployment,
+        namespace, constants.DEPLOYMENT_KIND, manifest['metadata']['name']
+    )
+    if child is None:
+        deploy_flower(apps_api_instance, namespace, spec, logger)
+        corrected.append((constants.DEPLOYMENT_KIND, manifest['metadata']['name']))
+    elif has_drifted(child, get_manifest_hash(manifest)) or \
+            child['replicas'] != manifest['spec']['replicas']:
+        apply_flower_deployment(apps_api_instance, spec, {'name': child['name']}, namespace)
+        corrected.append((constants.DEPLOYMENT_KIND, child['name']))
+
+    manifest = render_flower_service(namespace, spec)
+    child = get_cached_child_or_read(
+        api.read_namespaced_service,
+        namespace, constants.SERVICE_KIND, manifest['metadata']['name']
+    )
+    if child is None:
+        expose_flower_service(api, namespace, spec, logger)
+        corrected.append((constants.SERVICE_KIND, manifest['metadata']['name']))
+    elif has_drifted(child, get_manifest_hash(manifest)):
+        apply_flower_service(api, spec, {'name': child['name']}, namespace)
+        corrected.append((constants.SERVICE_KIND, child['name']))
+
+    for kind, child_name in corrected:
+        DRIFT_CORRECTIONS.labels(kind).inc()
+        logger.warning("Corrected drift of %s %s", kind, child_name)
+    return [child_name for _, child_name in corrected]
+
+
+def get_cached_child_or_read(read, namespace, kind, name):
+    """
+        Children the watch hasn't delivered yet, e.g. right after start up,
+        are read once and cached
+        @returns cache entry of the child or None if it doesn't exist
+    """
+    child = get_cached_child(namespace, kind, name)
+    if child is not None:
+        return child
+
+    try:
+        obj = read(name, namespace)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        return None
+    return cache_object(kind, obj)